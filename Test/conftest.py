@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+# Test/ has an old copy of the scorer, so the scripts in the repository root are imported instead.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compare_coverage_read_info as scorer  # noqa: E402
+
+# Reads on the synthetic graph with 3 edits. The diagnostic edges of its arms (homology_arm_0 is left out of the
+# tables) are (16, 18) and (20, 38) for homology_arm_1, (16, 17) and (17, 18) for its reference, (28, 30) and
+# (32, 39) for homology_arm_2, and (28, 29) and (29, 30) for its reference.
+# Columns: name, length, start, end, strand, path, path length, path start, path end, matches, block length, MAPQ.
+GAF = """\
+r1\t150\t0\t150\t+\t>16>18\t100\t0\t100\t95\t100\t60\tAS:i:95\tid:f:0.5
+r2\t150\t0\t150\t+\t<38<20\t100\t0\t100\t95\t100\t60\tAS:i:95
+r3\t150\t0\t150\t+\t>16>17>18\t100\t0\t100\t95\t100\t60\tAS:i:95
+r4\t150\t0\t150\t+\t>28>30\t100\t0\t100\t95\t100\t20\tAS:i:95
+r5\t150\t0\t150\t+\t>28>29>30\t100\t0\t100\t95\t100\t40\tAS:i:95
+r6\t150\t0\t150\t+\t>32>39\t100\t0\t100\t55\t60\t50\tAS:i:55
+r7\t150\t0\t150\t+\t>28>29\t100\t0\t100\t40\t100\t60\tAS:i:40
+r8\t150\t0\t150\t+\t>5\t100\t0\t100\t95\t100\t60\tAS:i:95
+r9\t150\t0\t150\t+\t>16>18>100\t100\t0\t100\t95\t100\t60\tAS:i:95
+"""
+# [arm, hom coverage, ref coverage, hom edges, hom tally, ref edges, ref tally], with the default filter (MAPQ >= 30)
+EXPECTED_TABLE = [["homology_arm_1-", 1.5, 1.0, 2, 3, 2, 2], ["homology_arm_2+", 0.5, 1.5, 2, 1, 2, 3]]
+
+
+def synthetic_paths():
+    # The paths of the synthetic graph, with a plasmid path whose node 100 is on no other path.
+    return scorer.synthetic_graph(3).path_list + [("plasmid_1", [100, 101], [False, False])]
+
+
+def write_gfa(gfa_file_name, paths, newline="\n"):
+    # A GFA with a segment for every node and a P line for every path.
+    nodes = sorted({int(node) for _, path_nodes, _ in paths for node in path_nodes})
+    lines = ["H\tVN:Z:1.0"] + [f"S\t{node}\tA" for node in nodes]
+    for name, path_nodes, reverse in paths:
+        steps = ",".join(f"{node}{'-' if rev else '+'}" for node, rev in zip(path_nodes, reverse))
+        lines.append(f"P\t{name}\t{steps}\t*")
+    with open(gfa_file_name, "w", newline="") as gfa_file:
+        gfa_file.write(newline.join(lines) + newline)
+    return str(gfa_file_name)
+
+
+@pytest.fixture
+def graph():
+    return scorer.MemoryGraph(synthetic_paths())
+
+
+@pytest.fixture
+def gfa_writer():
+    return write_gfa
+
+
+@pytest.fixture
+def gfa_file(tmp_path):
+    return write_gfa(tmp_path / "graph.gfa", synthetic_paths())
+
+
+@pytest.fixture
+def gaf_text():
+    return GAF
+
+
+@pytest.fixture
+def gaf_file(tmp_path):
+    gaf_file_name = tmp_path / "sample.gaf"
+    gaf_file_name.write_text(GAF)
+    return str(gaf_file_name)
+
+
+@pytest.fixture
+def expected_table():
+    return [list(row) for row in EXPECTED_TABLE]
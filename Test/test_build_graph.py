@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import build_graph
+
+# The graph tools, faked: each one logs its name and writes outputs made from its inputs. minimap2 places every arm
+# on the first sequence of the reference.
+FAKE_TOOLS = {
+    "minimap2": """ref=$(grep -m1 '^>' "${@: -2:1}" | cut -c2- | cut -d' ' -f1)
+grep '^>' "${@: -1}" | cut -c2- | awk -v OFS='\\t' -v ref="$ref" '{print $1, 4, 0, 4, "+", ref, 8, 0, 4, 4, 4, 60}'""",
+    "seqwish": """cat "$4" "$6" >"$2\"""",
+    "odgi": """if [ "$1" = build ]; then cat "$3"; else cat; fi""",
+    "vg": """if [ "$1" = convert ]; then cat "$3"; else cp "${@: -1}" "$4"; echo lcp >"$4.lcp"; fi""",
+}
+
+
+def design_row(arm, reference, edit):
+    return ",".join([arm] + ["x"] * 51 + [reference, edit]) + "\n"
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for tool, script in FAKE_TOOLS.items():
+        (bin_dir / tool).write_text(f"#!/bin/bash\necho {tool} >>\"$CALLS\"\n{script}\n")
+        (bin_dir / tool).chmod(0o755)
+    directory = tmp_path / "work"
+    directory.mkdir()
+    (directory / "design.csv").write_text(design_row("1", "ACGTACGT", "ACGAACGT") + design_row("2", "TTGCA", "TTGGA"))
+    (directory / "ref.fa").write_text(">chrI\nACGTACGTTTGCA\n>chrII\nGGGG\n")
+    (directory / "plasmid.fa").write_text(">CB39\nAAAA\n")
+    return directory
+
+
+def build(directory, *options):
+    calls = directory.parent / "calls.log"
+    if calls.exists():
+        calls.unlink()
+    env = dict(os.environ, PATH=f"{directory.parent / 'bin'}{os.pathsep}{os.environ['PATH']}", CALLS=str(calls))
+    result = subprocess.run([sys.executable, build_graph.__file__, "--design-csv", "design.csv", "--reference",
+                             "ref.fa", "--plasmid", "plasmid.fa", "--threads", "2"] + list(options),
+                            cwd=directory, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    steps = dict(line.split(": ", 1) for line in result.stdout.splitlines() if ": " in line and " in " not in line)
+    return steps, calls.read_text().split() if calls.exists() else []
+
+
+def outputs(directory):
+    return {name: (directory / name).read_bytes() for step in build_graph.STEPS for name in step["outputs"]}
+
+
+def cache_entries(directory):
+    return sorted(os.listdir(directory / build_graph.GRAPH_CACHE_DIR / "steps"))
+
+
+def test_only_changed_steps_run(workdir):
+    steps, calls = build(workdir)
+    assert set(steps.values()) == {"run"}
+    assert calls == ["minimap2", "seqwish", "odgi", "odgi", "odgi", "odgi", "vg", "vg"]
+    built = outputs(workdir)
+    assert b">plasmid_CB39\n" in built["yeast+edits.fa"]
+    steps, calls = build(workdir)
+    assert set(steps.values()) == {"cached"} and calls == []
+    assert outputs(workdir) == built
+    (workdir / "plasmid.fa").write_text(">CB39\nCCCC\n")
+    steps, calls = build(workdir)
+    assert [step for step, status in steps.items() if status == "run"] == ["fasta", "seqwish", "odgi", "xg", "gcsa"]
+    assert "minimap2" not in calls
+
+
+def test_cached_outputs_are_read_only(workdir):
+    build(workdir)
+    for name in outputs(workdir):
+        assert not os.stat(workdir / name).st_mode & 0o222, name
+    # A step that runs again can still replace its outputs in the working directory.
+    (workdir / "plasmid.fa").write_text(">CB39\nCCCC\n")
+    build(workdir)
+    assert b"CCCC" in (workdir / "yeast+edits.fa").read_bytes()
+
+
+def test_force_replaces_the_cache_entries(workdir):
+    build(workdir)
+    entries = cache_entries(workdir)
+    built = outputs(workdir)
+    # A damaged cache entry, which --force is there to mend.
+    damaged = workdir / "yeast+edits.og.gfa"
+    damaged.chmod(0o644)
+    damaged.write_text("damaged")
+    steps, calls = build(workdir, "--force")
+    assert set(steps.values()) == {"run"} and "minimap2" in calls and "vg" in calls
+    assert cache_entries(workdir) == entries
+    assert outputs(workdir) == built
+    for entry in entries:
+        for name in os.listdir(workdir / build_graph.GRAPH_CACHE_DIR / "steps" / entry):
+            assert os.path.samefile(workdir / build_graph.GRAPH_CACHE_DIR / "steps" / entry / name, workdir / name)
+
+
+def test_dry_run(workdir):
+    steps, calls = build(workdir, "--dry-run")
+    assert steps["arms"] == "run" and steps["paf"] == "run (after arms)" and calls == []
+    assert not (workdir / "yeast+edits.fa").exists()
+    build(workdir)
+    steps, calls = build(workdir, "--dry-run")
+    assert set(steps.values()) == {"cached"} and calls == []
+    (workdir / "ref.fa").write_text(">chrI\nACGTACGTTTGCA\n>chrII\nGGGGG\n")
+    steps, _ = build(workdir, "--dry-run")
+    assert (steps["arms"], steps["paf"], steps["fasta"]) == ("cached", "run", "run")
+    assert steps["seqwish"] == "run (after fasta, paf)"
@@ -0,0 +1,48 @@
+import csv
+
+import numpy as np
+import pytest
+
+import compare_coverage_read_info as scorer
+
+
+def test_known_tallies(graph, gaf_file, expected_table):
+    engine = scorer.CoverageEngine(graph=graph)
+    assert engine.score(gaf_file) == expected_table
+
+
+def test_table_file(graph, gaf_file, expected_table, tmp_path):
+    engine = scorer.CoverageEngine(graph=graph)
+    out_file_name = str(tmp_path / "sample.tsv")
+    scorer.write_to_tsv(engine.score(gaf_file), out_file_name)
+    with open(out_file_name) as tsv_file:
+        rows = list(csv.reader(tsv_file, delimiter="\t"))
+    assert rows[0][0] == "Homology arm"
+    assert rows[1:] == [[str(value) for value in row] for row in expected_table]
+
+
+def test_backends_build_the_same_index(graph, gfa_file):
+    from_memory = scorer.build_index(graph)
+    from_gfa = scorer.build_index(scorer.GfaGraph(gfa_file))
+    assert from_memory.keys() == from_gfa.keys()
+    for name in scorer.INDEX_ARRAYS:
+        assert np.array_equal(from_memory[name], from_gfa[name]), name
+
+
+def test_memory_graph_only_parses_wanted_paths(graph):
+    paths = dict(graph.paths(lambda name: name.startswith("homology_arm_")))
+    assert [name for name, steps in paths.items() if steps is not None] == \
+        ["homology_arm_0", "homology_arm_1", "homology_arm_2"]
+    nodes, reverse = paths["homology_arm_1"]
+    assert nodes.tolist() == [20, 19, 18, 38, 16, 15, 14, 13] and reverse.all()
+
+
+def test_graph_backend_is_abstract():
+    with pytest.raises(TypeError):
+        scorer.GraphBackend()
+
+    class NoPaths(scorer.GraphBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        NoPaths()
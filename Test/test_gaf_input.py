@@ -0,0 +1,117 @@
+import csv
+import gzip
+import io
+import struct
+import subprocess
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+import compare_coverage_read_info as scorer
+
+
+def test_rows_are_parsed_one_at_a_time(gaf_text):
+    def rows():
+        yield from gaf_text.encode().splitlines(True)[:2]
+        raise AssertionError("the parser read past the reads it was asked for")
+
+    reads = scorer.filter_gaf_rows(rows(), scorer.make_read_filter(0))
+    assert next(reads) == b">16>18"
+    assert next(reads) == b"<38<20"
+
+
+def test_small_batches_count_the_same(graph, gaf_file, expected_table, monkeypatch):
+    engine = scorer.CoverageEngine(graph=graph)
+    counts = engine.count(gaf_file)
+    # A batch of a few bytes of read paths holds at most one or two reads.
+    monkeypatch.setattr(scorer, "EDGE_BATCH_SIZE", 8)
+    assert np.array_equal(engine.count(gaf_file), counts)
+    assert engine.table(counts) == expected_table
+
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + struct.pack("<H", len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def tallies(table):
+    return {row[0]: (row[4], row[6]) for row in table}
+
+
+def test_ranges_start_and_end_on_lines(gaf_text, tmp_path):
+    gaf_file_name = tmp_path / "sample.gaf"
+    gaf_file_name.write_text(gaf_text)
+    data = gaf_file_name.read_bytes()
+    for parts in (1, 2, 4, 100):
+        ranges = scorer.split_gaf(str(gaf_file_name), parts)
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+        assert all(data[end - 1:end] == b"\n" for _, end in ranges)
+        assert len(ranges) <= parts
+    empty_file_name = tmp_path / "empty.gaf"
+    empty_file_name.write_text("")
+    assert scorer.split_gaf(str(empty_file_name), 4) == []
+
+
+def test_workers_match_serial(graph, gaf_text, tmp_path):
+    # Enough lines for several byte ranges per worker.
+    gaf_file_name = tmp_path / "sample.gaf"
+    gaf_file_name.write_text(gaf_text * 50)
+    engine = scorer.CoverageEngine(graph=graph)
+    serial = scorer.count_sample(str(gaf_file_name), engine.index, workers=1)
+    assert len(scorer.split_gaf(str(gaf_file_name), 3)) == 3
+    for workers in (2, 3):
+        parallel = scorer.count_sample(str(gaf_file_name), engine.index, workers=workers)
+        assert np.array_equal(parallel, serial)
+    assert tallies(engine.table(serial)) == {"homology_arm_1-": (150, 100), "homology_arm_2+": (50, 150)}
+
+
+def test_compressed_input(graph, gaf_text, expected_table, tmp_path):
+    data = gaf_text.encode()
+    gzip_file_name = tmp_path / "sample.gaf.gz"
+    gzip_file_name.write_bytes(gzip.compress(data))
+    # BGZF blocks that split lines in the middle, and the empty block that ends a BGZF file.
+    bgzf_file_name = tmp_path / "sample.gaf.bgz"
+    bgzf_file_name.write_bytes(b"".join(bgzf_block(data[i:i + 100]) for i in range(0, len(data), 100)) +
+                               bgzf_block(b""))
+    engine = scorer.CoverageEngine(graph=graph)
+    assert scorer.bgzf_block_size(bgzf_file_name.read_bytes()[:18]) is not None
+    assert engine.score(str(gzip_file_name)) == expected_table
+    assert engine.score(str(bgzf_file_name)) == expected_table
+    assert scorer.CoverageEngine(graph=graph, threads=3).score(str(bgzf_file_name)) == expected_table
+
+
+def test_compression_is_detected_from_the_contents(graph, gaf_text, expected_table, tmp_path):
+    # A gzip file without a .gz extension is still decompressed, and it is read by one process whatever the workers.
+    gaf_file_name = tmp_path / "sample.gaf"
+    gaf_file_name.write_bytes(gzip.compress(gaf_text.encode()))
+    assert scorer.is_gzipped(str(gaf_file_name))
+    assert scorer.CoverageEngine(graph=graph, workers=2).score(str(gaf_file_name)) == expected_table
+
+
+def test_broken_bgzf_is_an_error(graph, gaf_text, tmp_path):
+    gaf_file_name = tmp_path / "sample.gaf.bgz"
+    gaf_file_name.write_bytes(bgzf_block(gaf_text.encode()) + gzip.compress(b"not a BGZF block"))
+    with pytest.raises(ValueError):
+        scorer.CoverageEngine(graph=graph).score(str(gaf_file_name))
+
+
+def test_stdin_input(graph, gaf_text, expected_table, monkeypatch):
+    engine = scorer.CoverageEngine(graph=graph)
+    for data in (gaf_text.encode(), gzip.compress(gaf_text.encode())):
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(data)))
+        assert engine.score(scorer.STDIN_PATH) == expected_table
+
+
+def test_command_line_reads_a_pipe(gfa_file, gaf_text, expected_table, tmp_path):
+    out_file_name = tmp_path / "stdin.tsv"
+    subprocess.run([sys.executable, scorer.__file__, "--og-gfa-path", gfa_file, "--gaf-path", "-", "--out-path",
+                    str(out_file_name), "--no-index-cache"], input=gaf_text.encode(), check=True,
+                   stdout=subprocess.DEVNULL)
+    with open(out_file_name) as tsv_file:
+        rows = list(csv.reader(tsv_file, delimiter="\t"))[1:]
+    assert rows == [[str(value) for value in row] for row in expected_table]
@@ -0,0 +1,56 @@
+import numpy as np
+
+import compare_coverage_read_info as scorer
+
+
+def steps_of(graph, wanted=lambda name: True):
+    return {name: None if steps is None else (steps[0].tolist(), steps[1].tolist())
+            for name, steps in graph.paths(wanted)}
+
+
+def test_gfa_steps():
+    nodes, reverse = scorer.gfa_steps(b"1+,22-,333+", False)
+    assert nodes.tolist() == [1, 22, 333] and reverse.tolist() == [False, True, False]
+    nodes, reverse = scorer.gfa_steps(b">1<22>333", True)
+    assert nodes.tolist() == [1, 22, 333] and reverse.tolist() == [False, True, False]
+
+
+def test_gfa_graph_reads_the_paths_in_order(graph, gfa_file):
+    names = [name for name, _ in graph.paths(lambda name: False)]
+    gfa_paths = steps_of(scorer.GfaGraph(gfa_file), lambda name: name.startswith("ref_"))
+    assert list(gfa_paths) == names
+    assert [name for name, steps in gfa_paths.items() if steps is not None] == \
+        ["ref_homology_arm_0", "ref_homology_arm_1", "ref_homology_arm_2"]
+    assert gfa_paths["ref_homology_arm_1"] == steps_of(graph)["ref_homology_arm_1"]
+
+
+def test_line_endings_and_overlaps(graph, gfa_writer, tmp_path):
+    # The steps of a P line without the overlaps column end the line, so they must not keep its newline.
+    paths = steps_of(graph)
+    for newline in ("\n", "\r\n"):
+        gfa_file_name = gfa_writer(tmp_path / "graph.gfa", graph.path_list, newline)
+        assert steps_of(scorer.GfaGraph(gfa_file_name)) == paths
+        with open(gfa_file_name, newline="") as gfa_file:
+            lines = [line.replace("\t*" + newline, newline) for line in gfa_file]
+        with open(gfa_file_name, "w", newline="") as gfa_file:
+            gfa_file.writelines(lines)
+        assert steps_of(scorer.GfaGraph(gfa_file_name)) == paths
+
+
+def test_walks(graph, tmp_path):
+    lines = ["H\tVN:Z:1.1"]
+    for name, nodes, reverse in graph.path_list:
+        steps = "".join(f"{'<' if rev else '>'}{node}" for node, rev in zip(nodes, reverse))
+        lines.append(f"W\tyeast\t0\t{name}\t0\t{len(nodes)}\t{steps}")
+    gfa_file_name = tmp_path / "walks.gfa"
+    gfa_file_name.write_text("\n".join(lines) + "\n")
+    walks = steps_of(scorer.GfaGraph(str(gfa_file_name)))
+    assert walks == {f"yeast#0#{name}": steps for name, steps in steps_of(graph).items()}
+
+
+def test_open_graph_picks_the_backend(graph, gfa_file):
+    # The backend is chosen by the option the graph is given with.
+    assert isinstance(scorer.open_graph(gfa_file_name=gfa_file), scorer.GfaGraph)
+    assert isinstance(scorer.open_graph(og_file_name="graph.og"), scorer.OdgiGraph)
+    index = scorer.build_index(scorer.open_graph(gfa_file_name=gfa_file))
+    assert np.array_equal(index["edges"], scorer.build_index(graph)["edges"])
@@ -0,0 +1,64 @@
+import glob
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+import compare_coverage_read_info as scorer
+
+
+def index_dirs(gfa_file):
+    return glob.glob(f"{gfa_file}.v*.idx")
+
+
+def test_index_is_saved_and_memory_mapped(gfa_file, gaf_file, expected_table):
+    built = scorer.CoverageEngine(og_gfa_path=gfa_file)
+    assert built.score(gaf_file) == expected_table
+    assert len(index_dirs(gfa_file)) == 1
+    cached = scorer.CoverageEngine(og_gfa_path=gfa_file)
+    assert isinstance(cached.index["edges"], np.memmap)
+    for name in scorer.INDEX_ARRAYS:
+        assert np.array_equal(cached.index[name], built.index[name]), name
+    assert cached.score(gaf_file) == expected_table
+
+
+def test_changed_graph_gets_its_own_index(gfa_file, gfa_writer, tmp_path):
+    scorer.CoverageEngine(og_gfa_path=gfa_file).load()
+    gfa_writer(gfa_file, scorer.synthetic_graph(2).path_list)
+    scorer.CoverageEngine(og_gfa_path=gfa_file).load()
+    assert len(index_dirs(gfa_file)) == 2
+
+
+def test_incomplete_index_is_not_used(gfa_file):
+    engine = scorer.CoverageEngine(og_gfa_path=gfa_file).load()
+    directory = index_dirs(gfa_file)[0]
+    os.remove(os.path.join(directory, "edges.npy"))
+    assert scorer.load_index(directory) is None
+    assert scorer.load_index(directory + ".missing") is None
+    rebuilt = scorer.CoverageEngine(og_gfa_path=gfa_file, index_cache=False)
+    assert np.array_equal(rebuilt.index["edges"], engine.index["edges"])
+
+
+def test_unwritable_directory_falls_back_to_memory(gfa_file, gaf_file, expected_table, monkeypatch, capsys):
+    # Running as root ignores the permissions of a read-only directory, so the failure is simulated.
+    def read_only(*args, **kwargs):
+        raise PermissionError("Read-only file system")
+
+    monkeypatch.setattr(tempfile, "mkdtemp", read_only)
+    assert scorer.CoverageEngine(og_gfa_path=gfa_file).score(gaf_file) == expected_table
+    assert "Index not cached" in capsys.readouterr().err
+    assert index_dirs(gfa_file) == []
+
+
+def test_graph_is_hashed_when_the_index_is_needed(tmp_path):
+    engine = scorer.CoverageEngine(og_gfa_path=str(tmp_path / "missing.gfa"))
+    with pytest.raises(FileNotFoundError):
+        engine.load()
+
+
+def test_graph_hash_is_remembered(gfa_file, monkeypatch):
+    index_name = scorer.CoverageEngine(og_gfa_path=gfa_file).index_name
+    assert os.path.exists(os.path.join(os.path.dirname(gfa_file), scorer.GRAPH_CACHE_DIR, scorer.HASHES_FILE))
+    monkeypatch.setattr(scorer, "hash_file", None)
+    assert scorer.CoverageEngine(og_gfa_path=gfa_file).index_name == index_name
@@ -0,0 +1,44 @@
+import csv
+
+import numpy as np
+
+import compare_coverage_read_info as scorer
+
+
+def read_tsv(tsv_file_name):
+    with open(tsv_file_name) as tsv_file:
+        return list(csv.reader(tsv_file, delimiter="\t"))
+
+
+def test_matrix_matches_the_tables(graph, gaf_text, tmp_path):
+    # The second sample only has the reads with a MAPQ of 60, so its homology_arm_2+ has no homology arm reads.
+    gaf_file_names = [str(tmp_path / "a.gaf"), str(tmp_path / "b.gaf")]
+    (tmp_path / "a.gaf").write_text(gaf_text)
+    mapq_60 = [line for line in gaf_text.splitlines(True) if line.split("\t")[11] == "60"]
+    (tmp_path / "b.gaf").write_text("".join(mapq_60))
+    engine = scorer.CoverageEngine(graph=graph)
+    matrix_file_name = str(tmp_path / "matrix.tsv")
+    scorer.write_outputs(engine, gaf_file_names, engine.filter(), out_dir=str(tmp_path / "tables"),
+                         matrix_path=matrix_file_name, verbose=False)
+    header, *rows = read_tsv(matrix_file_name)
+    assert header == ["Homology arm", "a homology arm coverage", "a reference coverage",
+                      "a fractional homology arm coverage", "b homology arm coverage", "b reference coverage",
+                      "b fractional homology arm coverage"]
+    # The arms are in graph order, not sorted by coverage.
+    assert [row[0] for row in rows] == ["homology_arm_1-", "homology_arm_2+"]
+    for column, sample in ((1, "a"), (4, "b")):
+        for arm, hom_cov, ref_cov, *_ in read_tsv(tmp_path / "tables" / f"{sample}.tsv")[1:]:
+            row = next(row for row in rows if row[0] == arm)
+            hom, ref, frac = map(float, row[column:column + 3])
+            assert (hom, ref) == (float(hom_cov), float(ref_cov))
+            assert frac == (hom / (hom + ref) if hom else 0.0)
+    assert [float(value) for value in rows[1][4:]] == [0.0, 0.5, 0.0]
+
+
+def test_matrix_is_the_same_in_chunks(graph, gaf_file, monkeypatch):
+    engine = scorer.CoverageEngine(graph=graph)
+    counts = np.stack([engine.count(gaf_file)] * 5, axis=1)
+    arms, rows = scorer.matrix_rows(counts, engine.index, engine.path_ids)
+    monkeypatch.setattr(scorer, "MATRIX_CHUNK_SIZE", 2)
+    assert scorer.matrix_rows(counts, engine.index, engine.path_ids) == (arms, rows)
+    assert rows[0][:3] == rows[0][3:6] == [1.5, 1.0, 0.6]
@@ -0,0 +1,44 @@
+import subprocess
+
+import compare_coverage_read_info as scorer
+from build_graph import STEPS
+
+
+def test_path_classes():
+    assert scorer.path_class("homology_arm_1") == scorer.PATH_CLASS_HOM
+    assert scorer.path_class("ref_homology_arm_1") == scorer.PATH_CLASS_REF
+    assert scorer.path_class("plasmid_CB39") == scorer.PATH_CLASS_PLASMID
+    assert scorer.path_class("chrI") == scorer.PATH_CLASS_CHROM
+    assert scorer.path_class("chrmt") == scorer.PATH_CLASS_CHROM
+
+
+def test_catalog_classifies_every_path(graph):
+    path_catalog = scorer.load_arm_paths(graph)[0]
+    classes = dict(zip(path_catalog["names"], path_catalog["classes"].tolist()))
+    assert classes["plasmid_1"] == scorer.PATH_CLASS_PLASMID
+    assert classes["chrS"] == scorer.PATH_CLASS_CHROM
+    assert classes["homology_arm_2"] == scorer.PATH_CLASS_HOM
+    assert classes["ref_homology_arm_2"] == scorer.PATH_CLASS_REF
+
+
+def test_exclude_plasmids(graph, gaf_file, expected_table):
+    # r9 steps on node 100, which is only on the plasmid
+    by_class = scorer.CoverageEngine(graph=graph, exclude_plasmids=True)
+    by_prefix = scorer.CoverageEngine(graph=graph, exclude_path_prefixes=["plasmid_"])
+    assert by_class.filter()["excluded_nodes"].tolist() == by_prefix.filter()["excluded_nodes"].tolist()
+    assert by_class.score(gaf_file) == by_prefix.score(gaf_file)
+    assert by_class.score(gaf_file)[0][4] == expected_table[0][4] - 1
+    assert scorer.CoverageEngine(graph=graph).score(gaf_file) == expected_table
+
+
+def test_graph_build_names_the_plasmids(tmp_path):
+    step = next(step for step in STEPS if step["name"] == "fasta")
+    (tmp_path / "ref.fa").write_text(">chrI\nACGT\n")
+    (tmp_path / "ODD126_ref_and_hom_arms.fa").write_text(">homology_arm_1\nACGT\n")
+    (tmp_path / "plasmid.fa").write_text(">CB39\nACGT\n")
+    for plasmid, names in (("plasmid.fa", ["chrI", "homology_arm_1", "plasmid_CB39"]),
+                           ("", ["chrI", "homology_arm_1"])):
+        subprocess.run(["bash", "-e", "-o", "pipefail", "-c", step["command"]], cwd=tmp_path, check=True,
+                       env={"PATH": "/usr/bin:/bin", "REFERENCE": "ref.fa", "PLASMID": plasmid})
+        records = [line[1:] for line in (tmp_path / "yeast+edits.fa").read_text().splitlines() if line[0] == ">"]
+        assert records == names
@@ -0,0 +1,82 @@
+import csv
+import glob
+import sys
+
+import pytest
+
+import compare_coverage_read_info as scorer
+
+
+def tallies(table):
+    return {row[0]: (row[4], row[6]) for row in table}
+
+
+def test_read_filters(graph, gaf_file):
+    def score(**thresholds):
+        exclude = thresholds.pop("exclude", ())
+        engine = scorer.CoverageEngine(graph=graph, read_filter=scorer.make_read_filter(**thresholds),
+                                       exclude_path_prefixes=exclude)
+        return tallies(engine.score(gaf_file))
+
+    assert score() == {"homology_arm_1-": (3, 2), "homology_arm_2+": (1, 3)}
+    # r4 has a MAPQ of 20, r5 of 40
+    assert score(min_mapq=0) == {"homology_arm_1-": (3, 2), "homology_arm_2+": (2, 3)}
+    assert score(min_mapq=50) == {"homology_arm_1-": (3, 2), "homology_arm_2+": (1, 1)}
+    # r6 has 55 matches in a block of 60, r7 40 matches in a block of 100
+    assert score(min_matches=50) == {"homology_arm_1-": (3, 2), "homology_arm_2+": (1, 2)}
+    assert score(min_block_length=80) == {"homology_arm_1-": (3, 2), "homology_arm_2+": (0, 3)}
+    # r1 has an id:f tag of 0.5, which is used instead of matches / block length, and r7 an identity of 0.4
+    assert score(min_identity=0.9) == {"homology_arm_1-": (2, 2), "homology_arm_2+": (1, 2)}
+    # r9 steps on node 100, which is only on the plasmid
+    assert score(exclude=["plasmid"]) == {"homology_arm_1-": (2, 2), "homology_arm_2+": (1, 3)}
+
+
+def test_excluded_nodes_are_cached(gfa_file, gaf_file, monkeypatch):
+    def cached():
+        return glob.glob(f"{gfa_file}.v*.idx/excluded.*.npy")
+
+    expected = scorer.CoverageEngine(og_gfa_path=gfa_file, exclude_path_prefixes=["plasmid"]).score(gaf_file)
+    assert len(cached()) == 1
+    with monkeypatch.context() as patch:
+        patch.setattr(scorer, "excluded_node_bitmap", None)
+        assert scorer.CoverageEngine(og_gfa_path=gfa_file, exclude_path_prefixes=["plasmid"]).score(gaf_file) == \
+            expected
+    # Other excluded paths get a bitmap of their own.
+    assert scorer.CoverageEngine(og_gfa_path=gfa_file, exclude_plasmids=True).score(gaf_file) == expected
+    assert len(cached()) == 2
+
+
+def test_sweep_matches_min_mapq(graph, gaf_file, tmp_path):
+    mapq_bins = (0, 30, 40, 60)
+    sweep_file_name = str(tmp_path / "sweep.tsv")
+    engine = scorer.CoverageEngine(graph=graph, read_filter=scorer.make_read_filter(0, mapq_bins=mapq_bins))
+    scorer.write_outputs(engine, [gaf_file], engine.filter(), mapq_sweep_path=sweep_file_name, verbose=False)
+    with open(sweep_file_name) as tsv_file:
+        rows = [row for row in csv.DictReader(tsv_file, delimiter="\t") if row["Strand"] == "both"]
+    for min_mapq in mapq_bins:
+        table = scorer.CoverageEngine(graph=graph, read_filter=scorer.make_read_filter(min_mapq)).score(gaf_file)
+        expected = {row[0]: (row[1], row[2]) for row in table}
+        swept = {row["Homology arm"]: (float(row["Homology arm coverage"]), float(row["Reference coverage"]))
+                 for row in rows if int(row["Minimum MAPQ"]) == min_mapq}
+        assert swept == expected
+
+
+def parse_args(monkeypatch, *options):
+    monkeypatch.setattr(sys, "argv", ["compare_coverage_read_info.py", "--og-gfa-path", "graph.gfa", "--gaf-path",
+                                      "sample.gaf"] + list(options))
+    return scorer.parse_args()
+
+
+def test_min_mapq_defaults_to_lowest_bin(monkeypatch):
+    assert parse_args(monkeypatch, "--mapq-sweep-path", "sweep.tsv", "--mapq-bins", "5", "30").min_mapq == 5
+    assert parse_args(monkeypatch, "--mapq-sweep-path", "sweep.tsv").min_mapq == scorer.MAPQ_SWEEP_BINS[0]
+    assert parse_args(monkeypatch, "--out-path", "sample.tsv", "--mapq-bins", "40", "60").min_mapq == 40
+    assert parse_args(monkeypatch, "--out-path", "sample.tsv").min_mapq == scorer.MIN_MAPQ
+
+
+def test_min_mapq_above_lowest_bin_is_refused(monkeypatch, capsys):
+    for output in (["--out-path", "sample.tsv"], ["--mapq-sweep-path", "sweep.tsv"], ["--serve", "scorer.sock"]):
+        with pytest.raises(SystemExit):
+            parse_args(monkeypatch, "--min-mapq", "50", "--mapq-bins", "40", "60", *output)
+        assert "--min-mapq is above the lowest of --mapq-bins" in capsys.readouterr().err
+    assert parse_args(monkeypatch, "--out-path", "sample.tsv", "--min-mapq", "30", "--mapq-bins", "40").min_mapq == 30
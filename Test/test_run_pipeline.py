@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import run_pipeline
+
+# vg map, faked: it writes the GAF in <sample>.reads for -f <sample>.fastq.gz, or fails if there is no such file.
+FAKE_VG = """#!/bin/bash
+while [ $# -gt 0 ]; do
+  [ "$1" = -f ] && fastq=$2
+  shift
+done
+reads=${fastq%.fastq.gz}.reads
+[ -f "$reads" ] || { echo "cannot map $fastq" >&2; exit 3; }
+cat "$reads"
+"""
+
+
+@pytest.fixture
+def plate(tmp_path, gfa_file, gaf_text):
+    vg = tmp_path / "vg"
+    vg.write_text(FAKE_VG)
+    vg.chmod(0o755)
+    (tmp_path / "names.txt").write_text("good\nbad\n")
+    (tmp_path / "good.reads").write_text(gaf_text)
+    return tmp_path
+
+
+def run(directory, *options):
+    command = [sys.executable, run_pipeline.__file__, "--names", "names.txt", "--xg", "graph.xg", "--gcsa",
+               "graph.gcsa", "--og-gfa-path", "graph.gfa", "--vg", "./vg", "--cores", "2", "--memory", "1",
+               "--map-jobs", "1", "--score-jobs", "1", "--threads", "1"] + list(options)
+    returncode = subprocess.run(command, cwd=directory, capture_output=True).returncode
+    with open(directory / "pipeline_report.tsv") as tsv_file:
+        return returncode, {row["sample"]: row for row in csv.DictReader(tsv_file, delimiter="\t")}
+
+
+def read_table(tsv_file_name):
+    with open(tsv_file_name) as tsv_file:
+        return list(csv.reader(tsv_file, delimiter="\t"))[1:]
+
+
+@pytest.mark.parametrize("options", [[], ["--stream"]])
+def test_samples_are_mapped_and_scored(plate, expected_table, options):
+    returncode, report = run(plate, *options)
+    assert returncode == 1
+    assert report["good"]["status"] == "ok"
+    assert (report["bad"]["status"], report["bad"]["error"]) == ("map failed", "exit code 3: cannot map bad.fastq.gz")
+    assert read_table(plate / "good.tsv") == [[str(value) for value in row] for row in expected_table]
+    # Only the logs of the sample that failed are kept (with --stream, also those of the scorer it ran with), and no
+    # GAF file is left.
+    logs = ["bad.map.log", "bad.score.log", "bad.score.out"] if options else ["bad.map.log"]
+    assert sorted(name for name in os.listdir(plate) if name.endswith((".log", ".out", ".gaf", ".part"))) == logs
+
+
+def test_failed_scoring_keeps_the_gaf_and_logs(plate):
+    (plate / "graph.gfa").unlink()
+    returncode, report = run(plate)
+    assert returncode == 1
+    assert report["good"]["status"] == "score failed" and report["good"]["error"].startswith("exit code 1")
+    assert all((plate / name).exists() for name in ("good.gaf", "good.score.log", "good.score.out"))
+    assert not (plate / "good.map.log").exists()
+
+
+def test_missing_vg(plate):
+    returncode, report = run(plate, "--vg", "./missing-vg")
+    assert returncode == 1
+    assert all(row["status"] == "map failed" and row["error"].startswith("FileNotFoundError")
+               for row in report.values())
+
+
+def test_keep_gaf(plate, gaf_text):
+    run(plate, "--keep-gaf", "--gaf-dir", "gafs")
+    assert (plate / "gafs" / "good.gaf").read_text() == gaf_text
+
+
+def test_plan_fills_the_machine():
+    gb = 1 << 30
+    # A 64-core box with plenty of memory runs jobs of MAP_THREADS_PER_JOB threads on the cores not kept for scoring.
+    plan = run_pipeline.plan_jobs(64, 256 * gb, gb, 96)
+    assert (plan["score_jobs"], plan["map_jobs"], plan["map_threads"], plan["index_threads"]) == (4, 7, 8, 64)
+    # A laptop runs a single job on every core but the one of the scorer.
+    plan = run_pipeline.plan_jobs(8, 16 * gb, gb, 96)
+    assert (plan["score_jobs"], plan["map_jobs"], plan["map_threads"]) == (1, 1, 7)
+    # With little memory, fewer jobs fit, and the spare cores only become threads as long as their memory fits too.
+    plan = run_pipeline.plan_jobs(64, 8 * gb, 2 * gb, 96)
+    assert (plan["map_jobs"], plan["map_threads"]) == (1, 20)
+    assert plan["job_memory_bytes"] <= 8 * gb
+    # There are never more jobs than samples, and values that are given are kept.
+    assert run_pipeline.plan_jobs(64, 256 * gb, gb, 2)["map_jobs"] == 2
+    plan = run_pipeline.plan_jobs(64, 256 * gb, gb, 96, score_jobs=2, map_jobs=3, map_threads=5)
+    assert (plan["score_jobs"], plan["map_jobs"], plan["map_threads"]) == (2, 3, 5)
+
+
+def test_plan_is_recorded_and_reused(plate):
+    def plan(*options):
+        subprocess.run([sys.executable, run_pipeline.__file__, "--names", "names.txt", "--vg", "./vg", "--og-gfa-path",
+                        "graph.gfa", "--memory", "1"] + list(options), cwd=plate, capture_output=True)
+        with open(plate / options[-1]) as plan_file:
+            return json.load(plan_file)
+
+    first = plan("--cores", "4", "--plan-path", "first.json")
+    assert (first["cores"], first["sample_order"]) == (4, ["good", "bad"])
+    assert (first["score_jobs"], first["map_jobs"], first["map_threads"]) == (1, 1, 3)
+    # The packing of the earlier run is kept on a larger machine.
+    second = plan("--cores", "64", "--from-plan", "first.json", "--plan-path", "second.json")
+    assert second["cores"] == 64
+    assert (second["score_jobs"], second["map_jobs"], second["map_threads"]) == (1, 1, 3)
+    output = subprocess.run([sys.executable, run_pipeline.__file__, "--index-threads", "--cores", "12"],
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "12"
@@ -0,0 +1,78 @@
+import csv
+import socket
+import threading
+
+import pytest
+
+import compare_coverage_read_info as scorer
+
+
+@pytest.fixture
+def server(graph, tmp_path):
+    socket_path = str(tmp_path / "scorer.sock")
+    with scorer.ScoringServer(socket_path, scorer.CoverageEngine(graph=graph).load()) as scoring_server:
+        thread = threading.Thread(target=scoring_server.serve_forever, daemon=True)
+        thread.start()
+        yield socket_path
+        scoring_server.shutdown()
+        thread.join()
+
+
+def read_table(tsv_file_name):
+    with open(tsv_file_name) as tsv_file:
+        return list(csv.reader(tsv_file, delimiter="\t"))[1:]
+
+
+def test_jobs_match_the_engine(server, graph, gaf_file, expected_table, tmp_path):
+    response = scorer.submit_job(server, {"gaf_path": [gaf_file], "out_path": str(tmp_path / "default.tsv")})
+    assert (response["status"], response["samples"]) == ("ok", ["sample"]) and response["wait_seconds"] >= 0
+    assert read_table(tmp_path / "default.tsv") == [[str(value) for value in row] for row in expected_table]
+    # Options that are left out get the defaults of the command line, the others are those of the job only.
+    response = scorer.submit_job(server, {"gaf_path": [gaf_file], "out_path": str(tmp_path / "filtered.tsv"),
+                                          "min_mapq": 0, "exclude_plasmids": True})
+    assert response["status"] == "ok"
+    engine = scorer.CoverageEngine(graph=graph, read_filter=scorer.make_read_filter(0), exclude_plasmids=True)
+    assert read_table(tmp_path / "filtered.tsv") == [[str(value) for value in row] for row in engine.score(gaf_file)]
+
+
+def test_failed_jobs_and_stats(server, gaf_file, tmp_path):
+    response = scorer.submit_job(server, {"gaf_path": [str(tmp_path / "missing.gaf")],
+                                          "out_path": str(tmp_path / "missing.tsv")})
+    assert response["status"] == "error" and "FileNotFoundError" in response["error"]
+    response = scorer.submit_job(server, {"gaf_path": [gaf_file], "out_path": str(tmp_path / "sample.tsv"),
+                                          "min_mapq": 50, "mapq_bins": [40, 60]})
+    assert response["status"] == "error" and "--min-mapq is above" in response["error"]
+    assert scorer.submit_job(server, {"gaf_path": [gaf_file], "out_path": str(tmp_path / "sample.tsv")})["status"] == \
+        "ok"
+    stats = scorer.submit_job(server, {"stats": True})
+    assert (stats["submitted"], stats["completed"], stats["failed"], stats["running"], stats["queued"]) == \
+        (3, 1, 2, 0, 0)
+    assert stats["max_run_seconds"] >= stats["mean_run_seconds"] >= 0
+
+
+def test_invalid_request(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(server)
+        connection.sendall(b"not json\n")
+        with connection.makefile("rb") as response:
+            assert response.readline().startswith(b'{"status": "error", "error": "invalid request')
+
+
+def test_server_cannot_fork_workers(graph, tmp_path):
+    with pytest.raises(ValueError):
+        scorer.ScoringServer(str(tmp_path / "scorer.sock"), scorer.CoverageEngine(graph=graph, workers=2))
+
+
+def test_remove_stale_socket(server, tmp_path):
+    scorer.remove_stale_socket(str(tmp_path / "missing.sock"))
+    (tmp_path / "file.sock").write_text("")
+    with pytest.raises(FileExistsError, match="is not a socket"):
+        scorer.remove_stale_socket(str(tmp_path / "file.sock"))
+    with pytest.raises(FileExistsError, match="already running"):
+        scorer.remove_stale_socket(server)
+    # The socket of a server that stopped without removing it.
+    stale_path = str(tmp_path / "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(stale_path)
+    scorer.remove_stale_socket(stale_path)
+    assert not (tmp_path / "stale.sock").exists()
@@ -0,0 +1,86 @@
+import csv
+import glob
+
+import pytest
+
+import compare_coverage_read_info as scorer
+
+# The synthetic graph with 4 edits, split into a shard with the first two arms and one with the last two. Both have
+# the whole chromosome. The diagnostic edges of its arms are (16, 18) and (20, 50) for homology_arm_1, (28, 30) and
+# (32, 51) for homology_arm_2, (40, 42) and (44, 52) for homology_arm_3, and (28, 29) and (29, 30) for the reference
+# of homology_arm_2.
+SHARD_ARMS = {"first": ("0", "1"), "second": ("2", "3")}
+
+
+def row(name, path, score, tags=""):
+    return f"{name}\t150\t0\t150\t+\t{path}\t100\t0\t100\t{score}\t100\t60\tAS:i:{score}{tags}\n"
+
+
+# Every read is mapped against both shards. r1 aligns best to the second shard, r2 to the first one, and r4 equally
+# well to both, so it goes to the first shard, where it is on no arm. The mates of r3 each align to another shard.
+SHARD_GAFS = {
+    "first": [row("r1", ">5>6", 50), row("r2", ">16>18", 95), row("r3", ">16>17>18", 95, "\tfp:Z:r3"),
+              row("r3", "*", 0, "\tfn:Z:r3"), row("r4", ">28>29>30", 95)],
+    "second": [row("r1", ">28>30", 95), row("r5", ">32>51", 95), row("r2", ">16>17>18", 90),
+               row("r3", ">40>42", 95, "\tfn:Z:r3"), row("r3", "*", 0, "\tfp:Z:r3"), row("r4", ">28>29>30", 95)],
+}
+
+
+@pytest.fixture
+def shards(gfa_writer, tmp_path):
+    paths = scorer.synthetic_graph(4).path_list
+    shard_list = []
+    for shard, arms in SHARD_ARMS.items():
+        directory = tmp_path / "shards" / shard
+        directory.mkdir(parents=True)
+        gfa_writer(directory / "graph.gfa", [paths[0]] + [path for path in paths[1:] if path[0].endswith(arms)])
+        (tmp_path / f"sample.{shard}.gaf").write_text("".join(SHARD_GAFS[shard]))
+        shard_list.append((shard, str(directory)))
+    scorer.write_shards(tmp_path / "shards" / "shards.tsv", shard_list)
+    return scorer.read_shards(tmp_path / "shards" / "shards.tsv")
+
+
+def read_rows(tsv_file_name):
+    with open(tsv_file_name) as tsv_file:
+        return list(csv.reader(tsv_file, delimiter="\t"))[1:]
+
+
+def test_shard_list_round_trip(shards, tmp_path):
+    assert shards == [(shard, str(tmp_path / "shards" / shard)) for shard in SHARD_ARMS]
+    with open(tmp_path / "shards" / "shards.tsv") as tsv_file:
+        assert tsv_file.read() == "shard\tdirectory\nfirst\tfirst\nsecond\tsecond\n"
+
+
+def test_only_the_first_shard_skips_its_first_arm(shards, tmp_path):
+    first, second = (scorer.CoverageEngine(og_gfa_path=f"{directory}/graph.gfa", skip_first_arm=shard == "first")
+                     for shard, directory in shards)
+    assert [table_row[0] for table_row in first.score(str(tmp_path / "sample.first.gaf"))] == ["homology_arm_1-"]
+    # homology_arm_2 is the first arm of the second shard, and both of its diagnostic edges are still found.
+    table = second.score(str(tmp_path / "sample.second.gaf"))
+    assert [table_row[0] for table_row in table] == ["homology_arm_2+", "homology_arm_3-"]
+    assert table[0] == ["homology_arm_2+", 1.0, 1.0, 2, 2, 2, 2]
+    # Whether the first arm is left out is part of the key of the cached index.
+    assert [path.endswith(".all.idx") for path in glob.glob(f"{shards[1][1]}/graph.gfa.v*.idx")] == [True]
+    assert [path.endswith(".all.idx") for path in glob.glob(f"{shards[0][1]}/graph.gfa.v*.idx")] == [False]
+
+
+def test_reads_go_to_their_best_shard(shards, tmp_path):
+    engines = [scorer.CoverageEngine(og_gfa_path=f"{directory}/graph.gfa", skip_first_arm=False).load()
+               for _, directory in shards]
+    interesting = [scorer.arm_node_bitmap(engine.index) for engine in engines]
+    gafs = [str(tmp_path / f"sample.{shard}.gaf") for shard in SHARD_ARMS]
+    # The mates of r3 are kept apart, and r4 goes to the first shard, although it is only on an arm of the second one.
+    assert scorer.best_shard_reads(gafs, interesting) == [{b"r2", b"r3/2", b"r4"}, {b"r1", b"r5", b"r3/1"}]
+
+
+def test_shard_outputs(shards, tmp_path):
+    gaf = str(tmp_path / f"sample.{scorer.SHARD_FIELD}.gaf")
+    scorer.write_shard_outputs(shards, [gaf], og_gfa_file_name="graph.gfa", out_path=str(tmp_path / "sample.tsv"),
+                               matrix_path=str(tmp_path / "matrix.tsv"), verbose=False)
+    assert read_rows(tmp_path / "sample.tsv") == [
+        ["homology_arm_2+", "1.0", "0.0", "2", "2", "2", "0"],
+        ["homology_arm_1-", "0.5", "1.0", "2", "1", "2", "2"],
+        ["homology_arm_3-", "0.5", "0.0", "2", "1", "2", "0"],
+    ]
+    assert [matrix_row[0] for matrix_row in read_rows(tmp_path / "matrix.tsv")] == \
+        ["homology_arm_1-", "homology_arm_2+", "homology_arm_3-"]
@@ -0,0 +1,370 @@
+import argparse
+import collections
+import concurrent.futures
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+from compare_coverage_read_info import GRAPH_CACHE_DIR, FileHashes, write_shards
+from run_pipeline import machine_cores
+
+# The name of the shard for the homology arms that do not align to any reference sequence.
+UNPLACED_SHARD = "unplaced"
+# Bump this to rebuild every step, e.g. when the way the keys are computed changes.
+CACHE_VERSION = 1
+# The steps of the graph build, in order. Each step runs its bash command in the working directory, with the
+# parameters (CSV, REFERENCE, PLASMID, THREADS) in the environment, and writes its outputs there. A step is only run
+# again when its command, the contents of its inputs or the tools it calls change; otherwise its outputs are linked
+# from the cache. THREADS does not change the outputs, so it is not part of the key.
+STEPS = [
+    # Extract the homology arms as FASTA. The names for the homology arms are in column 1 of the design library, the
+    # corresponding reference sequence is in column BA (the 53rd column), and the homology arm edit sequence is in
+    # column 54. The arms and the reference over the range of the arms are combined into one FASTA file.
+    {"name": "arms", "inputs": ["$CSV"], "tools": ["awk", "tr"],
+     "outputs": ["ODD126_homology_arms.fa", "ref_subpaths.fa", "ODD126_ref_and_hom_arms.fa"],
+     "command": """awk -F',' '{print ">homology_arm_"$1; print $54;}' "$CSV" | tr -d \\- > ODD126_homology_arms.fa
+awk -F',' '{print ">ref_homology_arm_"$1; print $53;}' "$CSV" | tr -d \\- > ref_subpaths.fa
+cat ref_subpaths.fa ODD126_homology_arms.fa > ODD126_ref_and_hom_arms.fa"""},
+    # Map the homology arms against the reference.
+    {"name": "paf", "inputs": ["$REFERENCE", "ODD126_ref_and_hom_arms.fa"], "tools": ["minimap2"],
+     "outputs": ["ODD126_ref_and_hom_arms.paf"],
+     "command": """minimap2 -k 19 -w 1 -cx sr "$REFERENCE" ODD126_ref_and_hom_arms.fa >ODD126_ref_and_hom_arms.paf"""},
+    # Combine the inputs to seqwish in a single file (and add the plasmid sequences, if there are any). The plasmid
+    # sequences are renamed plasmid_<name>, so the scorer can tell their paths from the chromosomes.
+    {"name": "fasta", "inputs": ["$REFERENCE", "ODD126_ref_and_hom_arms.fa", "$PLASMID"], "tools": ["sed"],
+     "outputs": ["yeast+edits.fa"],
+     "command": """cat "$REFERENCE" ODD126_ref_and_hom_arms.fa >yeast+edits.fa
+[ -z "$PLASMID" ] || sed 's/^>/>plasmid_/' "$PLASMID" >>yeast+edits.fa"""},
+    # Induce the variation graph.
+    {"name": "seqwish", "inputs": ["yeast+edits.fa", "ODD126_ref_and_hom_arms.paf"], "tools": ["seqwish"],
+     "outputs": ["yeast+edits.gfa"],
+     "command": """seqwish -g yeast+edits.gfa -s yeast+edits.fa -p ODD126_ref_and_hom_arms.paf -P"""},
+    # Sort and "chop" the graph so nodes are <256bp long (needed for vg map).
+    {"name": "odgi", "inputs": ["yeast+edits.gfa"], "tools": ["odgi"],
+     "outputs": ["yeast+edits.og", "yeast+edits.og.gfa"],
+     "command": """odgi build -g yeast+edits.gfa -o - | odgi sort -i - -p sYYgs -o - | odgi chop -i - -o - -c 256 |
+  tee yeast+edits.og | odgi view -i - -g >yeast+edits.og.gfa"""},
+    # Import the graph into xg format (efficient static graph model).
+    {"name": "xg", "inputs": ["yeast+edits.og.gfa"], "tools": ["vg"],
+     "outputs": ["yeast+edits.og.gfa.xg"],
+     "command": """vg convert -x yeast+edits.og.gfa >yeast+edits.og.gfa.xg"""},
+    # Index the graph.
+    {"name": "gcsa", "inputs": ["yeast+edits.og.gfa.xg"], "tools": ["vg"],
+     "outputs": ["yeast+edits.og.gfa.gcsa", "yeast+edits.og.gfa.gcsa.lcp"],
+     "command": """vg index -p -g yeast+edits.og.gfa.gcsa -t "$THREADS" yeast+edits.og.gfa.xg"""},
+]
+# With --shards, the steps up to here are run once for the whole genome, and the rest for every shard.
+SHARED_STEPS = 2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build the graph and its indexes (the first part of find_coverage.sh). Every step is cached under "
+                    "a hash of its command and inputs, so only the steps whose inputs changed are run again.")
+    parser.add_argument("--design-csv", default="DesignLibraryDetails_ODD126.withEditWindow.csv")
+    parser.add_argument("--reference", default="ref_and_mt.fna",
+                        help="The reference genome with the mtDNA sequence added.")
+    parser.add_argument("--plasmid", default="ODD126_augmented_CB39.fasta",
+                        help="FASTA file with the plasmid sequences. The graph is built without them if it is missing.")
+    parser.add_argument("--threads", type=int, default=machine_cores(), help="Number of threads of vg index.")
+    parser.add_argument("--cache-dir", default=GRAPH_CACHE_DIR,
+                        help="Directory that keeps the outputs of every step. It can be deleted at any time.")
+    parser.add_argument("--force", action="store_true", help="Run every step, even if its outputs are cached.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print which steps would be run.")
+    parser.add_argument("--shards", metavar="SHARDS_TSV", required=False,
+                        help="Build one graph per reference sequence (chromosome) instead of one for the whole genome, "
+                             "each with the homology arms that the PAF places on it, in shards/<sequence>/, and list "
+                             "them in this TSV for run_pipeline.py and compare_coverage_read_info.py.")
+    parser.add_argument("--shard-jobs", type=int, required=False,
+                        help="Number of shards that are built at the same time (by default, one per thread, up to "
+                             "the number of shards). The threads of vg index are shared between them.")
+    return parser.parse_args()
+
+
+def step_inputs(step, params):
+    """
+    This function returns the input files of a step, with the parameters filled in. An empty parameter (a missing
+    plasmid FASTA) is left out.
+    :param step:
+    :param params: dictionary {parameter: value}
+    :return: list of file names
+    """
+    inputs = [string.Template(name).substitute(params) for name in step["inputs"]]
+    return [name for name in inputs if name]
+
+
+def tool_stamp(tool):
+    """
+    This function identifies the installed version of a tool by the path, size and modification time of its binary, so
+    updating a tool (e.g. with conda) invalidates the steps that use it.
+    :param tool:
+    :return: list
+    """
+    path = shutil.which(tool)
+    if path is None:
+        return [tool, None]
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def step_key(step, params, file_hash):
+    """
+    This function returns the key of a step: a hash of its command, the contents of its inputs and its tools.
+    :param step:
+    :param params: dictionary {parameter: value}
+    :param file_hash: FileHashes
+    :return: hex string
+    """
+    key = {"version": CACHE_VERSION, "name": step["name"], "command": step["command"],
+           "inputs": [file_hash(name) for name in step_inputs(step, params)],
+           "tools": [tool_stamp(tool) for tool in step["tools"]]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def link_file(source, destination):
+    """
+    This function puts a hard link to source at destination (or a copy, if the two are on different file systems).
+    :param source:
+    :param destination:
+    """
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def run_step(step, params, entry, workdir=".", replace=False):
+    """
+    This function runs the command of a step and moves its outputs into the cache entry. The old outputs are removed
+    first, so the command never writes into a file that is linked from the cache, and the cached outputs are made
+    read-only, so nothing else writes into them through their links either.
+    :param step:
+    :param params: dictionary {parameter: value}
+    :param entry: directory of the cache entry of the step
+    :param workdir: directory the command runs in
+    :param replace: replace the cache entry if it exists (with --force), instead of keeping it
+    """
+    outputs = [os.path.join(workdir, name) for name in step["outputs"]]
+    for output in outputs:
+        if os.path.lexists(output):
+            os.remove(output)
+    result = subprocess.run(["bash", "-e", "-o", "pipefail", "-c", step["command"]], env=dict(os.environ, **params),
+                            cwd=workdir)
+    missing = [output for output in outputs if not os.path.exists(output)]
+    if result.returncode != 0 or missing:
+        for output in outputs:
+            if os.path.exists(output):
+                os.remove(output)
+        sys.exit(f"Step {step['name']} in {workdir} failed (exit code {result.returncode})"
+                 + (f", missing {', '.join(missing)}" if missing else "") + ".")
+    partial = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix=".tmp")
+    for name, output in zip(step["outputs"], outputs):
+        shutil.move(output, os.path.join(partial, name))
+        os.chmod(os.path.join(partial, name), os.stat(os.path.join(partial, name)).st_mode & 0o7555)
+    old = None
+    if replace and os.path.isdir(entry):
+        # A directory can only be renamed over an empty one, so the old entry is moved aside first.
+        old = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix=".old")
+        os.replace(entry, old)
+    try:
+        os.replace(partial, entry)
+    except OSError:
+        # The same step (with the same inputs) was just cached by another shard.
+        shutil.rmtree(partial)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def build(steps, params, cache_dir, force=False, dry_run=False, workdir=".", file_hash=None, label=""):
+    """
+    This function runs the steps whose key is not in the cache, and links the outputs of every step from the cache into
+    the working directory.
+    :param steps: list of steps, in order
+    :param params: dictionary {parameter: value}
+    :param cache_dir:
+    :param force: run every step
+    :param dry_run: only print which steps would be run
+    :param workdir: directory the steps run in, and their inputs and outputs are in
+    :param file_hash: FileHashes shared with other builds, which the caller saves (or None to use and save its own)
+    :param label: printed in front of the name of every step
+    :return: list of the names of the steps that were (or would be) run
+    """
+    os.makedirs(os.path.join(cache_dir, "steps"), exist_ok=True)
+    hashes = file_hash or FileHashes(cache_dir)
+    produced = {}
+    # Dry run: the files a cached step would link, which may not be in the working directory yet.
+    cached = {}
+    ran = []
+    for step in steps:
+        produced.update((name, step["name"]) for name in step["outputs"])
+        # Without running, the inputs that an earlier step would make are not known yet.
+        after = sorted(set(produced[name] for name in step_inputs(step, params) if produced.get(name) in ran))
+        if dry_run and after:
+            print(f"{label}{step['name']}: run (after {', '.join(after)})")
+            ran.append(step["name"])
+            continue
+        key = step_key(step, params, lambda name: hashes(cached.get(name, os.path.join(workdir, name))))
+        entry = os.path.join(cache_dir, "steps", key[:32])
+        if force or not os.path.isdir(entry):
+            print(f"{label}{step['name']}: run", flush=True)
+            if not dry_run:
+                start = time.time()
+                run_step(step, params, entry, workdir, force)
+                print(f"{label}{step['name']}: done in {time.time() - start:.1f}s", flush=True)
+            ran.append(step["name"])
+        else:
+            print(f"{label}{step['name']}: cached", flush=True)
+            if dry_run:
+                cached.update((name, os.path.join(entry, name)) for name in step["outputs"])
+        if not dry_run:
+            for name in step["outputs"]:
+                link_file(os.path.join(entry, name), os.path.join(workdir, name))
+        if file_hash is None:
+            hashes.save()
+    return ran
+
+
+def fasta_records(fasta_file_name):
+    """
+    This function streams the records of a FASTA file.
+    :param fasta_file_name:
+    :return: generator of (name, list of lines, including the header)
+    """
+    name, lines = None, []
+    with open(fasta_file_name) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                if name is not None:
+                    yield name, lines
+                name, lines = line[1:].split()[0], []
+            lines.append(line)
+    if name is not None:
+        yield name, lines
+
+
+def place_arms(paf_file_name):
+    """
+    This function places every homology arm on the reference sequence (chromosome) it aligns to best, by the number of
+    matching bases (PAF column 10). An arm and its reference arm ("ref_homology_arm_...") are kept together, on the
+    sequence of the reference arm if it aligns, otherwise on that of the homology arm.
+    :param paf_file_name:
+    :return: dictionary {arm name (without "ref_"): sequence name}
+    """
+    best = {}
+    with open(paf_file_name) as paf:
+        for line in paf:
+            fields = line.split("\t")
+            query, target, matches = fields[0], fields[5], int(fields[9])
+            if query not in best or matches > best[query][0]:
+                best[query] = (matches, target)
+    placement = {name: target for name, (_, target) in best.items() if not name.startswith("ref_")}
+    placement.update((name[len("ref_"):], target) for name, (_, target) in best.items() if name.startswith("ref_"))
+    return placement
+
+
+def write_if_changed(file_name, lines):
+    """
+    This function writes lines to a file, but leaves the file alone if it already has exactly these lines, so the
+    steps that read it stay cached without hashing it again.
+    :param file_name:
+    :param lines:
+    """
+    with open(file_name + ".tmp", "wt") as new_file:
+        new_file.writelines(lines)
+    if os.path.exists(file_name) and filecmp.cmp(file_name, file_name + ".tmp", shallow=False):
+        os.remove(file_name + ".tmp")
+    else:
+        os.replace(file_name + ".tmp", file_name)
+
+
+def split_shards(reference, arms_fasta, paf_file_name, shards_dir):
+    """
+    This function splits the inputs of the graph into one directory per reference sequence: the sequence itself, the
+    homology arms and reference arms placed on it, and their alignments to it. Arms that do not align anywhere go into
+    the "unplaced" shard, without a reference sequence. Each directory has the same file names as the whole-genome
+    build, so the same steps build its graph.
+    :param reference: FASTA file of the reference genome
+    :param arms_fasta: FASTA file of the homology arms and reference arms
+    :param paf_file_name: alignments of the arms to the reference
+    :param shards_dir:
+    :return: list of (shard name, directory)
+    """
+    placement = place_arms(paf_file_name)
+    arms = collections.defaultdict(list)
+    for name, lines in fasta_records(arms_fasta):
+        arm = name[len("ref_"):] if name.startswith("ref_") else name
+        arms[placement.get(arm, UNPLACED_SHARD)] += lines
+    alignments = collections.defaultdict(list)
+    with open(paf_file_name) as paf:
+        for line in paf:
+            fields = line.split("\t", 6)
+            arm = fields[0][len("ref_"):] if fields[0].startswith("ref_") else fields[0]
+            if placement.get(arm) == fields[5]:
+                alignments[fields[5]].append(line)
+    shards = []
+    sequences = list(fasta_records(reference)) + ([(UNPLACED_SHARD, [])] if UNPLACED_SHARD in arms else [])
+    for name, lines in sequences:
+        directory = os.path.join(shards_dir, name.replace(os.sep, "_"))
+        os.makedirs(directory, exist_ok=True)
+        write_if_changed(os.path.join(directory, "ref_and_mt.fna"), lines)
+        write_if_changed(os.path.join(directory, "ODD126_ref_and_hom_arms.fa"), arms[name])
+        write_if_changed(os.path.join(directory, "ODD126_ref_and_hom_arms.paf"), alignments[name])
+        shards.append((name, directory))
+    return shards
+
+
+def build_shards(params, cache_dir, shards_file_name, shard_jobs=None, force=False, dry_run=False):
+    """
+    This function builds one graph per reference sequence, several at the same time. The homology arms and their
+    alignments are made once for the whole genome; every later step is run per shard and cached like the whole-genome
+    build, so a shard is only rebuilt when its sequence or the arms placed on it change.
+    :param params: dictionary {parameter: value}
+    :param cache_dir:
+    :param shards_file_name: TSV listing the shards and their directories
+    :param shard_jobs: number of shards built at the same time, or None for one per thread
+    :param force: run every step
+    :param dry_run: only print which steps would be run
+    """
+    file_hash = FileHashes(cache_dir)
+    ran = build(STEPS[:SHARED_STEPS], params, cache_dir, force, dry_run, file_hash=file_hash)
+    if dry_run and ran:
+        print(f"shards: split after {', '.join(ran)}")
+        return
+    shards_dir = os.path.join(os.path.dirname(os.path.abspath(shards_file_name)), "shards")
+    shards = split_shards(params["REFERENCE"], "ODD126_ref_and_hom_arms.fa", "ODD126_ref_and_hom_arms.paf", shards_dir)
+    jobs = min(len(shards), shard_jobs or int(params["THREADS"]))
+    shard_params = dict(params, REFERENCE="ref_and_mt.fna", THREADS=str(max(1, int(params["THREADS"]) // jobs)),
+                        PLASMID=os.path.abspath(params["PLASMID"]) if params["PLASMID"] else "")
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        builds = [executor.submit(build, STEPS[SHARED_STEPS:], shard_params, os.path.abspath(cache_dir), force,
+                                  dry_run, directory, file_hash, f"{name}: ") for name, directory in shards]
+        try:
+            for shard_build in builds:
+                shard_build.result()
+        finally:
+            file_hash.save()
+    if not dry_run:
+        write_shards(shards_file_name, shards)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    params = {"CSV": args.design_csv, "REFERENCE": args.reference, "THREADS": str(args.threads),
+              "PLASMID": args.plasmid if os.path.exists(args.plasmid) else ""}
+    if not params["PLASMID"]:
+        print(f"{args.plasmid} not found, the graph is built without plasmid sequences.")
+    if args.shards is not None:
+        build_shards(params, args.cache_dir, args.shards, args.shard_jobs, args.force, args.dry_run)
+    else:
+        build(STEPS, params, args.cache_dir, args.force, args.dry_run)
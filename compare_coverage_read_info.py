@@ -1,203 +1,1055 @@
-import odgi
 import csv
+import abc
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
 
+# Bump this whenever the layout of the index sidecar changes, so that stale indexes are rebuilt instead of read.
+INDEX_VERSION = 6
+# The bash script names the homology arm paths "homology_arm_..." and their reference paths "ref_homology_arm_...",
+# and build_graph.py names the plasmid paths "plasmid_...". Paths are classified by these prefixes into a bitmask;
+# all other paths are chromosomes (or the mtDNA).
+PATH_CLASS_HOM = 1
+PATH_CLASS_REF = 2
+PATH_CLASS_CHROM = 4
+PATH_CLASS_PLASMID = 8
+PATH_CLASSES = {"hom": PATH_CLASS_HOM, "ref_h": PATH_CLASS_REF, "plasmid_": PATH_CLASS_PLASMID}
+# GAF columns (0-based) used when scoring reads, and the lowest mapping quality of a read that is counted by default.
+GAF_PATH_COLUMN = 5
+GAF_MATCHES_COLUMN = 9
+GAF_BLOCK_LENGTH_COLUMN = 10
+GAF_MAPQ_COLUMN = 11
+GAF_IDENTITY_TAG = b"\tid:f:"
+GAF_SCORE_TAG = b"\tAS:i:"
+GAF_NAME_COLUMN = 0
+# vg map tags the first mate of a read pair with the name of the next fragment, and the second one with that of the
+# previous fragment.
+GAF_NEXT_TAG = b"\tfn:Z:"
+GAF_PREVIOUS_TAG = b"\tfp:Z:"
+MIN_MAPQ = 30
+# The MAPQ bins of --mapq-sweep-path if --mapq-bins is not given. Each bin holds the reads with a MAPQ from its
+# lower bound up to the next one.
+MAPQ_SWEEP_BINS = (0, 1, 5, 10, 20, 30, 40, 50, 60)
+# Stratified counts keep the reads on the forward (">") and reverse ("<") strand apart, in this order.
+READ_STRANDS = ("+", "-")
+GAF_BUFFER_SIZE = 1 << 20
+# Edges are packed into one 64-bit integer per edge, which needs node IDs below 2^32. Reads are counted in batches
+# of about EDGE_BATCH_SIZE bytes of GAF path.
+EDGE_NODE_LIMIT = 1 << 32
+EDGE_BATCH_SIZE = 1 << 22
+# The multi-sample coverage matrix is computed for this many samples at a time.
+MATRIX_CHUNK_SIZE = 64
+GZIP_MAGIC = b"\x1f\x8b"
+# A GAF path of "-" means the GAF records are read from standard input, e.g. straight from vg map.
+STDIN_PATH = "-"
+# With --shards, every GAF file name has this field, which is replaced by the name of each shard.
+SHARD_FIELD = "{shard}"
+# The options of a scoring job that a client sends to the scoring server (see ScoringServer), and those of them that
+# are file names, which the client makes absolute.
+JOB_OPTIONS = ("gaf_path", "out_path", "out_dir", "matrix_path", "mapq_sweep_path", "min_mapq", "min_matches",
+               "min_block_length", "min_identity", "exclude_path_prefix", "exclude_plasmids", "mapq_bins")
+JOB_FILE_OPTIONS = ("out_path", "out_dir", "matrix_path", "mapq_sweep_path")
+# build_graph.py caches its steps in this directory, next to the graph it builds. The SHA-256 of files (such as the
+# graph, which names its index) are remembered there, in HASHES_FILE.
+GRAPH_CACHE_DIR = ".graph_cache"
+HASHES_FILE = "hashes.json"
+INDEX_ARRAYS = ("path_names", "path_classes", "hom_paths", "ref_paths", "interval_offsets", "interval_starts",
+                "interval_ends", "arm_starts", "arm_ends", "edge_offsets", "edges", "shared_edges", "incidence_edges",
+                "incidence_offsets", "incidence_paths", "incidence_counts")
 
-def parse_args():
+
+def make_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--og-path", required=True)
-    parser.add_argument("--gaf-path", required=True)
-    parser.add_argument("--out-path", required=True)
+    parser.add_argument("--og-path", required=False)
+    parser.add_argument("--og-gfa-path", required=False,
+                        help="Read the graph from its GFA (e.g. yeast+edits.og.gfa) instead of the .og file, "
+                             "without odgi.")
+    parser.add_argument("--gaf-path", nargs="+", default=[],
+                        help="One or more GAF files, plain or compressed with gzip or bgzip, or - to read GAF from "
+                             "standard input. They are all scored against a single load of the graph.")
+    parser.add_argument("--manifest", required=False,
+                        help="A text file with one GAF file per line, scored in addition to --gaf-path.")
+    parser.add_argument("--out-path", required=False, help="The TSV to write when a single GAF is scored.")
+    parser.add_argument("--out-dir", required=False, help="Write one <sample>.tsv per GAF to this directory.")
+    parser.add_argument("--matrix-path", required=False,
+                        help="Write the homology arm, reference and fractional coverage of every arm in every sample "
+                             "to a single arms x samples TSV.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that score GAF files at the same time.")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads that decompress a bgzip-compressed GAF file.")
     parser.add_argument("--info-path", required=False)
     parser.add_argument("--test-example", required=False)
-    return parser.parse_args()
+    parser.add_argument("--no-index-cache", action="store_true",
+                        help="Always walk the graph, and do not read or write the index next to the .og file.")
+    parser.add_argument("--min-mapq", type=int, required=False,
+                        help=f"Lowest mapping quality (GAF column 12) of a read that is counted (by default {MIN_MAPQ}, "
+                             f"or the lowest of --mapq-bins if they are given).")
+    parser.add_argument("--min-matches", type=int, default=0,
+                        help="Lowest number of residue matches (GAF column 10) of a read that is counted.")
+    parser.add_argument("--min-block-length", type=int, default=0,
+                        help="Lowest alignment block length (GAF column 11) of a read that is counted.")
+    parser.add_argument("--min-identity", type=float, default=0.0,
+                        help="Lowest identity (the id:f tag, or else matches / block length) of a read that is "
+                             "counted.")
+    parser.add_argument("--exclude-path-prefix", nargs="+", default=[],
+                        help="Skip reads that touch a node that is only on paths starting with one of these prefixes, "
+                             "e.g. the plasmid paths. The nodes are saved with the index.")
+    parser.add_argument("--exclude-plasmids", action="store_true",
+                        help="Skip reads that touch a node that is only on plasmid paths (named plasmid_... by "
+                             "build_graph.py). The nodes are saved with the index.")
+    parser.add_argument("--mapq-bins", type=int, nargs="+", required=False,
+                        help="Lower bounds of the MAPQ bins that the reads are counted in (by strand), in one pass "
+                             "over each GAF file. Reads below the lowest bound, or below --min-mapq, are skipped.")
+    parser.add_argument("--mapq-sweep-path", required=False,
+                        help="Write the coverage of every arm in every sample, for every MAPQ bin as threshold and "
+                             "for both strands together and apart, to a single TSV.")
+    parser.add_argument("--serve", metavar="SOCKET", required=False,
+                        help="Load the index once and score the jobs sent to this Unix domain socket, one at a time, "
+                             "until interrupted.")
+    parser.add_argument("--server", metavar="SOCKET", required=False,
+                        help="Send the GAF files and options to the scorer running with --serve on this socket, "
+                             "instead of scoring them here.")
+    parser.add_argument("--server-stats", action="store_true",
+                        help="Print the queue and latency statistics of the scorer on --server.")
+    parser.add_argument("--shards", metavar="SHARDS_TSV", required=False,
+                        help="Score the graphs of all the shards listed by build_graph.py --shards, and merge them "
+                             "into one table. --og-path or --og-gfa-path is then the file name inside each shard "
+                             "directory, and every GAF file name has {shard} in it, e.g. sample.{shard}.gaf. Every "
+                             "read is only counted in the shard it aligns best to.")
+    return parser
 
 
-args = parse_args()
-gr = odgi.graph()
-gr.load(args.og_path)
-path_names = []
-node_ids = []
-gr.for_each_path_handle(lambda p: path_names.append(gr.get_path_name(p)))
-gr.for_each_path_handle(lambda p: node_ids.append(p))
+def parse_args():
+    parser = make_parser()
+    parsed = parser.parse_args()
+    if parsed.server is None and (parsed.og_path is None) == (parsed.og_gfa_path is None):
+        parser.error("exactly one of --og-path and --og-gfa-path is needed")
+    if parsed.mapq_sweep_path is not None and parsed.mapq_bins is None:
+        parsed.mapq_bins = list(MAPQ_SWEEP_BINS)
+    if parsed.mapq_bins is not None and sorted(set(parsed.mapq_bins)) != parsed.mapq_bins:
+        parser.error("--mapq-bins must be increasing")
+    try:
+        parsed.min_mapq = default_min_mapq(parsed.min_mapq, parsed.mapq_bins)
+    except ValueError as error:
+        parser.error(str(error))
+    if parsed.serve is not None or parsed.server_stats:
+        if parsed.serve is None and parsed.server is None:
+            parser.error("--server-stats needs --server")
+        if parsed.serve is not None and parsed.workers > 1:
+            # The server runs its jobs in threads, and forking worker processes from them can deadlock.
+            parser.error("--workers cannot be used with --serve")
+        return parsed
+    if parsed.manifest is not None:
+        parsed.gaf_path += read_manifest(parsed.manifest)
+    if not parsed.gaf_path:
+        parser.error("at least one GAF file is needed (--gaf-path or --manifest)")
+    if all(path is None for path in (parsed.out_path, parsed.out_dir, parsed.matrix_path, parsed.mapq_sweep_path)):
+        parser.error("one of --out-path, --out-dir, --matrix-path or --mapq-sweep-path is needed")
+    if parsed.gaf_path.count(STDIN_PATH) > 1:
+        parser.error("standard input (-) can only be scored once")
+    if parsed.out_path is not None and len(parsed.gaf_path) > 1:
+        parser.error("--out-path can only be used with a single GAF file, use --out-dir for several")
+    if parsed.server is not None and STDIN_PATH in parsed.gaf_path:
+        parser.error("standard input (-) cannot be sent to --server")
+    if parsed.shards is not None:
+        if parsed.server is not None or parsed.mapq_sweep_path is not None:
+            parser.error("--shards cannot be used with --server or --mapq-sweep-path")
+        if not all(SHARD_FIELD in gaf for gaf in parsed.gaf_path):
+            parser.error(f"with --shards, every GAF file name needs {SHARD_FIELD}")
+    return parsed
 
 
-def step_str(step):
-    path_str = gr.get_path_name(gr.get_path_handle_of_step(step))
-    dir_str = "+" if not gr.get_is_reverse(gr.get_handle_of_step(step)) else "-"
-    return path_str + dir_str
+def default_min_mapq(min_mapq, mapq_bins):
+    """
+    This function returns the lowest MAPQ of a read that is counted: the one that is given, or else the lowest MAPQ
+    bin (so the reads of every bin, and every threshold of a sweep, are counted), or else MIN_MAPQ. A given MAPQ
+    above the lowest bin is refused, as the lower bins would then silently hold only some of their reads.
+    :param min_mapq: the lowest MAPQ that is given, or None
+    :param mapq_bins: lower bounds of the MAPQ bins, or None
+    :return: lowest MAPQ
+    """
+    if min_mapq is not None and mapq_bins is not None and min_mapq > mapq_bins[0]:
+        raise ValueError("--min-mapq is above the lowest of --mapq-bins, so the lower bins would not hold all of their "
+                         "reads")
+    if min_mapq is not None:
+        return min_mapq
+    if mapq_bins is not None:
+        return mapq_bins[0]
+    return MIN_MAPQ
 
 
-def show_steps(handle):
-    steps = []
-    gr.for_each_step_on_handle(handle, lambda step: steps.append(step))
-    all_path.append([
-        gr.get_id(handle), " ".join([step_str(s) for s in steps])
-    ])
+def read_manifest(manifest_file_name):
+    """
+    This function reads a manifest of GAF files, one per line. Empty lines are skipped.
+    :param manifest_file_name:
+    :return: list of GAF file names
+    """
+    with open(manifest_file_name) as manifest:
+        return [line.strip() for line in manifest if line.strip()]
 
 
-def read_gaf(gaf_file_name):
+def write_shards(shards_file_name, shards):
     """
-    This function takes a gaf file and returns a list of the nodes that reads in the
-    file were mapped to.
-    :param: gaf_file_name
-    :return: list of nodes
+    This function writes the list of shards that build_graph.py --shards made, with their directories relative to the
+    list itself.
+    :param shards_file_name:
+    :param shards: list of (shard name, directory)
+    """
+    base = os.path.dirname(os.path.abspath(shards_file_name))
+    with open(shards_file_name, "wt") as tsv_file:
+        tsv_writer = csv.writer(tsv_file, delimiter='\t', lineterminator='\n')
+        tsv_writer.writerow(["shard", "directory"])
+        for name, directory in shards:
+            tsv_writer.writerow([name, os.path.relpath(directory, base)])
+
+
+def read_shards(shards_file_name):
+    """
+    This function reads the list of shards written by write_shards. The directories are relative to the list.
+    :param shards_file_name:
+    :return: list of (shard name, directory)
+    """
+    base = os.path.dirname(os.path.abspath(shards_file_name))
+    with open(shards_file_name) as tsv_file:
+        return [(row["shard"], os.path.join(base, row["directory"]))
+                for row in csv.DictReader(tsv_file, delimiter='\t')]
+
+
+def sample_name(gaf_file_name):
+    """
+    This function returns the name of a sample, which is the name of its GAF file without the directory and the
+    .gaf (or .gaf.gz, .gaf.bgz) extension.
+    :param gaf_file_name:
+    :return: sample name
+    """
+    if gaf_file_name == STDIN_PATH:
+        return "stdin"
+    name = os.path.basename(gaf_file_name.replace("." + SHARD_FIELD, "").replace(SHARD_FIELD, ""))
+    for extension in (".gz", ".bgz", ".gaf"):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+
+def load_odgi_graph(og_file_name):
+    """
+    This function loads an odgi graph. odgi is only imported here, so the scorer also runs without it (from the GFA
+    of the graph) on machines where the odgi binding cannot be loaded.
+    :param og_file_name:
+    :return: loaded odgi graph
+    """
+    import odgi
+    graph = odgi.graph()
+    graph.load(og_file_name)
+    return graph
+
+
+class GraphBackend(abc.ABC):
+    """
+    The paths of a graph, in the form the scorer needs them. Every backend yields all the paths of its graph in the
+    order of the graph (the rank of a path is its ID in the path catalog), and parses the steps of only those paths
+    that are asked for. Nothing else about the graph is used, so the index can be built from an odgi graph, from its
+    GFA, or from paths held in memory.
     """
-    nodes = []
-    for row in open(gaf_file_name):
-        row = row.split()
-        mapq = int(row[11])
-        if mapq < 30:
+
+    @abc.abstractmethod
+    def paths(self, wanted):
+        """
+        :param wanted: function (path name) -> True if the steps of the path are needed
+        :return: generator of (path name, steps), where steps is (array of node IDs, boolean array that is True for
+        the steps on the reverse strand), or None for the paths that are not wanted
+        """
+
+
+class OdgiGraph(GraphBackend):
+    """
+    A graph in odgi format (.og). The graph is only loaded the first time its paths are needed.
+    """
+
+    def __init__(self, og_file_name):
+        self.og_file_name = og_file_name
+        self.graph = None
+
+    def paths(self, wanted):
+        if self.graph is None:
+            self.graph = load_odgi_graph(self.og_file_name)
+        graph = self.graph
+        path_handles = []
+        graph.for_each_path_handle(path_handles.append)
+        for path_handle in path_handles:
+            name = graph.get_path_name(path_handle)
+            if not wanted(name):
+                yield name, None
+                continue
+            handles = []
+            graph.for_each_step_in_path(path_handle, lambda step: handles.append(graph.get_handle_of_step(step)))
+            nodes = np.array([graph.get_id(handle) for handle in handles], dtype=np.int64)
+            reverse = np.array([graph.get_is_reverse(handle) for handle in handles], dtype=bool)
+            yield name, (nodes, reverse)
+
+
+class GfaGraph(GraphBackend):
+    """
+    A graph in GFA format, such as the yeast+edits.og.gfa that odgi view writes. The file is streamed every time the
+    paths are needed, and odgi is not used.
+    """
+
+    def __init__(self, gfa_file_name):
+        self.gfa_file_name = gfa_file_name
+
+    def paths(self, wanted):
+        for name, steps, is_walk in gfa_paths(self.gfa_file_name):
+            yield name, gfa_steps(steps, is_walk) if wanted(name) else None
+
+
+class MemoryGraph(GraphBackend):
+    """
+    A graph that is only a list of paths held in memory, e.g. from synthetic_graph, to test and benchmark the scorer
+    without building a real graph.
+    """
+
+    def __init__(self, paths):
+        """
+        :param paths: list of (path name, node IDs, True for the steps on the reverse strand)
+        """
+        self.path_list = paths
+
+    def paths(self, wanted):
+        for name, nodes, reverse in self.path_list:
+            if wanted(name):
+                yield name, (np.asarray(nodes, dtype=np.int64), np.asarray(reverse, dtype=bool))
+            else:
+                yield name, None
+
+
+def open_graph(og_file_name=None, gfa_file_name=None):
+    """
+    This function opens a graph with the backend that fits the file it is given.
+    :param og_file_name: graph in odgi format
+    :param gfa_file_name: graph in GFA format
+    :return: graph backend
+    """
+    if gfa_file_name is not None:
+        return GfaGraph(gfa_file_name)
+    return OdgiGraph(og_file_name)
+
+
+def synthetic_graph(arms, arm_nodes=8, spacing=4):
+    """
+    This function creates a graph in memory with a single chromosome and the given number of edits. Every reference
+    homology arm follows arm_nodes nodes of the chromosome, and its homology arm follows the same nodes, except for its
+    middle node, which is replaced by a node of its own (the edit). Every other arm is on the reverse strand. The arms
+    are spacing nodes apart.
+    :param arms: number of edits
+    :param arm_nodes: number of nodes of each arm
+    :param spacing: number of chromosome nodes between two arms
+    :return: MemoryGraph
+    """
+    chromosome_nodes = arms * (arm_nodes + spacing)
+    paths = [("chrS", np.arange(1, chromosome_nodes + 1), np.zeros(chromosome_nodes, dtype=bool))]
+    for arm in range(arms):
+        ref_nodes = np.arange(arm_nodes) + arm * (arm_nodes + spacing) + 1
+        hom_nodes = ref_nodes.copy()
+        hom_nodes[arm_nodes // 2] = chromosome_nodes + arm + 1
+        reverse = np.full(arm_nodes, arm % 2 == 1)
+        if arm % 2:
+            ref_nodes, hom_nodes = ref_nodes[::-1], hom_nodes[::-1]
+        paths.append((f"ref_homology_arm_{arm}", ref_nodes, reverse))
+        paths.append((f"homology_arm_{arm}", hom_nodes, reverse))
+    return MemoryGraph(paths)
+
+
+def path_class(name):
+    """
+    This function classifies a path by the prefix of its name (see PATH_CLASSES) into a small integer bitmask. Paths
+    without any of these prefixes (the chromosomes and the mtDNA) have class PATH_CLASS_CHROM.
+    :param name: path name
+    :return: class
+    """
+    classes = 0
+    for prefix, prefix_class in PATH_CLASSES.items():
+        if name.startswith(prefix):
+            classes |= prefix_class
+    return classes or PATH_CLASS_CHROM
+
+
+def make_path_catalog(names):
+    """
+    This function interns the name of every path in the graph to an integer ID (its rank in the graph), once, and
+    classifies the paths with path_class.
+    Everywhere else, a path on a given strand is referred to by its oriented ID, 2 * ID (+ 1 for the "-" strand).
+    :param names: list of path names, in the order of the graph
+    :return: catalog {"names": list of names, "ids": {name: ID}, "classes": array of classes}
+    """
+    classes = np.array([path_class(name) for name in names], dtype=np.uint8)
+    return {"names": names, "ids": {name: i for i, name in enumerate(names)}, "classes": classes}
+
+
+def oriented_name(names, oriented_id):
+    """
+    This function returns the name of an oriented path: its name followed by "+" or "-".
+    :param names: list of path names from the catalog
+    :param oriented_id:
+    :return: path name
+    """
+    return names[oriented_id >> 1] + ("-" if oriented_id & 1 else "+")
+
+
+def reference_of(path_catalog, hom_id):
+    """
+    This function returns the oriented ID of the reference path that belongs to a homology arm (on the same strand).
+    :param path_catalog: from make_path_catalog
+    :param hom_id: oriented ID of the homology arm
+    :return: oriented ID of the reference path, or None if the graph has no such path
+    """
+    ref_id = path_catalog["ids"].get("ref_" + path_catalog["names"][hom_id >> 1])
+    return None if ref_id is None else 2 * ref_id + (hom_id & 1)
+
+
+def load_arm_paths(graph):
+    """
+    This function walks the steps of the homology arm and reference homology arm paths only, so the rest of the
+    genome (chromosomes, mtDNA, plasmids) is never visited. Each path is keyed by its oriented ID, i.e. the path and
+    the orientation of the step ("+" or "-"), and maps to an integer array of the nodes it steps on.
+    The homology arms are returned in the order the nodes of the graph would find them (by their lowest node ID), as
+    create_shared_edges and make_coverage_table depend on that order.
+    :param graph: graph backend
+    :return: path catalog, list of homology arm paths, list of reference paths, dictionary {path: array of nodes}
+    """
+    names = []
+    walks = {}
+    first_seen = {}
+    arm_classes = PATH_CLASS_HOM | PATH_CLASS_REF
+    for rank, (name, steps) in enumerate(graph.paths(lambda name: path_class(name) & arm_classes)):
+        names.append(name)
+        if steps is None:
             continue
-        nodes.append(row[5])
-    return nodes
+        nodes, reverse = steps
+        for strand in (False, True):
+            step_ranks = np.flatnonzero(reverse == strand)
+            if len(step_ranks):
+                path = 2 * rank + strand
+                walks[path] = nodes[step_ranks]
+                lowest = np.argmin(walks[path])
+                first_seen[path] = (int(walks[path][lowest]), rank, int(step_ranks[lowest]))
+    path_catalog = make_path_catalog(names)
+    return (path_catalog,) + order_arm_paths(path_catalog, first_seen) + (walks,)
+
+
+def order_arm_paths(path_catalog, first_seen):
+    """
+    This function puts the homology arm and reference homology arm paths in the order the nodes of the graph would
+    find them: by their lowest node, then by the rank of the path and the step on which the path first reaches it.
+    :param path_catalog:
+    :param first_seen: dictionary {path: (lowest node, rank of the path, rank of the step)}
+    :return: list of homology arm paths, list of reference paths
+    """
+    ordered = sorted(first_seen, key=first_seen.get)
+    h_arms = [path for path in ordered if path_catalog["classes"][path >> 1] & PATH_CLASS_HOM]
+    ref_paths = [path for path in ordered if path_catalog["classes"][path >> 1] & PATH_CLASS_REF]
+    return h_arms, ref_paths
+
+
+def gfa_paths(gfa_file_name):
+    """
+    This function streams the paths (P lines) and walks (W lines) of a GFA file, such as the yeast+edits.og.gfa that
+    odgi view writes, in the order of the file, which is the order of the paths in the graph. The steps are not
+    parsed here, and all other lines (including the S lines with the sequences) are skipped without being split.
+    Walks are named sample#haplotype#sequence.
+    :param gfa_file_name:
+    :return: generator of (path name, steps as bytes, True for a walk)
+    """
+    with open(gfa_file_name, "rb", buffering=GAF_BUFFER_SIZE) as gfa:
+        for line in gfa:
+            if line.startswith(b"P\t"):
+                # Without the overlaps column, the newline would otherwise be left at the end of the steps.
+                fields = line.rstrip(b"\r\n").split(b"\t", 3)
+                yield fields[1].decode(), fields[2], False
+            elif line.startswith(b"W\t"):
+                fields = line.rstrip(b"\r\n").split(b"\t", 7)
+                yield "#".join(field.decode() for field in fields[1:4]), fields[6], True
+
+
+def gfa_steps(steps, is_walk):
+    """
+    This function parses the steps of a GFA path ("1+,2-,3+") or walk (">1<2>3") into the nodes and their
+    orientation.
+    :param steps: steps as bytes
+    :param is_walk: True for the steps of a W line
+    :return: array of node IDs, boolean array that is True for the steps on the reverse strand
+    """
+    if is_walk:
+        nodes = steps.replace(b"<", b">")[1:].split(b">")
+        orientations = steps.translate(None, b"0123456789")
+        reverse = b"<"
+    else:
+        nodes = steps.replace(b"+", b"").replace(b"-", b"").split(b",")
+        orientations = steps.translate(None, b"0123456789,")
+        reverse = b"-"
+    return np.array(nodes, dtype=np.int64), np.frombuffer(orientations, dtype=np.uint8) == ord(reverse)
+
+
+def excluded_node_bitmap(graph, prefixes, classes=0):
+    """
+    This function creates a bitmap of the nodes that are only on paths of the given classes (see path_class), e.g.
+    PATH_CLASS_PLASMID, or whose name starts with one of the prefixes. Nodes that the excluded paths share with any
+    other path (such as the homology arms on a plasmid) are not in the bitmap. The paths of the graph are read twice:
+    once for the nodes of the excluded paths, and once to drop the ones that any other path steps on.
+    :param graph: graph backend
+    :param prefixes: list of path name prefixes
+    :param classes: bitmask of path classes
+    :return: bitmap, as an array of bytes
+    """
+    def is_excluded(name):
+        return name.startswith(tuple(prefixes)) or bool(path_class(name) & classes)
+
+    excluded = set()
+    for name, steps in graph.paths(is_excluded):
+        if steps is not None:
+            excluded.update(steps[0].tolist())
+    if excluded:
+        for name, steps in graph.paths(lambda name: not is_excluded(name)):
+            if steps is not None:
+                excluded.difference_update(steps[0].tolist())
+    return node_bitmap(excluded)
+
+
+def node_bitmap(nodes):
+    """
+    This function creates a bitmap with a bit set for every given node.
+    :param nodes: collection of node IDs
+    :return: bitmap, as an array of bytes
+    """
+    if not nodes:
+        return np.zeros(0, dtype=np.uint8)
+    flags = np.zeros(max(nodes) + 1, dtype=bool)
+    flags[list(nodes)] = True
+    return np.packbits(flags)
+
+
+def make_read_filter(min_mapq=MIN_MAPQ, min_matches=0, min_block_length=0, min_identity=0.0, excluded_nodes=None,
+                     mapq_bins=None, read_keys=None):
+    """
+    This function collects the thresholds that a read has to pass to be counted, and how the reads that pass are
+    counted. The defaults only keep reads with a MAPQ of at least MIN_MAPQ, and count them all together.
+    :param min_mapq: lowest mapping quality
+    :param min_matches: lowest number of residue matches
+    :param min_block_length: lowest alignment block length
+    :param min_identity: lowest identity
+    :param excluded_nodes: bitmap from excluded_node_bitmap, or None
+    :param mapq_bins: increasing lower bounds of MAPQ bins to count the reads in (by strand), or None
+    :param read_keys: set of the read_key of the only reads to count, or None to count reads of any name
+    :return: read filter
+    """
+    return {"min_mapq": min_mapq, "min_matches": min_matches, "min_block_length": min_block_length,
+            "min_identity": min_identity, "excluded_nodes": excluded_nodes,
+            "mapq_bins": None if mapq_bins is None else tuple(mapq_bins), "read_keys": read_keys}
+
+
+def read_key(row, columns):
+    """
+    This function returns what tells a read apart from the others in a GAF file: its name, and for paired-end reads
+    also which mate it is (as both mates have the same name).
+    :param row: line of a gaf file, as bytes
+    :param columns: the row split up to (at least) the name column
+    :return: key, as bytes
+    """
+    if GAF_NEXT_TAG in row:
+        return columns[GAF_NAME_COLUMN] + b"/1"
+    if GAF_PREVIOUS_TAG in row:
+        return columns[GAF_NAME_COLUMN] + b"/2"
+    return columns[GAF_NAME_COLUMN]
+
+
+def read_identity(row, columns):
+    """
+    This function returns the identity of a read, from its id:f tag, or else as residue matches / block length.
+    :param row: line of a gaf file, as bytes
+    :param columns: the row split up to (at least) the block length column
+    :return: identity
+    """
+    tag = row.find(GAF_IDENTITY_TAG)
+    if tag != -1:
+        return float(row[tag + len(GAF_IDENTITY_TAG):].split(None, 1)[0])
+    block_length = int(columns[GAF_BLOCK_LENGTH_COLUMN])
+    return int(columns[GAF_MATCHES_COLUMN]) / block_length if block_length else 0.0
+
+
+def compile_read_filter(read_filter):
+    """
+    This function turns the column thresholds of a read filter into a list of checks on a split GAF row, leaving out
+    the ones that keep every read, and works out how far a row has to be split for them.
+    :param read_filter: from make_read_filter
+    :return: number of splits, list of functions (row, columns) -> bool
+    """
+    checks = []
+    min_mapq = read_filter["min_mapq"]
+    min_matches = read_filter["min_matches"]
+    min_block_length = read_filter["min_block_length"]
+    min_identity = read_filter["min_identity"]
+    if min_matches > 0:
+        checks.append(lambda row, columns: int(columns[GAF_MATCHES_COLUMN]) >= min_matches)
+    if min_block_length > 0:
+        checks.append(lambda row, columns: int(columns[GAF_BLOCK_LENGTH_COLUMN]) >= min_block_length)
+    if min_identity > 0:
+        checks.append(lambda row, columns: read_identity(row, columns) >= min_identity)
+    read_keys = read_filter["read_keys"]
+    if read_keys is not None:
+        checks.append(lambda row, columns: read_key(row, columns) in read_keys)
+    if min_mapq > 0:
+        checks.insert(0, lambda row, columns: int(columns[GAF_MAPQ_COLUMN]) >= min_mapq)
+    if min_mapq > 0 or read_filter["mapq_bins"] is not None:
+        return GAF_MAPQ_COLUMN + 1, checks
+    if checks:
+        return GAF_BLOCK_LENGTH_COLUMN + 1, checks
+    return GAF_PATH_COLUMN + 1, checks
 
 
-def make_paths(path):
+def filter_gaf_rows(rows, read_filter=None):
     """
-    This function separates the names of the paths.
-    In the input, the names are in one string, separated by spaces.
-    :param: path
-    :return: list of paths
+    This function takes the lines of a gaf file and yields, one read at a time, the nodes that the read was mapped
+    to (the path column, as bytes), if the read passes the read filter. Each line is only split as far as the last
+    column that the filter needs (the MAPQ column, column 12, by default), so the rest of the line is never
+    tokenized and nothing is kept in memory between reads. If the filter has MAPQ bins, the MAPQ of each read is
+    yielded with its nodes.
+    :param rows: lines of a gaf file, as bytes
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: generator of nodes, or of (MAPQ, nodes)
     """
-    my_list = []
-    for i in path:
-        my_list.append([i[0], i[1].split(" ")])
-    return my_list
+    read_filter = read_filter or make_read_filter()
+    splits, checks = compile_read_filter(read_filter)
+    if read_filter["mapq_bins"] is not None:
+        for row in rows:
+            columns = row.split(None, splits)
+            if all(check(row, columns) for check in checks):
+                yield int(columns[GAF_MAPQ_COLUMN]), columns[GAF_PATH_COLUMN]
+        return
+    if len(checks) == 1:
+        check = checks[0]
+        for row in rows:
+            columns = row.split(None, splits)
+            if check(row, columns):
+                yield columns[GAF_PATH_COLUMN]
+        return
+    for row in rows:
+        columns = row.split(None, splits)
+        if all(check(row, columns) for check in checks):
+            yield columns[GAF_PATH_COLUMN]
 
 
-def separate_paths(paths):
+class PrefixedReader(io.RawIOBase):
     """
-    This function returns all the path names in a uniform format. This is necessary because
-    some names are in a list with more than 1 element.
-    :param paths:
-    :return:
+    A binary stream that first returns bytes that were already read from another stream, and then the rest of that
+    stream. This is used to look at the first bytes of standard input (to detect compression) without losing them.
     """
-    sep_path_names = []
-    for x in paths:
-        if len(x[1]) > 1:
-            for y in x[1]:
-                if y not in sep_path_names:
-                    sep_path_names.append(y)
+
+    def __init__(self, prefix, stream):
+        super().__init__()
+        self.prefix = prefix
+        self.stream = stream
+        self.name = getattr(stream, "name", "<stdin>")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.prefix[:len(buffer)] if self.prefix else self.stream.read1(len(buffer))
+        self.prefix = self.prefix[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_gaf(gaf_file_name):
+    """
+    This function opens a gaf file in binary with a large buffer. If the name is "-", standard input is used instead,
+    and its first bytes are read ahead so that peeking at the header works the same as for a file.
+    :param gaf_file_name:
+    :return: binary file object
+    """
+    if gaf_file_name == STDIN_PATH:
+        header = sys.stdin.buffer.read(18)
+        return io.BufferedReader(PrefixedReader(header, sys.stdin.buffer), GAF_BUFFER_SIZE)
+    return open(gaf_file_name, "rb", buffering=GAF_BUFFER_SIZE)
+
+
+def is_gzipped(gaf_file_name):
+    """
+    This function checks whether a file is gzip (or bgzip) compressed, by its first two bytes.
+    :param gaf_file_name:
+    :return: True if the file is compressed
+    """
+    with open(gaf_file_name, "rb") as gaf:
+        return gaf.read(2) == GZIP_MAGIC
+
+
+def bgzf_block_size(header):
+    """
+    This function reads the size of a BGZF block from the "BC" field in the extra field of its gzip header. Plain
+    gzip files do not have this field.
+    :param header: the first 18 bytes of the file
+    :return: total size of the block in bytes, or None if this is not a BGZF block
+    """
+    if len(header) < 18 or header[:2] != GZIP_MAGIC or not header[3] & 4 or header[12:14] != b"BC":
+        return None
+    return struct.unpack("<H", header[16:18])[0] + 1
+
+
+def read_bgzf_blocks(gaf):
+    """
+    This function yields the raw deflate data of every block of a BGZF file, without decompressing it.
+    :param gaf: BGZF file opened in binary
+    :return: generator of compressed blocks
+    """
+    while True:
+        header = gaf.read(18)
+        if not header:
+            return
+        block_size = bgzf_block_size(header)
+        if block_size is None:
+            raise ValueError(f"{gaf.name} is not a valid BGZF file")
+        extra_size = struct.unpack("<H", header[10:12])[0]
+        block = header + gaf.read(block_size - len(header))
+        # The deflate data sits between the header (12 bytes plus the extra field) and the CRC32 and size (8 bytes).
+        yield block[12 + extra_size:-8]
+
+
+def read_bgzf(gaf, threads):
+    """
+    This function decompresses a BGZF file with a pool of threads and yields the decompressed blocks in order.
+    The blocks are independent deflate streams, and zlib releases the GIL while it decompresses them, so the threads
+    really run in parallel. Only a few blocks per thread are in flight at a time.
+    :param gaf: BGZF file opened in binary
+    :param threads: number of threads
+    :return: generator of decompressed data
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for block in read_bgzf_blocks(gaf):
+            pending.append(pool.submit(zlib.decompress, block, -15))
+            if len(pending) >= 4 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def split_lines(chunks):
+    """
+    This function turns decompressed chunks of a file into lines. Lines that are split between chunks are joined.
+    :param chunks: iterable of bytes
+    :return: generator of lines
+    """
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def gaf_rows(gaf_file_name, threads=1):
+    """
+    This function yields the lines of a gaf file, which can be plain text, gzip or bgzip compressed (the compression
+    is detected from the file contents, not the extension), or standard input if the name is "-". The lines are
+    yielded as they are read, so reads from a pipe are counted while the mapper is still writing them. BGZF files are
+    decompressed by several threads.
+    :param gaf_file_name:
+    :param threads: number of threads that decompress BGZF files
+    :return: generator of lines
+    """
+    with open_gaf(gaf_file_name) as gaf:
+        header = gaf.peek(18)[:18]
+        if header[:2] != GZIP_MAGIC:
+            yield from gaf
+        elif bgzf_block_size(header) is not None:
+            yield from split_lines(read_bgzf(gaf, threads))
         else:
-            if x[1][0] not in sep_path_names:
-                sep_path_names.append(x[1][0])
-    return sep_path_names
-
-
-def get_path_names(paths):
-    """
-    This function returns 2 lists, one with the path names for the reference
-    and one for the homology arms.
-    :param paths:
-    :return:
-    """
-    # The bash script ensures that the correct names are given (the homology arm paths all start with "h")
-    h_arms = []
-    ref_paths = []
-    for path_name in paths:
-        if path_name.startswith("hom"):
-            h_arms.append(path_name)
-        elif path_name.startswith("ref_h"):
-            ref_paths.append(path_name)
-    return h_arms, ref_paths
+            with gzip.GzipFile(fileobj=gaf) as unzipped:
+                yield from io.BufferedReader(unzipped, GAF_BUFFER_SIZE)
 
 
-def create_node_dict(path):
+def read_gaf(gaf_file_name, threads=1, read_filter=None):
     """
-    creates a dictionary with the node IDs as keys and the path names as values.
-    :param path:
-    :return:
+    This function takes a gaf file (plain or compressed) and yields the nodes that reads in the file were mapped to.
+    :param: gaf_file_name
+    :param threads: number of threads that decompress BGZF files
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: generator of nodes
     """
-    temp_dict = {}
-    for i in path:
-        shared_score = 0
-        for j in i[1]:
-            if j.startswith("hom"):
-                shared_score += 1
-            if j.startswith("ref_h"):
-                shared_score += 1
-        temp_dict[i[0]] = i[1]
-    return temp_dict
+    yield from filter_gaf_rows(gaf_rows(gaf_file_name, threads), read_filter)
 
 
-def get_path(node):
+def split_gaf(gaf_file_name, parts):
     """
-    Careful, this function returns a list, even if there is only one element.
-    Use a length or type check when this function is called.
-    :param node:
-    :return:
+    This function splits a gaf file into (at most) the given number of byte ranges of about the same size. Every
+    range starts at the beginning of a line and ends just after a newline (or at the end of the file), so every read
+    is in exactly one range.
+    :param gaf_file_name:
+    :param parts: number of ranges
+    :return: list of (start, end) byte offsets
     """
-    return node_dict.get(node)
+    size = os.path.getsize(gaf_file_name)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(gaf_file_name, "rb") as gaf, mmap.mmap(gaf.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for i in range(1, parts):
+            newline = mapped.find(b"\n", max(size * i // parts, bounds[-1]))
+            if newline == -1:
+                break
+            bounds.append(newline + 1)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_gaf_range(gaf_file_name, start, end, read_filter=None):
+    """
+    This function yields the nodes that reads were mapped to, like read_gaf, but only for the lines in the byte range
+    [start, end) of the file. The file is memory-mapped, so only the pages of this range are read.
+    :param gaf_file_name:
+    :param start: byte offset of the first line
+    :param end: byte offset just after the last line
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: generator of nodes
+    """
+    with open(gaf_file_name, "rb") as gaf, mmap.mmap(gaf.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        mapped.seek(start)
+        yield from filter_gaf_rows(mapped_rows(mapped, end), read_filter)
+
+
+def mapped_rows(mapped, end):
+    """
+    This function yields the lines of a memory-mapped file from its current position up to the byte offset end.
+    :param mapped: memory-mapped file
+    :param end:
+    :return: generator of lines
+    """
+    while mapped.tell() < end:
+        yield mapped.readline()
 
 
 def find_legit_edges(reads):
     """
-    This function takes a list of nodes to which reads mapped (from the GAF file)
+    This function takes the nodes to which reads mapped (from the GAF file)
     and picks out the relevant edges (only reads that map to more than one node).
-    The dictionary with the edges still needs to be created in a subsequent step.
+    The nodes of each such read are yielded as they arrive (as a string of the form ">1>2>3"), and are counted in a
+    subsequent step.
     :param reads:
-    :return:
+    :return: generator of nodes
     """
-    con_nodes = []
     for x in reads:
-        if x.count('<') > 1 or x.count('>') > 1:
-            x = x.replace('<', '>')
+        if x.count(b'<') > 1 or x.count(b'>') > 1:
+            yield x.replace(b'<', b'>')
             # This makes it easier to split the string.
             # This is something that could change if we are interested in the orientation of the reads.
-            con_nodes.append(x[1:].split('>'))
-            # The [1:] above takes away the leading empty string that is left behind by the split function.
-    return con_nodes
-
-
-def create_edge_dict(edges):
-    """
-    This function takes a list of edges and creates a dictionary with the tuple of 2 concurrent nodes
-    as the key and the number of reads mapping to that edge as the value. Tuples are sorted such that
-    they are in ascending order. This means that the first node in the tuple is always the smaller node,
-    regardless of original orientation of the read. This is for uniformity of the data as the list of
-    edges in the reference and homology arm paths are also created in the same fashion.
-    :param edges:
-    :return:
-    """
-    edge_list = []
-    edge_dict = {}
-    for nodes in edges:
-        if len(nodes) == 2:
-            temp = (int(nodes[0]), int(nodes[1]))
-            temp = sorted(temp)
-            edge_list.append(tuple(temp))
-        elif len(nodes) > 2:
-            for j in range(len(nodes) - 1):
-                temp = (int(nodes[j]), int(nodes[j + 1]))
-                temp = sorted(temp)
-                edge_list.append(tuple(temp))
-
-    for i in edge_list:
-        if i in edge_dict:
-            edge_dict[i] += 1
-        else:
-            edge_dict[i] = 1
-    return edge_dict
 
 
-def create_reverse_dict(dictionary):
+def find_stratified_edges(reads, mapq_bins):
+    """
+    This function picks out the same reads as find_legit_edges, and also works out the stratum of each read: the MAPQ
+    bin it falls in, and its strand (from the orientation of its first step). Reads with a MAPQ below the lowest bin
+    are skipped.
+    :param reads: (MAPQ, nodes) of each read
+    :param mapq_bins: increasing lower bounds of the MAPQ bins
+    :return: generator of (stratum, nodes), where the stratum is 2 * bin (+ 1 for the reverse strand)
+    """
+    for mapq, x in reads:
+        if x.count(b'<') > 1 or x.count(b'>') > 1:
+            mapq_bin = bisect.bisect_right(mapq_bins, mapq) - 1
+            if mapq_bin >= 0:
+                yield 2 * mapq_bin + x.startswith(b'<'), x.replace(b'<', b'>')
+
+
+def pack_edges(first, second):
+    """
+    This function packs edges into single 64-bit integers, with the smaller node in the upper 32 bits and the larger
+    node in the lower 32 bits. This means that an edge is packed the same way regardless of the original orientation
+    of the read, and that sorting the packed edges sorts them like the (node1, node2) tuples.
+    :param first: array of node IDs
+    :param second: array of node IDs
+    :return: array of packed edges
+    """
+    low = np.minimum(first, second).astype(np.uint64)
+    high = np.maximum(first, second).astype(np.uint64)
+    if high.size and high.max() >= EDGE_NODE_LIMIT:
+        raise ValueError(f"node IDs must be below {EDGE_NODE_LIMIT} to be packed into edges")
+    return (low << np.uint64(32)) | high
+
+
+def merge_edge_counts(edge_counts):
+    """
+    This function adds up several sets of edge counts.
+    :param edge_counts: list of (packed edges, counts)
+    :return: (sorted unique packed edges, counts)
+    """
+    edges = np.concatenate([np.asarray(i[0], dtype=np.uint64) for i in edge_counts] + [np.zeros(0, np.uint64)])
+    counts = np.concatenate([np.asarray(i[1], dtype=np.int64) for i in edge_counts] + [np.zeros(0, np.int64)])
+    order = np.argsort(edges, kind="stable")
+    edges, counts = edges[order], counts[order]
+    if len(edges) == 0:
+        return edges, counts
+    starts = np.flatnonzero(np.concatenate(([True], edges[1:] != edges[:-1])))
+    return edges[starts], np.add.reduceat(counts, starts)
+
+
+def arm_node_bitmap(index):
+    """
+    This function creates a bitmap of the nodes that are on any homology arm or reference homology arm path (one bit
+    per node ID, from the arm intervals). Only edges between two of these nodes can be diagnostic.
+    :param index:
+    :return: bitmap, as an array of bytes
+    """
+    if len(index["arm_ends"]) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    on_arms = np.zeros(int(index["arm_ends"][-1]) + 1, dtype=bool)
+    on_arms[interval_nodes(index["arm_starts"], index["arm_ends"])] = True
+    return np.packbits(on_arms)
+
+
+def nodes_in_bitmap(bitmap, nodes):
+    """
+    This function looks nodes up in a bitmap from arm_node_bitmap.
+    :param bitmap:
+    :param nodes: array of node IDs
+    :return: boolean array, True for the nodes that are set in the bitmap
+    """
+    inside = nodes < len(bitmap) * 8
+    nodes = np.where(inside, nodes, 0)
+    return inside & ((bitmap[nodes >> 3] >> (7 - (nodes & 7))) & 1).astype(bool)
+
+
+def reads_touching(bitmap, nodes, read_lengths):
+    """
+    This function finds the reads of a batch that step on any node of a bitmap.
+    :param bitmap: bitmap from arm_node_bitmap or excluded_node_bitmap
+    :param nodes: array of the node IDs of all the reads of the batch, one read after the other
+    :param read_lengths: list of the number of nodes of every read
+    :return: boolean array, True for the reads that touch the bitmap
+    """
+    reads = np.repeat(np.arange(len(read_lengths)), read_lengths)
+    return np.bincount(reads[nodes_in_bitmap(bitmap, nodes)], minlength=len(read_lengths)) > 0
+
+
+def count_edge_batch(batch, interesting=None, excluded=None):
+    """
+    This function counts the edges of a batch of reads at once. All the node IDs of the batch are parsed into one
+    array, the pairs of concurrent nodes that do not cross from one read into the next are packed, and the packed
+    edges are counted with np.unique. If a bitmap of interesting nodes is given, pairs with a node outside of it are
+    dropped before they are packed, so reads that only map to the background genome (most of them) are never turned
+    into edges. If a bitmap of excluded nodes is given, reads that touch any of them are dropped entirely.
+    :param batch: list of reads, as strings of the form ">1>2>3"
+    :param interesting: bitmap from arm_node_bitmap, or None to count every edge
+    :param excluded: bitmap from excluded_node_bitmap, or None
+    :return: (sorted unique packed edges, counts)
+    """
+    nodes = np.array(b"".join(batch)[1:].split(b">"), dtype=np.int64)
+    read_lengths = [read.count(b">") for read in batch]
+    read_ends = np.cumsum(read_lengths)
+    concurrent = np.ones(len(nodes) - 1, dtype=bool)
+    concurrent[read_ends[:-1] - 1] = False
+    if excluded is not None and len(excluded):
+        reads = np.repeat(np.arange(len(batch)), read_lengths)
+        concurrent &= ~reads_touching(excluded, nodes, read_lengths)[reads[:-1]]
+    if interesting is not None:
+        on_arms = nodes_in_bitmap(interesting, nodes)
+        concurrent &= on_arms[:-1] & on_arms[1:]
+    edges = pack_edges(nodes[:-1][concurrent], nodes[1:][concurrent])
+    return np.unique(edges, return_counts=True)
+
+
+def count_read_edges(edges, interesting=None, excluded=None):
+    """
+    This function counts the edges of the reads in batches (of about EDGE_BATCH_SIZE bytes of read paths), so memory
+    only grows with the number of distinct edges, not with the number of reads.
+    :param edges: reads, as strings of the form ">1>2>3"
+    :param interesting: bitmap from arm_node_bitmap, or None to count every edge
+    :param excluded: bitmap from excluded_node_bitmap, or None
+    :return: (sorted unique packed edges, counts)
+    """
+    totals = (np.zeros(0, np.uint64), np.zeros(0, np.int64))
+    batch = []
+    batch_nodes = 0
+    for read in edges:
+        batch.append(read)
+        batch_nodes += len(read)
+        if batch_nodes >= EDGE_BATCH_SIZE:
+            totals = merge_edge_counts([totals, count_edge_batch(batch, interesting, excluded)])
+            batch = []
+            batch_nodes = 0
+    if batch:
+        totals = merge_edge_counts([totals, count_edge_batch(batch, interesting, excluded)])
+    return totals
+
+
+def count_stratified_edges(edges, interesting=None, excluded=None):
+    """
+    This function counts the edges of the reads like count_read_edges, but keeps a separate count for every stratum.
+    The reads of each stratum are batched separately, so every batch is still counted at once.
+    :param edges: (stratum, reads as strings of the form ">1>2>3") from find_stratified_edges
+    :param interesting: bitmap from arm_node_bitmap, or None to count every edge
+    :param excluded: bitmap from excluded_node_bitmap, or None
+    :return: dictionary {stratum: (sorted unique packed edges, counts)}
+    """
+    totals = collections.defaultdict(lambda: (np.zeros(0, np.uint64), np.zeros(0, np.int64)))
+    batches = collections.defaultdict(list)
+    batch_nodes = collections.Counter()
+    for stratum, read in edges:
+        batches[stratum].append(read)
+        batch_nodes[stratum] += len(read)
+        if batch_nodes[stratum] >= EDGE_BATCH_SIZE:
+            batch_counts = count_edge_batch(batches.pop(stratum), interesting, excluded)
+            totals[stratum] = merge_edge_counts([totals[stratum], batch_counts])
+            batch_nodes[stratum] = 0
+    for stratum, batch in batches.items():
+        totals[stratum] = merge_edge_counts([totals[stratum], count_edge_batch(batch, interesting, excluded)])
+    return dict(totals)
+
+
+def merge_stratified_counts(stratified_counts):
+    """
+    This function adds up several sets of stratified edge counts.
+    :param stratified_counts: list of {stratum: (packed edges, counts)}
+    :return: dictionary {stratum: (sorted unique packed edges, counts)}
+    """
+    strata = sorted(set().union(*stratified_counts))
+    return {stratum: merge_edge_counts([counts[stratum] for counts in stratified_counts if stratum in counts])
+            for stratum in strata}
+
+
+def count_reads(reads, interesting, read_filter):
     """
-    This function takes as input a dictionary where there the keys are nodes and the values are a list of paths.
-    The output is a dictionary where the keys are paths and the values are a list of nodes. This dictionary has far
-    fewer entries than the input dictionary, making it much more efficient to look up the nodes for a given path.
-    :param dictionary:
-    :return: dictionary {path; [list of nodes]}
+    This function counts the edges of the reads that passed the read filter, per stratum if the filter has MAPQ bins.
+    :param reads: from filter_gaf_rows
+    :param interesting: bitmap from arm_node_bitmap, or None to count every edge
+    :param read_filter: from make_read_filter
+    :return: (packed edges, counts), or {stratum: (packed edges, counts)}
     """
-    graph_dict = {}
-    for k, v in dictionary.items():
-        if v is not None:
-            for x in v:
-                if x in graph_dict:
-                    graph_dict[x].append(k)
-                else:
-                    graph_dict[x] = [k]
-    return graph_dict
+    if read_filter["mapq_bins"] is None:
+        return count_read_edges(find_legit_edges(reads), interesting, read_filter["excluded_nodes"])
+    edges = find_stratified_edges(reads, read_filter["mapq_bins"])
+    return count_stratified_edges(edges, interesting, read_filter["excluded_nodes"])
 
 
 def create_edges(path):
@@ -218,109 +1070,747 @@ def create_edges(path):
     return edges
 
 
-def create_shared_edges(hpaths):
+def create_shared_edges(path_catalog, hpaths, path_dict, skip_first=True):
     """
     This function takes each homology arm, and it's corresponding reference homology arm, and creates a list of edges
     that are shared between the two paths. This new list can be checked against to exclude shared edges further down
     the line.
+    :param path_catalog: from make_path_catalog
     :param list of homology arm paths, hpaths:
+    :param path_dict: dictionary {path: array of nodes}
+    :param skip_first: leave out the first homology arm, as the coverage table does
     :return: list of shared edges
     """
+    shared_edges = []
     counter = 0
     ref_edges = []
     h_edges = []
-    for i in hpaths[1:]:
-        ref_edges.append(create_edges(path_dict.get(f"ref_{i}")))
+    for i in hpaths[1:] if skip_first else hpaths:
+        ref_edges.append(create_edges(path_dict.get(reference_of(path_catalog, i))))
         h_edges.append(create_edges(path_dict.get(i)))
         for j in h_edges[counter]:
             if j in ref_edges[counter]:
                 shared_edges.append(j)
         counter += 1
+    return shared_edges
 
 
-def create_edge_tally_dict(dictionary, paths):
+def node_intervals(nodes):
     """
-    This function takes a dictionary of edges {(node1, node2): number of reads} and a list of path names.
-    It then creates a dictionary that maps the path names to the number of edges in the path that had reads mapped
-    to them.
-    :param dictionary:
-    :param paths:
-    :return: dictionary {path name; number of valid edges}
+    This function run-length encodes the sorted nodes of a path as intervals of consecutive node IDs. After odgi sort
+    and chop, the homology arm paths mostly cover runs of consecutive nodes, so a path is stored as a few intervals
+    instead of every node. A node that the path steps on more than once starts a new interval, so the intervals
+    always expand back to exactly the same (sorted) nodes.
+    :param nodes: sorted array of node IDs
+    :return: array of interval starts, array of interval ends (inclusive)
     """
-    tally_dictionary = {}
-    for i in paths:
-        for j in i:
-            tally = 0
-            temp = create_edges(path_dict.get(j))
-            for k in temp:
-                if k not in shared_edges and dictionary.get(k) is not None:
-                    tally += dictionary.get(k)
-            tally_dictionary[j] = tally
-    return tally_dictionary
+    if len(nodes) == 0:
+        return nodes, nodes
+    breaks = np.flatnonzero(np.diff(nodes) != 1) + 1
+    return nodes[np.append(0, breaks)], nodes[np.append(breaks - 1, len(nodes) - 1)]
 
 
-def tally_reads_in_path(path):
+def interval_nodes(starts, ends):
     """
-    This function takes a path and returns the number of edges in the path that had reads mapped to them.
-    :param path:
-    :return: number of edges
+    This function expands intervals back into the node IDs they cover.
+    :param starts: array of interval starts
+    :param ends: array of interval ends (inclusive)
+    :return: array of node IDs
     """
-    return edge_tally[path]
+    lengths = ends - starts + 1
+    first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + np.arange(lengths.sum()) - first
 
 
-def num_edges(path):
+def interval_edges(starts, ends):
     """
-    This function takes a path and returns the number of edges in the path. It excludes edges that are shared between
-    the reference and the homology arm.
-    :param path:
-    :return:
+    This function enumerates the (packed) edges of a path from its intervals. Like create_edges, these are the pairs
+    of concurrent nodes in the sorted nodes of the path: within an interval they are (n, n + 1), and between two
+    intervals they join the end of one to the start of the next.
+    :param starts: array of interval starts
+    :param ends: array of interval ends (inclusive)
+    :return: array of packed edges
+    """
+    nodes = interval_nodes(starts, ends)
+    return pack_edges(nodes[:-1], nodes[1:])
+
+
+def intervals_contain(starts, ends, nodes):
+    """
+    This function checks, with a binary search, which of the given nodes fall inside a sorted set of intervals.
+    :param starts: array of interval starts (sorted)
+    :param ends: array of interval ends (inclusive)
+    :param nodes: array of node IDs
+    :return: boolean array
     """
-    temp = []
-    for i in create_edges(path_dict.get(path)):
-        if i not in shared_edges:
-            temp.append(i)
-    return len(temp)
+    if len(starts) == 0:
+        return np.zeros(len(nodes), dtype=bool)
+    position = np.searchsorted(starts, nodes, side="right") - 1
+    return (position >= 0) & (nodes <= ends[np.maximum(position, 0)])
 
 
-def group_paths(paths):
+def merge_intervals(starts, ends):
     """
-    This function takes a list of homology arm paths and groups the corresponding reference paths (over the
-    homology arm path range) together. If either the homology arm or the reference path is not found to have zero
-    edges, it is NOT grouped. The list is in the form [homology arm path, reference path].
-    :param list of homology arm paths:
-    :return: list in the form [homology arm path, reference path]
+    This function merges intervals that overlap or touch, giving the sorted union of the intervals.
+    :param starts: array of interval starts
+    :param ends: array of interval ends (inclusive)
+    :return: array of interval starts, array of interval ends (inclusive)
     """
-    grouped_paths = []
-    for hpath in paths:
-        if num_edges(hpath) != 0 and num_edges(f"ref_{hpath}") != 0:
-            grouped_paths.append([hpath, num_edges(hpath), f"ref_{hpath}", num_edges(f"ref_{hpath}")])
-    return grouped_paths
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] > reach[:-1] + 1)))
+    return starts[first], reach[np.append(first[1:] - 1, len(starts) - 1)]
 
 
-def make_coverage_table(path_ids):
+def create_index(path_catalog, hpaths, ref_paths, path_dict, shared_edges):
     """
-    This function will take a list of path names and return a table containing the coverage
-    (and associated information) of each path.
-    :param list of path_ids:
+    This function packs everything the coverage calculation needs from the graph into a dictionary of NumPy arrays:
+    the path catalog, the oriented IDs of the homology arm and reference paths, the nodes of each path (as intervals,
+    see node_intervals), the edges of each path that are not shared between a homology arm and its reference (the
+    diagnostic edges), the shared edges themselves, and the union of the intervals of all paths (the arm nodes).
+    The paths are stored homology arms first, then reference paths, and the intervals and edges of path i are found
+    between offsets[i] and offsets[i + 1]. Edges are packed with pack_edges. The shared edges are removed here, once.
+    :param path_catalog: from make_path_catalog
+    :param hpaths: list of homology arm paths
+    :param ref_paths: list of reference homology arm paths
+    :param path_dict: dictionary {path: array of nodes}
+    :param shared_edges: list of shared edges from create_shared_edges
+    :return: dictionary {array name: array}
+    """
+    shared = np.unique(np.array(shared_edges, dtype=np.int64).reshape(-1, 2), axis=0)
+    shared = pack_edges(shared[:, 0], shared[:, 1])
+    starts, ends, edges = [], [], []
+    for path in hpaths + ref_paths:
+        path_nodes = np.sort(path_dict.get(path, np.zeros(0, dtype=np.int64)))
+        path_starts, path_ends = node_intervals(path_nodes)
+        path_edges = interval_edges(path_starts, path_ends)
+        starts.append(path_starts)
+        ends.append(path_ends)
+        # The shared edges are unique and sorted, so they can be looked up with a binary search per path.
+        found = np.minimum(np.searchsorted(shared, path_edges), max(len(shared) - 1, 0))
+        is_shared = shared[found] == path_edges if len(shared) else np.zeros(len(path_edges), dtype=bool)
+        edges.append(path_edges[~is_shared])
+    empty = [np.zeros(0, dtype=np.int64)]
+    index = {
+        "path_names": np.array(path_catalog["names"], dtype=str),
+        "path_classes": path_catalog["classes"],
+        "hom_paths": np.array(hpaths, dtype=np.int64),
+        "ref_paths": np.array(ref_paths, dtype=np.int64),
+        "interval_offsets": np.cumsum([0] + [len(i) for i in starts]).astype(np.int64),
+        "interval_starts": np.concatenate(starts + empty).astype(np.int64),
+        "interval_ends": np.concatenate(ends + empty).astype(np.int64),
+        "edge_offsets": np.cumsum([0] + [len(i) for i in edges]).astype(np.int64),
+        "edges": np.concatenate(edges + [np.zeros(0, dtype=np.uint64)]),
+        "shared_edges": shared,
+    }
+    index["arm_starts"], index["arm_ends"] = merge_intervals(index["interval_starts"], index["interval_ends"])
+    incidence_edges, incidence_offsets, incidence_paths, incidence_counts = group_by_key(index["edges"],
+                                                                                         index["edge_offsets"])
+    index.update({"incidence_edges": incidence_edges, "incidence_offsets": incidence_offsets,
+                  "incidence_paths": incidence_paths, "incidence_counts": incidence_counts})
+    return index
+
+
+def build_index(graph, skip_first=True):
+    """
+    This function builds the index of a graph from any graph backend: it walks the homology arm and reference
+    homology arm paths, finds the shared edges and creates the index from them.
+    :param graph: graph backend
+    :param skip_first: see create_shared_edges
+    :return: index
+    """
+    path_catalog, hom_path, ref_hom_path, path_dict = load_arm_paths(graph)
+    # These are the catalog of path names, the (oriented IDs of the) homology arm and reference homology arm paths,
+    # and a dictionary that can be used to look up the nodes of a given path.
+    shared_edges = create_shared_edges(path_catalog, hom_path, path_dict, skip_first)
+    return create_index(path_catalog, hom_path, ref_hom_path, path_dict, shared_edges)
+
+
+def group_by_key(keys, key_offsets):
+    """
+    This function inverts a mapping from paths to keys (the diagnostic edges), stored like a CSR matrix with one row
+    per path, into a mapping from keys to paths with one row per distinct key: the paths that contain unique_keys[i]
+    (and how many times they contain it) are found between offsets[i] and offsets[i + 1] of paths and counts.
+    This gives the incidence of the diagnostic edges.
+    :param keys: keys of every path, one path after another
+    :param key_offsets: where the keys of each path start
+    :return: unique keys, offsets, paths, counts
+    """
+    paths = np.repeat(np.arange(len(key_offsets) - 1), np.diff(key_offsets))
+    order = np.lexsort((paths, keys))
+    keys, paths = keys[order], paths[order]
+    # Every distinct (key, path) pair becomes one entry, counting how often the path contains the key.
+    new_entry = np.concatenate(([True], (keys[1:] != keys[:-1]) | (paths[1:] != paths[:-1])))[:len(keys)]
+    entries = np.flatnonzero(new_entry)
+    counts = np.diff(np.append(entries, len(keys)))
+    keys, paths = keys[entries], paths[entries]
+    new_key = np.concatenate(([True], keys[1:] != keys[:-1]))[:len(keys)]
+    return (keys[new_key], np.append(np.flatnonzero(new_key), len(keys)).astype(np.int64), paths.astype(np.int64),
+            counts.astype(np.int64))
+
+
+def hash_file(file_name):
+    """
+    This function returns the SHA-256 digest of the contents of a file, read in chunks so that large graphs
+    do not have to fit in memory.
+    :param file_name:
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileHashes:
+    """
+    The SHA-256 of files, remembered in <cache dir>/hashes.json by path, size, modification time and inode, so a
+    large file is only read again after it changed.
+    """
+
+    def __init__(self, cache_dir):
+        self.file_name = os.path.join(cache_dir, HASHES_FILE)
+        self.hashes = {}
+        # The shards of build_graph.py are built in threads that share the hashes.
+        self.lock = threading.Lock()
+        try:
+            with open(self.file_name) as hashes_file:
+                self.hashes = json.load(hashes_file)
+        except (OSError, ValueError):
+            pass
+
+    def __call__(self, file_name):
+        stat = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        stamp = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        if path in self.hashes and self.hashes[path][0] == stamp:
+            return self.hashes[path][1]
+        digest = hash_file(file_name)
+        with self.lock:
+            self.hashes[path] = [stamp, digest]
+        return digest
+
+    def save(self):
+        # Every process writes its own temporary file, so ones that save at the same time never mix their writes.
+        directory = os.path.dirname(self.file_name)
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            handle, tmp_name = tempfile.mkstemp(prefix=".hashes-", dir=directory)
+            try:
+                with os.fdopen(handle, "wt") as hashes_file:
+                    json.dump(self.hashes, hashes_file)
+                os.replace(tmp_name, self.file_name)
+            except OSError:
+                os.remove(tmp_name)
+                raise
+
+
+def index_dir(og_file_name, file_hash=hash_file, skip_first=True):
+    """
+    This function returns the name of the index directory that belongs to a graph. The directory sits next to the
+    .og file and is keyed by a hash of the graph contents (and the index version), so that a rebuilt graph never
+    picks up an index that was made for an older one. An index that keeps the first arm has a name of its own.
+    :param og_file_name:
+    :param file_hash: function (file name) -> SHA-256, e.g. FileHashes
+    :param skip_first: see create_shared_edges
+    :return: directory name
+    """
+    return f"{og_file_name}.v{INDEX_VERSION}.{file_hash(og_file_name)[:16]}{'' if skip_first else '.all'}.idx"
+
+
+def save_index(index, directory):
+    """
+    This function writes every array of the index to its own .npy file. The files are written to a temporary
+    directory first and then moved into place, so samples that are scored at the same time never see a half-written
+    index. If the index cannot be written (e.g. the directory of the graph is read-only), it is not cached and the
+    index in memory is used as it is.
+    :param index: dictionary {array name: array}
+    :param directory: index directory
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix=".idx-", dir=parent)
+    except OSError as error:
+        print(f"Index not cached: {error}", file=sys.stderr)
+        return
+    try:
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), index[name])
+    except OSError as error:
+        # E.g. the disk is full.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f"Index not cached: {error}", file=sys.stderr)
+        return
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Another process finished writing the same index first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_index(directory):
+    """
+    This function memory-maps the arrays of a previously saved index. Nothing is read from disk until the arrays
+    are used.
+    :param directory: index directory
+    :return: dictionary {array name: array}, or None if there is no (complete) index
+    """
+    if not os.path.isdir(directory):
+        return None
+    try:
+        return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in INDEX_ARRAYS}
+    except (OSError, ValueError):
+        return None
+
+
+def cached_excluded_nodes(graph, prefixes, classes, directory=None):
+    """
+    This function returns the bitmap of excluded_node_bitmap, read from the index directory if it was made there
+    before, so the paths of the graph are only walked once for every set of excluded paths. The bitmap is saved under
+    a hash of the prefixes and classes, and is not cached if the directory is missing or cannot be written.
+    :param graph: graph backend
+    :param prefixes: list of path name prefixes
+    :param classes: bitmask of path classes
+    :param directory: index directory, or None
+    :return: bitmap, as an array of bytes
+    """
+    if directory is None or not os.path.isdir(directory):
+        return excluded_node_bitmap(graph, prefixes, classes)
+    key = hashlib.sha256(json.dumps([sorted(prefixes), classes]).encode()).hexdigest()[:16]
+    file_name = os.path.join(directory, f"excluded.{key}.npy")
+    try:
+        return np.load(file_name)
+    except (OSError, ValueError):
+        pass
+    bitmap = excluded_node_bitmap(graph, prefixes, classes)
+    try:
+        handle, tmp_name = tempfile.mkstemp(prefix=".excluded-", dir=directory)
+    except OSError as error:
+        print(f"Excluded nodes not cached: {error}", file=sys.stderr)
+        return bitmap
+    try:
+        with os.fdopen(handle, "wb") as tmp_file:
+            np.save(tmp_file, bitmap)
+        os.replace(tmp_name, file_name)
+    except OSError as error:
+        os.remove(tmp_name)
+        print(f"Excluded nodes not cached: {error}", file=sys.stderr)
+    return bitmap
+
+
+def arm_names(index):
+    """
+    This function returns the names of the paths in the index (homology arms first, then reference paths), each
+    followed by its orientation ("+" or "-").
+    :param index:
+    :return: list of path names
+    """
+    names = index["path_names"].tolist()
+    return [oriented_name(names, i) for i in index["hom_paths"].tolist() + index["ref_paths"].tolist()]
+
+
+def align_edge_counts(edge_counts, index):
+    """
+    This function lines the read counts of a sample up with the diagnostic edges of the incidence, giving one count
+    per diagnostic edge. Reads on any other edge are dropped here.
+    :param edge_counts: (packed edges, counts) of the reads
+    :param index:
+    :return: array with the number of reads on every diagnostic edge
+    """
+    read_edges, read_counts = edge_counts
+    # Only edges with both nodes inside the arm intervals can be diagnostic; this is a binary search in a handful of
+    # intervals, which drops most background edges before they are looked up among the diagnostic edges.
+    on_arms = (intervals_contain(index["arm_starts"], index["arm_ends"], (read_edges >> np.uint64(32)).astype(np.int64))
+               & intervals_contain(index["arm_starts"], index["arm_ends"],
+                                   (read_edges & np.uint64(EDGE_NODE_LIMIT - 1)).astype(np.int64)))
+    read_edges, read_counts = read_edges[on_arms], read_counts[on_arms]
+    incidence_edges = index["incidence_edges"]
+    counts = np.zeros(len(incidence_edges), dtype=np.int64)
+    if len(incidence_edges):
+        position = np.minimum(np.searchsorted(incidence_edges, read_edges), len(incidence_edges) - 1)
+        found = incidence_edges[position] == read_edges
+        counts[position[found]] = read_counts[found]
+    return counts
+
+
+def tally_matrix(count_matrix, index):
+    """
+    This function adds up, for every path in the index and every sample, the number of reads mapping to each of the
+    diagnostic edges of the path. This is one sparse matrix product of the transposed incidence (paths x edges) and
+    the edge counts (edges x samples): the entries of the incidence are grouped by path, and the sum over each group
+    is taken from a running sum, which is exact and handles paths without any diagnostic edges. Samples are done
+    MATRIX_CHUNK_SIZE columns at a time to bound memory.
+    :param count_matrix: array (diagnostic edges x samples) from align_edge_counts
+    :param index:
+    :return: array (paths x samples) of tallies
+    """
+    paths = len(index["edge_offsets"]) - 1
+    entry_edges = np.repeat(np.arange(len(index["incidence_edges"])), np.diff(index["incidence_offsets"]))
+    order = np.argsort(index["incidence_paths"], kind="stable")
+    path_starts = np.searchsorted(index["incidence_paths"][order], np.arange(paths + 1))
+    entry_edges = entry_edges[order]
+    entry_counts = index["incidence_counts"][order][:, None]
+    tallies = np.zeros((paths, count_matrix.shape[1]), dtype=np.int64)
+    for first in range(0, count_matrix.shape[1], MATRIX_CHUNK_SIZE):
+        block = count_matrix[entry_edges, first:first + MATRIX_CHUNK_SIZE] * entry_counts
+        running = np.concatenate((np.zeros((1, block.shape[1]), dtype=np.int64), np.cumsum(block, axis=0)))
+        tallies[:, first:first + MATRIX_CHUNK_SIZE] = running[path_starts[1:]] - running[path_starts[:-1]]
+    return tallies
+
+
+def group_paths(index):
+    """
+    This function takes the homology arm paths of the index and groups the corresponding reference paths (over the
+    homology arm path range) together. If either the homology arm or the reference path is found to have zero
+    edges, it is NOT grouped. Each grouped arm gets one record, computed once, with its name, the positions of the
+    homology arm and reference path in the index, and their number of edges (excluding edges that are shared between
+    the reference and the homology arm).
+    :param index:
+    :return: structured array with one record per grouped arm, in graph order
+    """
+    names = arm_names(index)
+    positions = {name: i for i, name in enumerate(names)}
+    num_edges = np.diff(index["edge_offsets"])
+    records = []
+    for position, hpath in enumerate(names[:len(index["hom_paths"])]):
+        ref_position = positions.get(f"ref_{hpath}")
+        if ref_position is not None and num_edges[position] != 0 and num_edges[ref_position] != 0:
+            records.append((hpath, position, ref_position, num_edges[position], num_edges[ref_position]))
+    name_length = max([len(name) for name in names], default=1)
+    return np.array(records, dtype=[("name", f"U{name_length}"), ("position", np.int64), ("ref_position", np.int64),
+                                    ("edges", np.int64), ("ref_edges", np.int64)])
+
+
+def arm_metrics(path_ids, tallies):
+    """
+    This function derives the coverage of every grouped arm from the tallies of the paths, for one or more samples
+    at once. The homology arm coverage and reference coverage are the tallies divided by the number of edges. The
+    fractional coverage is the homology arm coverage divided by the sum of the homology arm and reference coverage;
+    it is 0 when no reads map to the homology arm, and 1 when reads only map to the homology arm.
+    :param path_ids: grouped arms from group_paths
+    :param tallies: array (paths x samples) from tally_matrix
+    :return: dictionary {metric: array (arms x samples)}
+    """
+    hom_tally = tallies[path_ids["position"]]
+    ref_tally = tallies[path_ids["ref_position"]]
+    hom_cov = hom_tally / path_ids["edges"].reshape(-1, 1)
+    ref_cov = ref_tally / path_ids["ref_edges"].reshape(-1, 1)
+    frac_cov = np.divide(hom_cov, hom_cov + ref_cov, out=np.zeros_like(hom_cov), where=hom_tally != 0)
+    return {"tally": hom_tally, "ref_tally": ref_tally, "coverage": hom_cov, "ref_coverage": ref_cov,
+            "fractional_coverage": frac_cov}
+
+
+def coverage_matrix(count_matrix, index, path_ids, skip_first=True):
+    """
+    This function computes the homology arm coverage, reference coverage and fractional homology arm coverage of
+    every arm in every sample at once. The arms are the same as in the coverage table of a single sample, in graph
+    order.
+    :param count_matrix: array (diagnostic edges x samples) from align_edge_counts
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param skip_first: leave out the first arm, as the coverage table does
+    :return: list of arms, and arrays (arms x samples) of homology arm, reference and fractional coverage
+    """
+    arms = path_ids[1:] if skip_first else path_ids
+    metrics = arm_metrics(arms, tally_matrix(count_matrix, index))
+    return arms["name"].tolist(), metrics["coverage"], metrics["ref_coverage"], metrics["fractional_coverage"]
+
+
+def make_coverage_table(path_ids, tallies, skip_first=True):
+    """
+    This function will take the grouped arms and the tallies of one sample and return a table containing the coverage
+    (and associated information) of each arm.
+    :param path_ids: grouped arms from group_paths
+    :param tallies: array with the tally of every path
+    :param skip_first: leave out the first arm (False keeps every arm, for the shards after the first one)
     :return: coverage list
     """
-    coverage_list = []
     # this list will be in the form: [[hom_arm_name, hom_arm_coverage, ref_subpath_coverage, #_of_hom_arm_edges,
     # count_for_hom_arm, #_of_ref_subpath_edges, count_for_ref_subpath], [etc]]
-    for path in path_ids[1:]:
-        if path[1] != 0 and path[3] != 0:
-            coverage_list.append(
-                [path[0], tally_reads_in_path(path[0]) / path[1],
-                 tally_reads_in_path(path[2]) / path[3], path[1], tally_reads_in_path(path[0]),
-                 path[3], tally_reads_in_path(path[2])])
-    return coverage_list
+    arms = path_ids[1:] if skip_first else path_ids
+    metrics = arm_metrics(arms, tallies.reshape(-1, 1))
+    columns = [arms["name"], metrics["coverage"][:, 0], metrics["ref_coverage"][:, 0], arms["edges"],
+               metrics["tally"][:, 0], arms["ref_edges"], metrics["ref_tally"][:, 0]]
+    return [list(row) for row in zip(*(column.tolist() for column in columns))]
+
+
+def count_gaf_range(gaf_range):
+    """
+    This function counts the edges of the reads in one byte range of a gaf file. It is run in the worker processes
+    that parse a single gaf file in parallel. The counts are returned packed, which is cheap to send back.
+    :param gaf_range: (gaf file name, start, end, bitmap of interesting nodes, read filter)
+    :return: (packed edges, counts)
+    """
+    gaf_file_name, start, end, interesting, read_filter = gaf_range
+    return count_reads(read_gaf_range(gaf_file_name, start, end, read_filter), interesting, read_filter)
+
+
+def count_gaf_edges(gaf_file_name, workers=1, threads=1, interesting=None, read_filter=None):
+    """
+    This function counts the edges of the reads in a gaf file. With more than one worker, an uncompressed file is
+    split into newline-aligned byte ranges that are parsed in parallel processes, and their counts are merged
+    afterwards. The counts are the same either way. Compressed files are read in a single process.
+    :param gaf_file_name:
+    :param workers: number of processes
+    :param threads: number of threads that decompress BGZF files
+    :param interesting: bitmap from arm_node_bitmap, or None to count every edge
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: (packed edges, counts), or {stratum: (packed edges, counts)} if the filter has MAPQ bins
+    """
+    read_filter = read_filter or make_read_filter()
+    ranges = []
+    if workers > 1 and gaf_file_name != STDIN_PATH and not is_gzipped(gaf_file_name):
+        ranges = [(gaf_file_name, start, end, interesting, read_filter)
+                  for start, end in split_gaf(gaf_file_name, workers)]
+    if len(ranges) <= 1:
+        return count_reads(read_gaf(gaf_file_name, threads, read_filter), interesting, read_filter)
+    with multiprocessing.get_context("fork").Pool(len(ranges)) as pool:
+        range_counts = pool.map(count_gaf_range, ranges)
+    if read_filter["mapq_bins"] is None:
+        return merge_edge_counts(range_counts)
+    return merge_stratified_counts(range_counts)
+
+
+def count_sample(gaf_file_name, index, workers=1, threads=1, read_filter=None):
+    """
+    This function counts the reads of one GAF file on every diagnostic edge of the index.
+    :param gaf_file_name:
+    :param index:
+    :param workers: number of processes that parse the GAF file
+    :param threads: number of threads that decompress a BGZF file
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: array with the number of reads on every diagnostic edge, or array (diagnostic edges x strata) if the
+    filter has MAPQ bins
+    """
+    edge_counts = count_gaf_edges(gaf_file_name, workers, threads, arm_node_bitmap(index), read_filter)
+    if read_filter is None or read_filter["mapq_bins"] is None:
+        return align_edge_counts(edge_counts, index)
+    no_counts = (np.zeros(0, np.uint64), np.zeros(0, np.int64))
+    strata = range(len(READ_STRANDS) * len(read_filter["mapq_bins"]))
+    return np.stack([align_edge_counts(edge_counts.get(stratum, no_counts), index) for stratum in strata], axis=1)
+
+
+def coverage_table(counts, index, path_ids, skip_first=True):
+    """
+    This function turns the edge counts of one sample into its coverage table, sorted by the homology arm coverage
+    (making it easy to see which hom_arm has the highest coverage).
+    :param counts: array with the number of reads on every diagnostic edge
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param skip_first: see make_coverage_table
+    :return: sorted coverage list
+    """
+    cov_list = make_coverage_table(path_ids, tally_matrix(counts[:, None], index)[:, 0], skip_first)
+    return sorted(cov_list, key=lambda row: row[1], reverse=True)
+
+
+def score_gaf(gaf_file_name, index, path_ids, workers=1, threads=1, read_filter=None):
+    """
+    This function scores the reads of one GAF file against the index and returns its coverage table.
+    :param gaf_file_name:
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param workers: number of processes that parse the GAF file
+    :param threads: number of threads that decompress a BGZF file
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: sorted coverage list
+    """
+    return coverage_table(count_sample(gaf_file_name, index, workers, threads, read_filter), index, path_ids)
+
+
+def set_worker_index(index):
+    """
+    This function is run once in every worker process of score_samples, and keeps the index for count_sample_in_worker.
+    The workers are forked, so the index is not pickled: every worker shares the parent's (read-only) copy of it.
+    :param index:
+    """
+    global worker_index
+    worker_index = index
+
+
+def count_sample_in_worker(task):
+    """
+    This function counts a GAF file in a worker process, against the index that set_worker_index kept.
+    :param task: (gaf file name, number of decompression threads, read filter)
+    :return: array with the number of reads on every diagnostic edge
+    """
+    gaf_file_name, threads, read_filter = task
+    return count_sample(gaf_file_name, worker_index, threads=threads, read_filter=read_filter)
+
 
+def score_samples(gaf_file_names, index, workers, threads=1, read_filter=None):
+    """
+    This function counts the reads of every GAF file on the diagnostic edges, in a pool of worker processes if more
+    than one worker is asked for. A single GAF file is instead split into byte ranges that the workers parse in
+    parallel. The counts are yielded in the same order as the GAF files, as soon as they are ready.
+    :param gaf_file_names: list of GAF files
+    :param index:
+    :param workers: number of processes
+    :param threads: number of threads that decompress each BGZF file
+    :param read_filter: from make_read_filter, or None for the default filter
+    :return: generator of arrays with the number of reads on every diagnostic edge
+    """
+    if workers <= 1 or len(gaf_file_names) == 1:
+        for gaf in gaf_file_names:
+            yield count_sample(gaf, index, workers, threads, read_filter)
+        return
+    pool = multiprocessing.get_context("fork").Pool(min(workers, len(gaf_file_names)), set_worker_index, (index,))
+    with pool:
+        yield from pool.imap(count_sample_in_worker, [(gaf, threads, read_filter) for gaf in gaf_file_names])
+
+
+class CoverageEngine:
+    """
+    Scores GAF files against one graph, for use inside a long-lived Python process (a notebook, a scheduler) as well
+    as from the command line. Nothing is loaded when the engine is created: the index of the graph is read from its
+    cache (or built from the graph) the first time it is needed, and then reused by every GAF file that is scored.
 
-def write_to_tsv(coverage_list):
+        engine = CoverageEngine(og_gfa_path="yeast+edits.og.gfa")
+        table = engine.score("sample.gaf")
+    """
+
+    def __init__(self, og_path=None, og_gfa_path=None, graph=None, index_cache=True, read_filter=None,
+                 exclude_path_prefixes=(), exclude_plasmids=False, workers=1, threads=1, skip_first_arm=True):
+        """
+        :param og_path: graph in odgi format
+        :param og_gfa_path: graph in GFA format
+        :param graph: graph backend, instead of a graph file (its index is not cached)
+        :param index_cache: read and write the index next to the graph file
+        :param read_filter: from make_read_filter, or None for the default filter
+        :param exclude_path_prefixes: skip reads on nodes that are only on paths with these prefixes
+        :param exclude_plasmids: skip reads on nodes that are only on plasmid paths
+        :param workers: number of processes that count GAF files
+        :param threads: number of threads that decompress each BGZF file
+        :param skip_first_arm: leave out the first arm of the graph, from the shared edges and the tables
+        """
+        self.graph = graph if graph is not None else open_graph(og_path, og_gfa_path)
+        self.graph_file_name = og_gfa_path or og_path if graph is None and index_cache else None
+        self.read_filter = read_filter or make_read_filter()
+        self.exclude_path_prefixes = list(exclude_path_prefixes)
+        self.exclude_plasmids = exclude_plasmids
+        self.workers = workers
+        self.threads = threads
+        self.skip_first_arm = skip_first_arm
+        self._index = None
+        self._index_name = None
+        self._path_ids = None
+        self._excluded_nodes = {}
+
+    @property
+    def index_name(self):
+        """
+        The index directory of the graph file, or None if the index is not cached. The graph is only hashed the first
+        time this is needed, and its hash is remembered in the GRAPH_CACHE_DIR next to it, so an unchanged graph is
+        not read again.
+        """
+        if self._index_name is None and self.graph_file_name is not None:
+            graph_dir = os.path.dirname(os.path.abspath(self.graph_file_name))
+            hashes = FileHashes(os.path.join(graph_dir, GRAPH_CACHE_DIR))
+            self._index_name = index_dir(self.graph_file_name, hashes, self.skip_first_arm)
+            try:
+                hashes.save()
+            except OSError:
+                # E.g. the directory of the graph is read-only, so the graph is hashed again next time.
+                pass
+        return self._index_name
+
+    @property
+    def index(self):
+        """
+        The index of the graph, memory-mapped from its cache if the graph has been seen before, or else built from
+        the graph (and cached).
+        """
+        if self._index is None:
+            index = None if self.index_name is None else load_index(self.index_name)
+            if index is None:
+                index = build_index(self.graph, self.skip_first_arm)
+                if self.index_name is not None:
+                    save_index(index, self.index_name)
+            self._index = index
+        return self._index
+
+    @property
+    def path_ids(self):
+        """
+        The grouped arms of the index, from group_paths.
+        """
+        return self.load()._path_ids
+
+    def load(self):
+        """
+        This function loads the index and groups its arms now, instead of when they are first needed.
+        :return: the engine
+        """
+        if self._path_ids is None:
+            self._path_ids = group_paths(self.index)
+        return self
+
+    def filter(self, read_filter=None, exclude_path_prefixes=None, exclude_plasmids=None):
+        """
+        This function returns a read filter with the nodes of the excluded paths filled in. The nodes are looked up
+        in the graph once for every set of excluded paths, and cached in the index directory.
+        :param read_filter: from make_read_filter, or None for the filter of the engine
+        :param exclude_path_prefixes: list of prefixes, or None for those of the engine
+        :param exclude_plasmids: True to exclude the plasmid paths, or None for the setting of the engine
+        :return: read filter
+        """
+        read_filter = read_filter or self.read_filter
+        prefixes = tuple(self.exclude_path_prefixes if exclude_path_prefixes is None else exclude_path_prefixes)
+        plasmids = self.exclude_plasmids if exclude_plasmids is None else exclude_plasmids
+        excluded = (prefixes, PATH_CLASS_PLASMID if plasmids else 0)
+        if excluded == ((), 0):
+            return read_filter
+        if excluded not in self._excluded_nodes:
+            # The index is loaded first, so that its directory exists.
+            self.load()
+            self._excluded_nodes[excluded] = cached_excluded_nodes(self.graph, *excluded, self.index_name)
+        return dict(read_filter, excluded_nodes=self._excluded_nodes[excluded])
+
+    def count(self, gaf_file_name):
+        """
+        This function counts the reads of one GAF file on every diagnostic edge.
+        :param gaf_file_name:
+        :return: array with the number of reads on every diagnostic edge (x strata, if the filter has MAPQ bins)
+        """
+        return count_sample(gaf_file_name, self.index, self.workers, self.threads, self.filter())
+
+    def count_all(self, gaf_file_names, read_filter=None):
+        """
+        This function counts the reads of several GAF files, with score_samples.
+        :param gaf_file_names: list of GAF files
+        :param read_filter: from filter, or None for the filter of the engine
+        :return: generator of arrays, in the same order as the GAF files
+        """
+        return score_samples(gaf_file_names, self.index, self.workers, self.threads, read_filter or self.filter())
+
+    def table(self, counts):
+        """
+        This function turns the counts of one sample into its coverage table (see write_to_tsv for the columns).
+        :param counts: from count or count_all
+        :return: coverage list, sorted by the homology arm coverage
+        """
+        if counts.ndim == 2:
+            counts = counts.sum(axis=1)
+        return coverage_table(counts, self.index, self.path_ids, self.skip_first_arm)
+
+    def score(self, gaf_file_name):
+        """
+        This function scores the reads of one GAF file.
+        :param gaf_file_name:
+        :return: coverage list, sorted by the homology arm coverage
+        """
+        return self.table(self.count(gaf_file_name))
+
+
+def write_to_tsv(coverage_list, out_file_name):
     """
     This function takes a list of coverage data and writes it to a tsv file.
     """
-    with open(args.out_path, "wt") as tsv_file:
+    with open(out_file_name, "wt") as tsv_file:
         tsv_writer = csv.writer(tsv_file, delimiter='\t', lineterminator='\n')
         tsv_writer.writerow(["Homology arm", "Homology arm coverage", "Reference coverage", "Homology arm edges",
                              "Count for homology arm", "Reference edges", "Count for reference"])
@@ -328,27 +1818,495 @@ def write_to_tsv(coverage_list):
             tsv_writer.writerow(i)
 
 
+def write_matrix(count_matrix, samples, out_file_name, index, path_ids, skip_first=True):
+    """
+    This function takes the edge counts of several samples and writes the homology arm coverage, reference coverage
+    and fractional homology arm coverage of every arm (rows) in every sample (columns) to a single tsv file. The arms
+    are in the same order as in the graph.
+    :param count_matrix: array (diagnostic edges x samples) from align_edge_counts
+    :param samples: list of sample names
+    :param out_file_name:
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param skip_first: see coverage_matrix
+    """
+    write_matrix_rows(*matrix_rows(count_matrix, index, path_ids, skip_first), samples, out_file_name)
+
+
+def matrix_rows(count_matrix, index, path_ids, skip_first=True):
+    """
+    This function computes the rows of the coverage matrix: for every arm, the homology arm coverage, reference
+    coverage and fractional homology arm coverage, interleaved per sample.
+    :param count_matrix: array (diagnostic edges x samples) from align_edge_counts
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param skip_first: see coverage_matrix
+    :return: list of arms, list of rows
+    """
+    arms, hom_cov, ref_cov, frac_cov = coverage_matrix(count_matrix, index, path_ids, skip_first)
+    return arms, np.stack((hom_cov, ref_cov, frac_cov), axis=2).reshape(len(arms), -1).tolist()
+
+
+def write_matrix_rows(arms, rows, samples, out_file_name):
+    """
+    This function writes the rows of a coverage matrix to a tsv file, under a header with the samples.
+    :param arms: list of arms
+    :param rows: list of rows from matrix_rows
+    :param samples: list of sample names
+    :param out_file_name:
+    """
+    with open(out_file_name, "wt") as tsv_file:
+        tsv_writer = csv.writer(tsv_file, delimiter='\t', lineterminator='\n')
+        header = ["Homology arm"]
+        for sample in samples:
+            header += [f"{sample} homology arm coverage", f"{sample} reference coverage",
+                       f"{sample} fractional homology arm coverage"]
+        tsv_writer.writerow(header)
+        # The three tables are interleaved per sample, in the same order as the header.
+        for arm, row in zip(arms, rows):
+            tsv_writer.writerow([arm] + row)
+
+
+def sweep_count_matrix(stratified):
+    """
+    This function turns the stratified edge counts of one sample into its edge counts at every MAPQ threshold: for
+    each MAPQ bin, the reads in that bin or a higher one, on both strands together and on each strand.
+    :param stratified: array (diagnostic edges x strata) from count_sample
+    :return: array (diagnostic edges x (bins * 3)), ordered by bin, then by both strands, "+" and "-"
+    """
+    by_strand = stratified.reshape(len(stratified), -1, len(READ_STRANDS))
+    at_least = np.cumsum(by_strand[:, ::-1], axis=1)[:, ::-1]
+    both = at_least.sum(axis=2, keepdims=True)
+    return np.concatenate((both, at_least), axis=2).reshape(len(stratified), -1)
+
+
+def write_sweep(stratified_counts, samples, mapq_bins, out_file_name, index, path_ids, skip_first=True):
+    """
+    This function takes the stratified edge counts of several samples and writes the homology arm coverage,
+    reference coverage and fractional homology arm coverage of every arm in every sample, for every MAPQ bin used as
+    the threshold and every strand, to a single (long) tsv file. All of these come from the counts of one pass over
+    each GAF file.
+    :param stratified_counts: list of arrays (diagnostic edges x strata) from count_sample
+    :param samples: list of sample names
+    :param mapq_bins: lower bounds of the MAPQ bins
+    :param out_file_name:
+    :param index:
+    :param path_ids: grouped arms from group_paths
+    :param skip_first: see coverage_matrix
+    """
+    count_matrix = np.concatenate([sweep_count_matrix(counts) for counts in stratified_counts], axis=1)
+    arms, hom_cov, ref_cov, frac_cov = coverage_matrix(count_matrix, index, path_ids, skip_first)
+    with open(out_file_name, "wt") as tsv_file:
+        tsv_writer = csv.writer(tsv_file, delimiter='\t', lineterminator='\n')
+        tsv_writer.writerow(["Sample", "Minimum MAPQ", "Strand", "Homology arm", "Homology arm coverage",
+                             "Reference coverage", "Fractional homology arm coverage"])
+        column = 0
+        for sample in samples:
+            for mapq in mapq_bins:
+                for strand in ("both",) + READ_STRANDS:
+                    for arm, hom, ref, frac in zip(arms, hom_cov[:, column].tolist(), ref_cov[:, column].tolist(),
+                                                   frac_cov[:, column].tolist()):
+                        tsv_writer.writerow([sample, mapq, strand, arm, hom, ref, frac])
+                    column += 1
+
+
+def write_outputs(engine, gaf_file_names, read_filter, out_path=None, out_dir=None, matrix_path=None,
+                  mapq_sweep_path=None, verbose=True):
+    """
+    This function scores GAF files with an engine and writes the tables that are asked for: the coverage table of a
+    single GAF file, one coverage table per GAF file in a directory, the coverage matrix of all of them and the MAPQ
+    sweep of all of them.
+    :param engine: CoverageEngine
+    :param gaf_file_names: list of GAF files
+    :param read_filter: from CoverageEngine.filter
+    :param out_path: TSV for the coverage table of a single GAF file
+    :param out_dir: directory for a <sample>.tsv per GAF file
+    :param matrix_path: TSV for the coverage matrix
+    :param mapq_sweep_path: TSV for the MAPQ sweep (the read filter needs MAPQ bins)
+    :param verbose: print every sample when it is scored
+    :return: list of sample names
+    """
+    sample_names = [sample_name(gaf) for gaf in gaf_file_names]
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    sample_counts = []
+    sample_strata = []
+    for sample, counts in zip(sample_names, engine.count_all(gaf_file_names, read_filter)):
+        if read_filter["mapq_bins"] is not None:
+            # The reads are counted per MAPQ bin and strand; the tables below use all of them together.
+            sample_strata.append(counts)
+            counts = counts.sum(axis=1)
+        if out_path is not None or out_dir is not None:
+            sorted_cov_list = engine.table(counts)
+            if out_path is not None:
+                write_to_tsv(sorted_cov_list, out_path)
+            if out_dir is not None:
+                write_to_tsv(sorted_cov_list, os.path.join(out_dir, f"{sample}.tsv"))
+        if matrix_path is not None:
+            sample_counts.append(counts)
+        if verbose:
+            print(f"Scored {sample}")
+    if matrix_path is not None:
+        # The edge counts of all samples are stacked into one (edges x samples) matrix and scored in one go.
+        write_matrix(np.stack(sample_counts, axis=1), sample_names, matrix_path, engine.index, engine.path_ids,
+                     engine.skip_first_arm)
+    if mapq_sweep_path is not None:
+        write_sweep(sample_strata, sample_names, read_filter["mapq_bins"], mapq_sweep_path, engine.index,
+                    engine.path_ids, engine.skip_first_arm)
+    return sample_names
+
+
+def alignment_score(row, columns):
+    """
+    This function returns how well a read aligns, to compare its alignments against different graphs: its alignment
+    score (AS:i tag), or else its number of residue matches, and then its MAPQ.
+    :param row: line of a gaf file, as bytes
+    :param columns: the row split up to (at least) the MAPQ column
+    :return: (score, MAPQ)
+    """
+    tag = row.find(GAF_SCORE_TAG)
+    if tag != -1:
+        score = int(row[tag + len(GAF_SCORE_TAG):].split(None, 1)[0])
+    else:
+        score = int(columns[GAF_MATCHES_COLUMN])
+    return score, int(columns[GAF_MAPQ_COLUMN])
+
+
+def arm_read_scores(gaf_file_name, interesting, threads=1):
+    """
+    This function finds the reads of a GAF file that step on the arms (and on more than one node, as only those can be
+    counted), and how well they align, in batches like count_read_edges.
+    :param gaf_file_name:
+    :param interesting: bitmap from arm_node_bitmap
+    :param threads: number of threads that decompress BGZF files
+    :return: generator of (read_key, alignment_score)
+    """
+    def touching(batch):
+        paths = [path for _, _, path in batch]
+        nodes = np.array(b"".join(paths)[1:].split(b">"), dtype=np.int64)
+        touched = reads_touching(interesting, nodes, [path.count(b">") for path in paths])
+        return ((key, score) for (key, score, _), touches in zip(batch, touched.tolist()) if touches)
+
+    batch = []
+    batch_nodes = 0
+    for row in gaf_rows(gaf_file_name, threads):
+        columns = row.split(None, GAF_MAPQ_COLUMN + 1)
+        path = columns[GAF_PATH_COLUMN]
+        if path.count(b"<") + path.count(b">") > 1:
+            batch.append((read_key(row, columns), alignment_score(row, columns), path.replace(b"<", b">")))
+            batch_nodes += len(path)
+            if batch_nodes >= EDGE_BATCH_SIZE:
+                yield from touching(batch)
+                batch = []
+                batch_nodes = 0
+    if batch:
+        yield from touching(batch)
+
+
+def best_shard_reads(gaf_file_names, interesting, threads=1):
+    """
+    This function takes the GAF files of one sample mapped against every shard, and puts every read in the one shard
+    that it aligns best to (see alignment_score; the first of the shards if they are equal). A read from one
+    chromosome is also mapped against the shards of the other chromosomes, so without this it could be counted in
+    several shards. Only the reads that step on the arms of a shard can be counted there, so only these are kept in
+    memory: they are found first, and then looked up in the GAF files of all shards. The mates of paired-end reads
+    are kept apart (see read_key).
+    :param gaf_file_names: list of GAF files, one per shard
+    :param interesting: list of bitmaps from arm_node_bitmap, one per shard
+    :param threads: number of threads that decompress BGZF files
+    :return: list with the set of the read_key of the reads to count in every shard
+    """
+    # {read_key: (alignment_score, -shard)}, so the best alignment is the largest one, and the first shard on a tie.
+    best = {}
+    for shard, gaf_file_name in enumerate(gaf_file_names):
+        if len(interesting[shard]):
+            for key, score in arm_read_scores(gaf_file_name, interesting[shard], threads):
+                best[key] = max(best.get(key, (score, -shard)), (score, -shard))
+    for shard, gaf_file_name in enumerate(gaf_file_names):
+        for row in gaf_rows(gaf_file_name, threads):
+            key = read_key(row, row.split(None, 1))
+            if key in best:
+                columns = row.split(None, GAF_MAPQ_COLUMN + 1)
+                if columns[GAF_PATH_COLUMN] != b"*":
+                    best[key] = max(best[key], (alignment_score(row, columns), -shard))
+    read_keys = [set() for _ in gaf_file_names]
+    for key, (_, shard) in best.items():
+        read_keys[-shard].add(key)
+    return read_keys
+
+
+def merge_coverage_tables(tables):
+    """
+    This function merges the coverage tables of one sample in several shards into one table, sorted by the homology
+    arm coverage. Every arm is in a single shard, so the rows are only put together. Arms with the same coverage stay
+    in the order of the shards.
+    :param tables: list of sorted coverage lists
+    :return: sorted coverage list
+    """
+    return sorted((row for table in tables for row in table), key=lambda row: row[1], reverse=True)
+
+
+def write_shard_outputs(shards, gaf_file_names, og_file_name=None, og_gfa_file_name=None, out_path=None,
+                        out_dir=None, matrix_path=None, verbose=True, **engine_options):
+    """
+    This function scores the GAF files of every sample in every shard against the graph of that shard, and writes the
+    tables that are asked for with the arms of all shards together: the coverage table of a single sample, one
+    coverage table per sample in a directory, and the coverage matrix of all of them (with the arms of each shard in
+    graph order). Every read is only counted in the shard it aligns best to (see best_shard_reads). Only the first shard
+    with arms leaves out its first arm (from its shared edges and its tables), like a single graph leaves out its
+    first arm; every other shard keeps all of its arms.
+    :param shards: list of (shard name, directory) from read_shards
+    :param gaf_file_names: list of GAF file names with {shard} in them
+    :param og_file_name: name of the graph in odgi format in every shard directory
+    :param og_gfa_file_name: name of the graph in GFA format in every shard directory
+    :param out_path: TSV for the coverage table of a single sample
+    :param out_dir: directory for a <sample>.tsv per sample
+    :param matrix_path: TSV for the coverage matrix
+    :param verbose: print every sample when it is scored
+    :param engine_options: passed on to the CoverageEngine of every shard
+    :return: list of sample names
+    """
+    sample_names = [sample_name(gaf) for gaf in gaf_file_names]
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    engines = []
+    for _, directory in shards:
+        # The shards before the first one with arms have nothing to leave out, so their index is the same either way.
+        engine = CoverageEngine(og_file_name and os.path.join(directory, og_file_name),
+                                og_gfa_file_name and os.path.join(directory, og_gfa_file_name),
+                                skip_first_arm=not any(len(earlier.path_ids) for earlier in engines), **engine_options)
+        engines.append(engine.load())
+    read_filters = [engine.filter() for engine in engines]
+    interesting = [arm_node_bitmap(engine.index) for engine in engines]
+    shard_counts = [[] for _ in shards]
+    for sample, gaf in zip(sample_names, gaf_file_names):
+        shard_gafs = [gaf.replace(SHARD_FIELD, shard) for shard, _ in shards]
+        tables = []
+        for i, read_keys in enumerate(best_shard_reads(shard_gafs, interesting, engines[0].threads)):
+            engine = engines[i]
+            read_filter = dict(read_filters[i], read_keys=read_keys)
+            counts = count_sample(shard_gafs[i], engine.index, engine.workers, engine.threads, read_filter)
+            if read_filter["mapq_bins"] is not None:
+                counts = counts.sum(axis=1)
+            if out_path is not None or out_dir is not None:
+                tables.append(engine.table(counts))
+            if matrix_path is not None:
+                shard_counts[i].append(counts)
+        if out_path is not None:
+            write_to_tsv(merge_coverage_tables(tables), out_path)
+        if out_dir is not None:
+            write_to_tsv(merge_coverage_tables(tables), os.path.join(out_dir, f"{sample}.tsv"))
+        if verbose:
+            print(f"Scored {sample}")
+    if matrix_path is not None:
+        arms = []
+        rows = []
+        for i, engine in enumerate(engines):
+            shard_arms, shard_rows = matrix_rows(np.stack(shard_counts[i], axis=1), engine.index, engine.path_ids,
+                                                 engine.skip_first_arm)
+            arms += shard_arms
+            rows += shard_rows
+        write_matrix_rows(arms, rows, sample_names, matrix_path)
+    return sample_names
+
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A scoring daemon on a Unix domain socket. It keeps one CoverageEngine, so the index is only loaded once, and runs
+    the jobs that clients send (see submit_job) one at a time, in the order they arrive. Every connection carries one
+    request, a line of JSON, and gets one line of JSON back: either the result of a scoring job (with the JOB_OPTIONS
+    of the command line), once it has run, or the statistics of the queue if the request is {"stats": true}.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, engine):
+        if engine.workers > 1:
+            raise ValueError("the scoring server cannot fork worker processes from its threads, use workers=1")
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, ScoringRequestHandler)
+        self.engine = engine
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "running": 0,
+                      "wait_seconds": 0.0, "run_seconds": 0.0, "max_wait_seconds": 0.0, "max_run_seconds": 0.0}
+        threading.Thread(target=self.run_jobs, daemon=True).start()
+
+    def submit(self, request):
+        """
+        This function queues a scoring job and waits until it has run.
+        :param request: dictionary with the JOB_OPTIONS
+        :return: response
+        """
+        job = {"request": request, "submitted": time.monotonic(), "done": threading.Event()}
+        with self.lock:
+            self.stats["submitted"] += 1
+        self.jobs.put(job)
+        job["done"].wait()
+        return job["response"]
+
+    def run_jobs(self):
+        """
+        This function runs the queued jobs, one at a time, for as long as the server runs.
+        """
+        while True:
+            job = self.jobs.get()
+            started = time.monotonic()
+            with self.lock:
+                self.stats["running"] += 1
+            try:
+                samples = self.run_job(job["request"])
+                job["response"] = {"status": "ok", "samples": samples}
+            except Exception as error:
+                job["response"] = {"status": "error", "error": f"{type(error).__name__}: {error}"}
+            finished = time.monotonic()
+            wait, run = started - job["submitted"], finished - started
+            job["response"].update({"wait_seconds": wait, "run_seconds": run})
+            with self.lock:
+                self.stats["running"] -= 1
+                self.stats["completed" if job["response"]["status"] == "ok" else "failed"] += 1
+                self.stats["wait_seconds"] += wait
+                self.stats["run_seconds"] += run
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+                self.stats["max_run_seconds"] = max(self.stats["max_run_seconds"], run)
+            job["done"].set()
+
+    def run_job(self, request):
+        """
+        This function scores the GAF files of a job and writes its tables.
+        :param request: dictionary with the JOB_OPTIONS (options that are left out get the defaults of the command
+                        line)
+        :return: list of sample names
+        """
+        request = dict(job_defaults(), **request)
+        if request["mapq_sweep_path"] is not None and request["mapq_bins"] is None:
+            request["mapq_bins"] = list(MAPQ_SWEEP_BINS)
+        request["min_mapq"] = default_min_mapq(request["min_mapq"], request["mapq_bins"])
+        read_filter = make_read_filter(request["min_mapq"], request["min_matches"], request["min_block_length"],
+                                       request["min_identity"], mapq_bins=request["mapq_bins"])
+        read_filter = self.engine.filter(read_filter, request["exclude_path_prefix"], request["exclude_plasmids"])
+        return write_outputs(self.engine, request["gaf_path"], read_filter, request["out_path"], request["out_dir"],
+                             request["matrix_path"], request["mapq_sweep_path"], verbose=False)
+
+    def snapshot(self):
+        """
+        This function returns the statistics of the server: the number of jobs that were submitted, completed and
+        failed, the number of jobs that are queued and running, and the mean and longest time that the finished jobs
+        waited in the queue and ran.
+        :return: dictionary of statistics
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        finished = stats["completed"] + stats["failed"]
+        stats.update({"queued": self.jobs.qsize(), "uptime_seconds": time.monotonic() - self.started,
+                      "mean_wait_seconds": stats.pop("wait_seconds") / finished if finished else 0.0,
+                      "mean_run_seconds": stats.pop("run_seconds") / finished if finished else 0.0})
+        return stats
+
+
+def job_defaults():
+    """
+    This function returns the defaults of the JOB_OPTIONS on the command line.
+    :return: dictionary {option: default}
+    """
+    parser = make_parser()
+    return {option: parser.get_default(option) for option in JOB_OPTIONS}
+
+
+def remove_stale_socket(socket_path):
+    """
+    This function removes the socket of a scoring server that is no longer running, so a new server can take its
+    place. Anything else at the path (a file, or the socket of a server that is still running) is left alone.
+    :param socket_path:
+    """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{socket_path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise FileExistsError(f"a scoring server is already running on {socket_path}")
+
+
+class ScoringRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one connection to the ScoringServer.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError as error:
+            response = {"status": "error", "error": f"invalid request: {error}"}
+        else:
+            response = self.server.snapshot() if request.get("stats") else self.server.submit(request)
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def submit_job(socket_path, request):
+    """
+    This function sends a request to a ScoringServer and waits for its response.
+    :param socket_path: Unix domain socket of the server
+    :param request: dictionary with the JOB_OPTIONS, or {"stats": true}
+    :return: response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        with connection.makefile("rb") as response:
+            return json.loads(response.readline())
+
+
 if __name__ == "__main__":
-    all_path = []
-    # The list "all_path" contains a list in the form of [node_id, path_names]
-    gr.for_each_handle(show_steps)
-    gaf_nodes = read_gaf(args.gaf_path)
-    pan_path = make_paths(all_path)
-    # The list "pan_path" contains lists in the form of [node_id, [path_name, path_name, ...]]
-    hom_path, ref_hom_path = get_path_names(separate_paths(pan_path))
-    # These are just lists of the path names for the homology arms and the reference homology arms.
-    node_dict = create_node_dict(pan_path)
-    # This dictionary can be used to look up the path names for a given node.
-    my_edges = find_legit_edges(gaf_nodes)
-    read_edges = create_edge_dict(my_edges)
-    path_dict = create_reverse_dict(node_dict)
-    shared_edges = []
-    create_shared_edges(hom_path)
-    edge_tally = create_edge_tally_dict(read_edges, get_path_names(separate_paths(pan_path)))
-    paths_for_coverage = group_paths(hom_path)
-    cov_list = make_coverage_table(paths_for_coverage)
-    # The line below sorts the list by the homology arm coverage, making it easy to see which hom_arm has the highest
-    # coverage.
-    sorted_cov_list = sorted(cov_list, key=lambda row: row[1], reverse=True)
-    write_to_tsv(sorted_cov_list)
+    args = parse_args()
+    if args.server is not None:
+        # The scoring itself happens in the server, which runs in its own directory, so file names are made absolute.
+        if args.server_stats:
+            job = {"stats": True}
+        else:
+            job = {option: getattr(args, option) for option in JOB_OPTIONS}
+            job["gaf_path"] = [os.path.abspath(gaf) for gaf in args.gaf_path]
+            job.update({option: os.path.abspath(job[option]) for option in JOB_FILE_OPTIONS if job[option] is not None})
+        response = submit_job(args.server, job)
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response.get("status", "ok") == "ok" else 1)
+    # The graph itself is only read if the index has to be built, or if paths are excluded for the first time.
+    # Everything else only needs the index, which is memory-mapped from disk when the graph has been seen before, and
+    # is loaded once, however many GAF files are scored against it.
+    engine_options = dict(index_cache=not args.no_index_cache,
+                          read_filter=make_read_filter(args.min_mapq, args.min_matches, args.min_block_length,
+                                                       args.min_identity, mapq_bins=args.mapq_bins),
+                          exclude_path_prefixes=args.exclude_path_prefix, exclude_plasmids=args.exclude_plasmids,
+                          workers=args.workers, threads=args.threads)
+    if args.shards is not None:
+        write_shard_outputs(read_shards(args.shards), args.gaf_path, args.og_path, args.og_gfa_path, args.out_path,
+                            args.out_dir, args.matrix_path, **engine_options)
+        print("Done!")
+        sys.exit(0)
+    engine = CoverageEngine(args.og_path, args.og_gfa_path, **engine_options)
+    if args.serve is not None:
+        # Stop the same way on SIGTERM (e.g. from a service manager) as on Ctrl-C, so the socket is removed.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            remove_stale_socket(args.serve)
+        except FileExistsError as error:
+            sys.exit(f"Cannot serve: {error}")
+        with ScoringServer(args.serve, engine.load()) as server:
+            print(f"Serving on {args.serve}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(args.serve)
+        sys.exit(0)
+    write_outputs(engine, args.gaf_path, engine.filter(), args.out_path, args.out_dir, args.matrix_path,
+                  args.mapq_sweep_path)
     print("Done!")
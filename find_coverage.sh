@@ -11,6 +11,7 @@ export LD_PRELOAD=/lib/x86_64-linux-gnu/libjemalloc.so.2
 # IMPORTANT: Any errors regarding "segmentation fault" and/or "core dumped" can be assumed to arise from
 # not exporting jemalloc correctly, normally when it is not installed or the path is incorrect.
 # You may need to run: apt install libjemalloc-dev if the problem persists.
+# The python script does not need odgi if it is given --og-gfa-path "yeast+edits.og.gfa" instead of --og-path.
 
 #if [ "$1" == "-t" ]; then
 #  export LD_PRELOAD=/lib/x86_64-linux-gnu/libjemalloc.so.2
@@ -47,43 +48,31 @@ export LD_PRELOAD=/lib/x86_64-linux-gnu/libjemalloc.so.2
 #  cat DesignLibraryDetails_ODD126.withEditWindow.csv | awk -F',' '{print ">ref_homology_arm_"$1; print $53;}' | tr -d \- > ref_subpaths.fa
 #fi
 
-cat DesignLibraryDetails_ODD126.withEditWindow.csv | awk -F',' '{print ">homology_arm_"$1; print $54;}' | tr -d \- > ODD126_homology_arms.fa
-cat DesignLibraryDetails_ODD126.withEditWindow.csv | awk -F',' '{print ">ref_homology_arm_"$1; print $53;}' | tr -d \- > ref_subpaths.fa
-
-# Combine homology arms and reference over the range of the homology arms into one FASTA file.
-cat ref_subpaths.fa ODD126_homology_arms.fa > ODD126_ref_and_hom_arms.fa
-
-#if [ "$1" == "-t" ]; then
-#  ref_and_mt=tiny_genome.fa
-#else
-#  ref_and_mt=ref_and_mt.fna
-#fi
-
-ref_and_mt=ref_and_mt.fna
-
-# map the homology arms against the reference
-minimap2 -k 19 -w 1 -cx sr $ref_and_mt ODD126_ref_and_hom_arms.fa >ODD126_ref_and_hom_arms.paf
-
-# combine the inputs to seqwish in a single file (and add plasmid sequences). In the test, the
-# augmented FASTA file is not used.
-#if [ "$1" == "-t" ]; then
-#  cat $ref_and_mt ODD126_ref_and_hom_arms.fa >yeast+edits.fa
-#else
-#  cat $ref_and_mt ODD126_ref_and_hom_arms.fa ODD126_augmented_CB39.fasta >yeast+edits.fa
-#fi
-
-cat $ref_and_mt ODD126_ref_and_hom_arms.fa ODD126_augmented_CB39.fasta >yeast+edits.fa
-# induce the variation graph
-seqwish -g yeast+edits.gfa -s yeast+edits.fa -p ODD126_ref_and_hom_arms.paf -P
-
-# sort and "chop" the graph so nodes are <256bp long (needed for vg map)
-odgi build -g yeast+edits.gfa -o -  | odgi sort -i - -p sYYgs -o - | odgi chop -i - -o - -c 256 | tee yeast+edits.og | odgi view -i - -g >yeast+edits.og.gfa
-
-# import the graph into xg format (efficient static graph model)
-vg convert -x yeast+edits.og.gfa >yeast+edits.og.gfa.xg
-
-# index the graph
-vg index -p -g yeast+edits.og.gfa.gcsa -t 16 yeast+edits.og.gfa.xg
+# build_graph.py and run_pipeline.py are run from the folder this script is in (e.g. "bash ../find_coverage.sh").
+scripts=$(dirname "$0")
+# "bash find_coverage.sh --shards" builds one graph per chromosome instead of one for the whole genome (each with the
+# homology arms that the PAF places on it), builds and indexes the shards in parallel, rebuilds only the shards whose
+# arms changed, and maps every sample against all the shards. The scores of all shards are merged into one .tsv per
+# sample. This is meant for genomes that are too large to build and index as a single graph.
+shards=()
+if [ "$1" == "--shards" ]; then
+  shards=(--shards shards.tsv)
+fi
+
+# build_graph.py runs the steps below (the commands are listed in STEPS in build_graph.py). Each step is cached under a
+# hash of its command, its inputs and its tools in .graph_cache, so only the steps whose inputs changed are run again:
+# with the same design library and reference, nothing is rebuilt and mapping starts right away.
+# 1a) extract the homology arms and the reference over the range of the arms from the design library
+# 1b) map the homology arms against the reference (minimap2) -> ODD126_ref_and_hom_arms.paf
+# 1c) combine the inputs to seqwish in a single file (and add the plasmid sequences as plasmid_...) -> yeast+edits.fa
+# 1d) induce the variation graph (seqwish) -> yeast+edits.gfa
+# 1e) sort and "chop" the graph so nodes are <256bp long (needed for vg map) -> yeast+edits.og, yeast+edits.og.gfa
+# 1f) import the graph into xg format (efficient static graph model) -> yeast+edits.og.gfa.xg
+# 1g) index the graph (vg index gets all the cores) -> yeast+edits.og.gfa.gcsa
+# Use --dry-run to see which steps would run, and --force to run all of them.
+python3 "$scripts"/build_graph.py --design-csv DesignLibraryDetails_ODD126.withEditWindow.csv --reference ref_and_mt.fna \
+  --plasmid ODD126_augmented_CB39.fasta --threads "$(python3 "$scripts"/run_pipeline.py --index-threads)" \
+  "${shards[@]}" || exit 1
 # The files generated so far can be used for all the data sets, as they do not change. Only the reads from the
 # experiment change.
 
@@ -110,13 +99,24 @@ vg index -p -g yeast+edits.og.gfa.gcsa -t 16 yeast+edits.og.gfa.xg
 
 
 
-cat Data_names.txt | while read -r line; do
-  # IMPORTANT: Using this pipeline on paired-end reads takes some tinkering, look at the naming convention in the
-  # line under "paired-end mode". If your reads are called reads1_001.fastq.gz and reads2_001.fastq.gz, Data_names.txt
-  # should contain only "reads", as the rest is added on in the line below.
-  # Paired-end mode:
-  #vg map -x yeast+edits.og.gfa.xg -g yeast+edits.og.gfa.gcsa -t 16 -% -f "$line"1_001.fastq.gz -f "$line"2_001.fastq.gz| pv -l >"$line".gaf
-  vg map -x yeast+edits.og.gfa.xg -g yeast+edits.og.gfa.gcsa -t 16 -% -f "$line".fastq.gz | pv -l >"$line".gaf
-  python3 compare_coverage_read_info.py --gaf-path "$line".gaf --out-path "$line".tsv --og-path "yeast+edits.og"
-done
+# run_pipeline.py maps the samples in Data_names.txt back to back and scores each one while the next ones are mapped,
+# writing "$line".tsv for every sample and pipeline_report.tsv with the status of every sample. A sample that fails
+# does not stop the others. The GAF files are deleted once they are scored (use --keep-gaf to keep them), and mapping
+# waits while the GAF files that are not yet scored take more than --disk-budget GB (add --stream to pipe vg map
+# straight into the python script instead, without writing GAF files at all). The number of vg map jobs that run
+# at the same time and their threads are planned from the cores, the free memory and the sizes of the indexes and
+# FASTQ files, and recorded in pipeline_plan.json (use --from-plan pipeline_plan.json to run with the same packing).
+# IMPORTANT: for paired-end reads, add --paired. If your reads are called reads1_001.fastq.gz and reads2_001.fastq.gz,
+# Data_names.txt should contain only "reads", as the rest is added on by the script.
+python3 "$scripts"/run_pipeline.py --names Data_names.txt --xg yeast+edits.og.gfa.xg --gcsa yeast+edits.og.gfa.gcsa \
+  --og-path "yeast+edits.og" "${shards[@]}"
+
+# The loop below does the same one sample at a time, streaming the GAF output of vg map straight into the python
+# script, so no GAF file is written at all.
+#cat Data_names.txt | while read -r line; do
+#  # Paired-end mode:
+#  #vg map -x yeast+edits.og.gfa.xg -g yeast+edits.og.gfa.gcsa -t 16 -% -f "$line"1_001.fastq.gz -f "$line"2_001.fastq.gz| pv -l | python3 compare_coverage_read_info.py --gaf-path - --out-path "$line".tsv --og-path "yeast+edits.og"
+#  vg map -x yeast+edits.og.gfa.xg -g yeast+edits.og.gfa.gcsa -t 16 -% -f "$line".fastq.gz | pv -l |
+#    python3 compare_coverage_read_info.py --gaf-path - --out-path "$line".tsv --og-path "yeast+edits.og"
+#done
 echo "Done!"
@@ -0,0 +1,511 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+
+from compare_coverage_read_info import read_shards
+
+# A rough size of the GAF that vg map writes for a .fastq.gz of a given size, used to reserve disk space for a GAF
+# before it is written. The reservation is corrected to the real size as soon as the GAF is complete.
+GAF_BYTES_PER_FASTQ_BYTE = 4
+# vg map scales about linearly up to this many threads per job; cores beyond that give more plate throughput as more
+# mapping jobs at the same time. Each vg map job holds the xg and GCSA indexes in memory (about this many bytes per
+# byte of index on disk), plus some memory for every thread.
+MAP_THREADS_PER_JOB = 8
+MAP_MEMORY_PER_INDEX_BYTE = 1.5
+MAP_MEMORY_PER_THREAD = 256 << 20
+SCORER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compare_coverage_read_info.py")
+REPORT_COLUMNS = ("sample", "status", "map_seconds", "score_seconds", "gaf_bytes", "error")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Map every sample in a list with vg map and score it with compare_coverage_read_info.py. The "
+                    "samples are mapped back to back, and each one is scored while the next ones are mapped.")
+    parser.add_argument("--names", default="Data_names.txt",
+                        help="Text file with the name of one sample per line (the FASTQ file without .fastq.gz).")
+    parser.add_argument("--xg", default="yeast+edits.og.gfa.xg")
+    parser.add_argument("--gcsa", default="yeast+edits.og.gfa.gcsa")
+    parser.add_argument("--og-path", required=False, default="yeast+edits.og")
+    parser.add_argument("--og-gfa-path", required=False,
+                        help="Score against the GFA of the graph instead of the .og file (no odgi needed).")
+    parser.add_argument("--paired", action="store_true",
+                        help="Map the paired-end files <name>1_001.fastq.gz and <name>2_001.fastq.gz of every sample.")
+    parser.add_argument("--threads", type=int, required=False,
+                        help="Number of threads of each vg map job (by default, planned from the cores and memory).")
+    parser.add_argument("--map-jobs", type=int, required=False,
+                        help="Number of vg map jobs at the same time (by default, planned from the cores and memory).")
+    parser.add_argument("--score-jobs", type=int, required=False,
+                        help="Number of samples that are scored at the same time, on cores that vg map does not use "
+                             "(by default, one per 16 cores, up to 4).")
+    parser.add_argument("--cores", type=int, required=False, help="Number of cores to use (by default, all).")
+    parser.add_argument("--memory", type=float, required=False,
+                        help="Memory to use, in GB (by default, the memory that is available).")
+    parser.add_argument("--plan-path", default="pipeline_plan.json",
+                        help="JSON file that records the machine, the estimates and the chosen packing of the jobs.")
+    parser.add_argument("--from-plan", required=False,
+                        help="Reuse the packing (jobs and threads) recorded in an earlier --plan-path.")
+    parser.add_argument("--index-threads", action="store_true",
+                        help="Only print the number of threads for vg index on this machine, and exit.")
+    parser.add_argument("--disk-budget", type=float, default=50,
+                        help="Most disk space (in GB) taken by GAF files that are mapped but not yet scored. Mapping "
+                             "waits when the next GAF would not fit.")
+    parser.add_argument("--gaf-dir", default=".", help="Directory for the GAF files.")
+    parser.add_argument("--keep-gaf", action="store_true",
+                        help="Keep the GAF files after scoring (they still count against --disk-budget until scored).")
+    parser.add_argument("--stream", action="store_true",
+                        help="Pipe the output of vg map straight into the scorer (--gaf-path -), so no GAF file is "
+                             "written at all. Every mapping job then has its own scorer running next to it.")
+    parser.add_argument("--report-path", default="pipeline_report.tsv",
+                        help="TSV with the status and timings of every sample.")
+    parser.add_argument("--vg", default="vg", help="The vg executable.")
+    parser.add_argument("--shards", metavar="SHARDS_TSV", required=False,
+                        help="Map every sample against each graph listed by build_graph.py --shards, and merge the "
+                             "scores of all shards into one table per sample. --xg, --gcsa, --og-path and "
+                             "--og-gfa-path are then the file names inside each shard directory.")
+    parsed = parser.parse_args()
+    if parsed.og_gfa_path is not None:
+        parsed.og_path = None
+    if parsed.stream and (parsed.keep_gaf or parsed.shards is not None):
+        parser.error("--stream cannot be used with --keep-gaf or --shards, which need the GAF files")
+    if parsed.from_plan is not None:
+        with open(parsed.from_plan) as plan_file:
+            plan = json.load(plan_file)
+        for option in ("map_jobs", "threads", "score_jobs"):
+            if getattr(parsed, option) is None:
+                setattr(parsed, option, plan["map_threads" if option == "threads" else option])
+    return parsed
+
+
+def machine_cores():
+    """
+    This function returns the number of cores this process may run on.
+    :return: number of cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def machine_memory():
+    """
+    This function returns the memory that is available, from /proc/meminfo (MemAvailable), or else the total memory.
+    :return: memory in bytes
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def file_size(file_name):
+    """
+    This function returns the size of a file, or 0 if it does not exist (yet).
+    :param file_name:
+    :return: size in bytes
+    """
+    return os.path.getsize(file_name) if os.path.exists(file_name) else 0
+
+
+def plan_jobs(cores, memory, index_bytes, samples, score_jobs=None, map_jobs=None, map_threads=None):
+    """
+    This function packs the vg map jobs onto the machine for the highest throughput over the whole plate rather
+    than the fastest single sample: the cores that are not kept for scoring are shared by as many mapping jobs of
+    about MAP_THREADS_PER_JOB threads as fit into memory (and as there are samples). Values that are given are kept.
+    :param cores: number of cores
+    :param memory: memory in bytes
+    :param index_bytes: size of the xg and GCSA indexes on disk
+    :param samples: number of samples
+    :param score_jobs: number of samples scored at the same time, or None
+    :param map_jobs: number of vg map jobs at the same time, or None
+    :param map_threads: number of threads of each vg map job, or None
+    :return: plan {"score_jobs", "map_jobs", "map_threads", "job_memory_bytes", "index_threads"}
+    """
+    if score_jobs is None:
+        score_jobs = max(1, min(4, cores // 16))
+    map_cores = max(1, cores - score_jobs)
+    if map_jobs is None:
+        threads = map_threads or min(map_cores, MAP_THREADS_PER_JOB)
+        job_memory = MAP_MEMORY_PER_INDEX_BYTE * index_bytes + MAP_MEMORY_PER_THREAD * threads
+        map_jobs = max(1, min(map_cores // threads, int(memory // job_memory), samples))
+    if map_threads is None:
+        # The spare cores go to the jobs as extra threads, as long as their memory still fits.
+        thread_memory = (memory / map_jobs - MAP_MEMORY_PER_INDEX_BYTE * index_bytes) // MAP_MEMORY_PER_THREAD
+        map_threads = max(1, min(map_cores // map_jobs, int(thread_memory)))
+    return {"score_jobs": score_jobs, "map_jobs": map_jobs, "map_threads": map_threads,
+            "job_memory_bytes": int(MAP_MEMORY_PER_INDEX_BYTE * index_bytes + MAP_MEMORY_PER_THREAD * map_threads),
+            # vg index runs once, on its own, so it gets every core.
+            "index_threads": cores}
+
+
+def read_sample_names(names_file_name):
+    """
+    This function reads the names of the samples, one per line. Empty lines are skipped.
+    :param names_file_name:
+    :return: list of sample names
+    """
+    with open(names_file_name) as names:
+        return [line.strip() for line in names if line.strip()]
+
+
+def fastq_files(sample, paired):
+    """
+    This function returns the FASTQ files of a sample, following the naming in find_coverage.sh.
+    :param sample:
+    :param paired: True for paired-end reads
+    :return: list of FASTQ file names
+    """
+    if paired:
+        return [f"{sample}1_001.fastq.gz", f"{sample}2_001.fastq.gz"]
+    return [f"{sample}.fastq.gz"]
+
+
+def map_command(args, sample, xg, gcsa):
+    """
+    This function returns the vg map command that writes the GAF of a sample to standard output.
+    :param args:
+    :param sample:
+    :param xg:
+    :param gcsa:
+    :return: list of arguments
+    """
+    command = [args.vg, "map", "-x", xg, "-g", gcsa, "-t", str(args.map_threads), "-%"]
+    for fastq in fastq_files(sample, args.paired):
+        command += ["-f", fastq]
+    return command
+
+
+def map_commands(args, sample):
+    """
+    This function returns the vg map commands of a sample: one against the whole graph, or one against every shard.
+    :param args:
+    :param sample:
+    :return: list of (GAF file, vg map command, log file)
+    """
+    if args.shards is None:
+        return [(os.path.join(args.gaf_dir, f"{sample}.gaf"), map_command(args, sample, args.xg, args.gcsa),
+                 f"{sample}.map.log")]
+    return [(os.path.join(args.gaf_dir, f"{sample}.{shard}.gaf"),
+             map_command(args, sample, os.path.join(directory, args.xg), os.path.join(directory, args.gcsa)),
+             f"{sample}.{shard}.map.log") for shard, directory in read_shards(args.shards)]
+
+
+def score_command(args, sample, tsv_file_name, gaf_file_name=None):
+    """
+    This function returns the command that scores the GAF file of a sample (or its GAF files of all shards).
+    :param args:
+    :param sample:
+    :param tsv_file_name:
+    :param gaf_file_name: the GAF file to score instead, e.g. - for standard input
+    :return: list of arguments
+    """
+    graph = ["--og-gfa-path", args.og_gfa_path] if args.og_gfa_path is not None else ["--og-path", args.og_path]
+    if gaf_file_name is None and args.shards is not None:
+        graph = ["--shards", args.shards] + graph
+        gaf_file_name = os.path.join(args.gaf_dir, f"{sample}.{{shard}}.gaf")
+    elif gaf_file_name is None:
+        gaf_file_name = os.path.join(args.gaf_dir, f"{sample}.gaf")
+    return [sys.executable, SCORER] + graph + ["--gaf-path", gaf_file_name, "--out-path", tsv_file_name]
+
+
+def index_bytes(args):
+    """
+    This function returns the size of the xg and GCSA indexes that one vg map job holds: those of the whole graph, or
+    of the largest shard, as the shards of a sample are mapped one after the other.
+    :param args:
+    :return: size in bytes
+    """
+    directories = [directory for _, directory in read_shards(args.shards)] if args.shards is not None else [""]
+    return max(sum(file_size(os.path.join(directory, name)) for name in (args.xg, args.gcsa, args.gcsa + ".lcp"))
+               for directory in directories)
+
+
+class DiskBudget:
+    """
+    Keeps track of the disk space taken by GAF files that are written or waiting to be scored. A GAF file reserves
+    its (estimated) size before it is written, and waits until it fits in the budget. A file that is larger than the
+    whole budget is still let through when nothing else is reserved, so the pipeline never stalls.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.changed = asyncio.Condition()
+
+    async def reserve(self, size):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.used_bytes == 0 or self.used_bytes + size <= self.budget_bytes)
+            self.used_bytes += size
+
+    async def resize(self, old_size, new_size):
+        async with self.changed:
+            self.used_bytes += new_size - old_size
+            self.changed.notify_all()
+
+    async def release(self, size):
+        await self.resize(size, 0)
+
+
+async def run_command(command, stdout_file_name, log_file_name):
+    """
+    This function runs a command with its standard output and standard error written to files.
+    :param command: list of arguments
+    :param stdout_file_name:
+    :param log_file_name: file for standard error
+    :return: exit code
+    """
+    with open(stdout_file_name, "wb") as stdout, open(log_file_name, "wb") as log:
+        process = await asyncio.create_subprocess_exec(*command, stdout=stdout, stderr=log)
+        return await process.wait()
+
+
+def error_message(log_file_name, returncode):
+    """
+    This function describes a failed command by its exit code and the last line it wrote to standard error.
+    :param log_file_name:
+    :param returncode:
+    :return: error message
+    """
+    with open(log_file_name, errors="replace") as log:
+        lines = [line.strip() for line in log if line.strip()]
+    return f"exit code {returncode}" + (f": {lines[-1]}" if lines else "")
+
+
+def exception_message(error):
+    """
+    This function describes an exception that stopped a sample (e.g. a vg executable that is missing).
+    :param error:
+    :return: error message
+    """
+    return f"{type(error).__name__}: {error}"
+
+
+def remove_files(file_names):
+    """
+    This function removes the files that exist among the given ones.
+    :param file_names:
+    """
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+async def map_sample(args, sample, results):
+    """
+    This function maps a sample against the graph, or against every shard in turn. A GAF is written under a temporary
+    name and only renamed when vg map succeeds. If the sample fails, the failure is reported and its GAF files are
+    removed, but its logs are kept; otherwise the logs are removed.
+    :param args:
+    :param sample:
+    :param results: dictionary {sample: report row}
+    :return: list of GAF files, or None if the sample failed
+    """
+    commands = []
+    try:
+        commands = map_commands(args, sample)
+        for gaf, command, log in commands:
+            returncode = await run_command(command, gaf + ".part", log)
+            if returncode != 0:
+                results[sample].update({"status": "map failed", "error": error_message(log, returncode)})
+                break
+            os.replace(gaf + ".part", gaf)
+        else:
+            remove_files([log for _, _, log in commands])
+            return [gaf for gaf, _, _ in commands]
+    except Exception as error:
+        results[sample].update({"status": "map failed", "error": exception_message(error)})
+    try:
+        remove_files([name for gaf, _, _ in commands for name in (gaf, gaf + ".part")])
+    except OSError:
+        pass
+    return None
+
+
+async def map_samples(pending, args, budget, mapped, results):
+    """
+    This function is one mapping slot: it maps samples from the queue one after the other, so the slot is kept busy,
+    and hands every GAF file to the scorers as soon as it is complete. With --shards, a sample is handed to the scorers
+    once all its GAF files are complete. A sample that fails to map is reported and skipped, and its reservation is
+    given back.
+    :param pending: queue of the samples that are not mapped yet
+    :param args:
+    :param budget: DiskBudget
+    :param mapped: queue for the scorers, of (sample, GAF files, reserved bytes)
+    :param results: dictionary {sample: report row}
+    """
+    while not pending.empty():
+        sample = pending.get_nowait()
+        estimate = GAF_BYTES_PER_FASTQ_BYTE * sum(map(file_size, fastq_files(sample, args.paired)))
+        await budget.reserve(estimate)
+        started = time.monotonic()
+        gafs = await map_sample(args, sample, results)
+        results[sample]["map_seconds"] = round(time.monotonic() - started, 1)
+        if gafs is None:
+            await budget.release(estimate)
+            continue
+        size = sum(map(file_size, gafs))
+        results[sample]["gaf_bytes"] = size
+        await budget.resize(estimate, size)
+        await mapped.put((sample, gafs, size))
+
+
+async def score_samples(args, budget, mapped, results):
+    """
+    This function scores the GAF files from the mappers as they come in, until the mappers are done. A sample that fails
+    to be scored is reported, and its GAF file and the output of the scorer are kept. The reservation of every sample
+    is given back, whatever happens.
+    :param args:
+    :param budget: DiskBudget
+    :param mapped: queue of (sample, GAF files, reserved bytes) from map_samples
+    :param results: dictionary {sample: report row}
+    """
+    while True:
+        item = await mapped.get()
+        if item is None:
+            return
+        sample, gafs, size = item
+        started = time.monotonic()
+        try:
+            returncode = await run_command(score_command(args, sample, f"{sample}.tsv"), f"{sample}.score.out",
+                                           f"{sample}.score.log")
+            if returncode != 0:
+                results[sample].update({"status": "score failed",
+                                        "error": error_message(f"{sample}.score.log", returncode)})
+            else:
+                results[sample]["status"] = "ok"
+                remove_files([f"{sample}.score.out", f"{sample}.score.log"] + ([] if args.keep_gaf else gafs))
+        except Exception as error:
+            results[sample].update({"status": "score failed", "error": exception_message(error)})
+        finally:
+            results[sample]["score_seconds"] = round(time.monotonic() - started, 1)
+            await budget.release(size)
+
+
+async def stream_sample(args, sample, results):
+    """
+    This function maps and scores a sample at the same time, with the output of vg map piped straight into the scorer,
+    so no GAF file is written. If the scorer fails, vg map stops too, and the sample counts as failed to score; if only
+    vg map fails, the table of the partial output is removed. The logs are only kept if the sample fails.
+    :param args:
+    :param sample:
+    :param results: dictionary {sample: report row}
+    """
+    tsv = f"{sample}.tsv"
+    read_end, write_end = os.pipe()
+    with open(f"{sample}.map.log", "wb") as map_log, open(f"{sample}.score.out", "wb") as score_out, \
+            open(f"{sample}.score.log", "wb") as score_log:
+        try:
+            mapper = await asyncio.create_subprocess_exec(*map_command(args, sample, args.xg, args.gcsa),
+                                                          stdout=write_end, stderr=map_log)
+            scorer = await asyncio.create_subprocess_exec(*score_command(args, sample, tsv, "-"), stdin=read_end,
+                                                          stdout=score_out, stderr=score_log)
+        finally:
+            # Only the two processes keep the pipe open, so each sees the other one finish.
+            os.close(read_end)
+            os.close(write_end)
+        map_returncode, score_returncode = await asyncio.gather(mapper.wait(), scorer.wait())
+    if score_returncode != 0:
+        results[sample].update({"status": "score failed",
+                                "error": error_message(f"{sample}.score.log", score_returncode)})
+    elif map_returncode != 0:
+        results[sample].update({"status": "map failed", "error": error_message(f"{sample}.map.log", map_returncode)})
+        remove_files([tsv])
+    else:
+        results[sample]["status"] = "ok"
+        remove_files([f"{sample}.map.log", f"{sample}.score.out", f"{sample}.score.log"])
+
+
+async def stream_samples(pending, args, results):
+    """
+    This function is one mapping slot in streaming mode: it maps and scores samples from the queue one after the other.
+    A sample that fails is reported and skipped.
+    :param pending: queue of the samples that are not mapped yet
+    :param args:
+    :param results: dictionary {sample: report row}
+    """
+    while not pending.empty():
+        sample = pending.get_nowait()
+        started = time.monotonic()
+        try:
+            await stream_sample(args, sample, results)
+        except Exception as error:
+            results[sample].update({"status": "map failed", "error": exception_message(error)})
+        # Mapping and scoring take the same time, as they run together.
+        results[sample]["map_seconds"] = results[sample]["score_seconds"] = round(time.monotonic() - started, 1)
+
+
+async def run_pipeline(samples, args):
+    """
+    This function maps and scores all the samples, with args.map_jobs mappers and args.score_jobs scorers running at
+    the same time (or with args.map_jobs mappers that each stream into their own scorer). The samples are mapped in
+    the given order.
+    :param samples: list of sample names
+    :param args:
+    :return: dictionary {sample: report row}
+    """
+    results = {sample: {"sample": sample, "status": "not run"} for sample in samples}
+    pending = asyncio.Queue()
+    for sample in samples:
+        pending.put_nowait(sample)
+    if args.stream:
+        await asyncio.gather(*[stream_samples(pending, args, results) for _ in range(args.map_jobs)])
+        return results
+    budget = DiskBudget(args.disk_budget * 1e9)
+    mapped = asyncio.Queue()
+    scorers = [asyncio.create_task(score_samples(args, budget, mapped, results)) for _ in range(args.score_jobs)]
+    await asyncio.gather(*[map_samples(pending, args, budget, mapped, results) for _ in range(args.map_jobs)])
+    for _ in scorers:
+        await mapped.put(None)
+    await asyncio.gather(*scorers)
+    return results
+
+
+def write_report(results, report_file_name):
+    """
+    This function writes the status and timings of every sample to a tsv file.
+    :param results: dictionary {sample: report row}
+    :param report_file_name:
+    """
+    with open(report_file_name, "wt") as tsv_file:
+        tsv_writer = csv.DictWriter(tsv_file, REPORT_COLUMNS, delimiter='\t', lineterminator='\n')
+        tsv_writer.writeheader()
+        for row in results.values():
+            tsv_writer.writerow(row)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cores = args.cores or machine_cores()
+    if args.index_threads:
+        print(plan_jobs(cores, 0, 0, 1)["index_threads"])
+        sys.exit(0)
+    os.makedirs(args.gaf_dir, exist_ok=True)
+    samples = read_sample_names(args.names)
+    # The largest samples are mapped first, so the last jobs of the plate are short ones and the slots finish together.
+    fastq_bytes = {sample: sum(map(file_size, fastq_files(sample, args.paired))) for sample in samples}
+    order = sorted(samples, key=lambda sample: -fastq_bytes[sample])
+    memory = args.memory * 1e9 if args.memory is not None else machine_memory()
+    job_index_bytes = index_bytes(args)
+    plan = plan_jobs(cores, memory, job_index_bytes, len(samples), args.score_jobs, args.map_jobs, args.threads)
+    args.score_jobs, args.map_jobs, args.map_threads = plan["score_jobs"], plan["map_jobs"], plan["map_threads"]
+    with open(args.plan_path, "wt") as plan_file:
+        json.dump(dict(plan, cores=cores, memory_bytes=int(memory), index_bytes=job_index_bytes,
+                       fastq_bytes=fastq_bytes, sample_order=order), plan_file, indent=2)
+    scoring = "streaming each into its own scorer" if args.stream else f"scoring {plan['score_jobs']} at a time"
+    print(f"Mapping {len(samples)} samples with {plan['map_jobs']} vg map jobs of {plan['map_threads']} threads, "
+          f"{scoring}. See {args.plan_path}.")
+    results = asyncio.run(run_pipeline(order, args))
+    results = {sample: results[sample] for sample in samples}
+    write_report(results, args.report_path)
+    failed = [row for row in results.values() if row["status"] != "ok"]
+    for row in failed:
+        print(f"{row['sample']}: {row['status']} ({row.get('error', '')})")
+    print(f"{len(samples) - len(failed)} of {len(samples)} samples scored. See {args.report_path}.")
+    sys.exit(1 if failed else 0)